@@ -0,0 +1,256 @@
+import sys
+import os
+import gc
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+import opchain
+from opchain.synth import make_chains
+from opchain.opchain import get_chains_path
+from opchain.opchain import get_mmm
+from opchain.opchain import _get_mapdata
+from opchain.opchain import read_chain
+from opchain.snapshot import get_snapshot_path
+from opchain.scan import getBestEw
+
+# offline benchmarks for the chain hot paths on synthetic chains
+#
+# usage: python bench_chains.py [--sizes small,medium,large] [--repeat N]
+#                               [--out results.json] [--compare base.json] [--threshold 1.25]
+#
+# --out saves the results as json, --compare prints the change against a
+# previous results file and exits with status 1 if any benchmark's best time
+# got slower than threshold times the old one.
+
+SYMBOL = "$SPX.X"
+RUN_DATE = "2021-04-01"
+# name -> (expirations, strikes per expiration)
+SIZES = {"small": (8, 60),
+         "medium": (20, 200),
+         "large": (60, 400)}
+REPEAT = 5
+THRESHOLD = 1.25
+PRB_VALUES = 100
+TARGET_DAYS = 45
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def time_func(func, repeat=REPEAT, setup=None):
+    # returns (times, peak bytes) - peak is measured on a separate run since
+    # tracemalloc slows everything down
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return times, peak
+
+
+def get_result(times, peak, items, unit):
+    result = {}
+    result["best"] = min(times)
+    result["mean"] = sum(times) / len(times)
+    result["repeat"] = len(times)
+    result["items"] = items
+    result["unit"] = unit
+    result["throughput"] = items / result["best"] if result["best"] > 0 else None
+    result["peak_bytes"] = peak
+    return result
+
+
+def clear_cache(remove_snapshot=False):
+    opchain.clear_chain_cache()
+    if remove_snapshot:
+        snappath = get_snapshot_path(get_chains_path(SYMBOL, RUN_DATE))
+        if os.path.isfile(snappath):
+            os.remove(snappath)
+
+
+def get_expiration(df, target=TARGET_DAYS):
+    # contracts for the expiration closest to target days
+    days = df['daysToExpiration'].unique()
+    day = days[np.argmin(abs(days - target))]
+    return df[df.daysToExpiration == day]
+
+
+def run_size(size, expirations, strikes, repeat=REPEAT):
+    chains = make_chains(symbol=SYMBOL, underlying=4000.0, expirations=expirations, strikes=strikes,
+                         step=5.0, missing=0.02, pm=0.5, run_date=RUN_DATE, day_step=3)
+    contracts = chains["numberOfContracts"]
+    filepath = get_chains_path(SYMBOL, RUN_DATE)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, "w") as f:
+        json.dump(chains, f)
+    underlying = chains["underlyingPrice"]
+    eprint(f"{size}: {expirations} expirations x {strikes} strikes, {contracts} contracts")
+
+    results = {}
+
+    def bench(name, func, items, unit, setup=None):
+        times, peak = time_func(func, repeat=repeat, setup=setup)
+        result = get_result(times, peak, items, unit)
+        results[f"{name}/{size}"] = result
+        eprint(f"  {name:24} best: {result['best']*1000:9.2f}ms  mean: {result['mean']*1000:9.2f}ms  "
+               f"{result['throughput']:12.0f} {unit}/s  peak: {peak/1024/1024:7.1f}MB")
+
+    bench("get_chains", lambda: opchain.get_chains(SYMBOL, run_date=RUN_DATE), contracts, "contracts")
+
+    def stream():
+        with open(filepath, "rb") as f:
+            read_chain(f)
+    bench("read_chain", stream, contracts, "contracts")
+
+    def parse():
+        _get_mapdata(chains["putExpDateMap"], "PUT", underlying=underlying)
+        _get_mapdata(chains["callExpDateMap"], "CALL", underlying=underlying)
+    bench("_get_mapdata", parse, contracts, "contracts")
+    bench("get_mmm", lambda: get_mmm(chains, underlying), expirations, "expirations")
+
+    def get_frame():
+        opchain.get_dataframe(SYMBOL, run_date=RUN_DATE)
+    bench("get_dataframe/json", get_frame, contracts, "contracts",
+          setup=lambda: clear_cache(remove_snapshot=True))
+    bench("get_dataframe/snapshot", get_frame, contracts, "contracts", setup=clear_cache)
+    bench("get_dataframe/cached", get_frame, contracts, "contracts")
+
+    puts = get_expiration(opchain.get_dataframe(SYMBOL, putCall="PUT", run_date=RUN_DATE))
+    days = int(puts['daysToExpiration'].iloc[0])
+    strike = puts['strikePrice'].to_numpy()
+    values = np.linspace(strike.min(), strike.max(), PRB_VALUES)
+
+    def prbs():
+        for value in values:
+            opchain.get_prb(value, puts)
+    bench("get_prb", prbs, PRB_VALUES, "values")
+    bench("get_candidates", lambda: opchain.get_candidates(puts), len(puts), "options")
+    bench("getBestEw", lambda: getBestEw(puts, daysToExpiration=days, count=100), len(puts), "options")
+    return results
+
+
+def compare(results, base, threshold=THRESHOLD):
+    # print the change in best time against base, returns the regressions
+    regressions = []
+    for name in results:
+        if name not in base:
+            print(f"{name:36} {results[name]['best']*1000:9.2f}ms  (new)")
+            continue
+        old = base[name]["best"]
+        new = results[name]["best"]
+        ratio = new / old if old > 0 else float("inf")
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:36} {old*1000:9.2f}ms -> {new*1000:9.2f}ms  x{ratio:5.2f}{flag}")
+    return regressions
+
+
+#
+# main
+#
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in ('-h', '--help'):
+        print("usage: python bench_chains.py [--sizes small,medium,large] [--repeat N] [--out results.json] [--compare base.json] [--threshold 1.25]")
+        sys.exit(0)
+
+    sizes = None
+    repeat = None
+    out_file = None
+    compare_file = None
+    threshold = None
+    for arg in sys.argv:
+        if arg.endswith(".py"):
+            continue
+        if sizes is None and arg == "--sizes":
+            sizes = arg
+        elif sizes == "--sizes":
+            sizes = arg.split(",")
+        elif repeat is None and arg == "--repeat":
+            repeat = arg
+        elif repeat == "--repeat":
+            repeat = int(arg)
+        elif out_file is None and arg == "--out":
+            out_file = arg
+        elif out_file == "--out":
+            out_file = arg
+        elif compare_file is None and arg == "--compare":
+            compare_file = arg
+        elif compare_file == "--compare":
+            compare_file = arg
+        elif threshold is None and arg == "--threshold":
+            threshold = arg
+        elif threshold == "--threshold":
+            threshold = float(arg)
+        else:
+            eprint(f"unexpected argument: {arg}")
+            sys.exit(1)
+    if sizes is None:
+        sizes = list(SIZES.keys())
+    if repeat is None:
+        repeat = REPEAT
+    if threshold is None:
+        threshold = THRESHOLD
+    for size in sizes:
+        if size not in SIZES:
+            eprint(f"unknown size: {size}, expected one of {list(SIZES.keys())}")
+            sys.exit(1)
+
+    base = None
+    if compare_file:
+        with open(compare_file) as f:
+            base = json.load(f)["results"]
+    if out_file:
+        out_file = os.path.abspath(out_file)
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.ERROR)
+
+    # the chain json and snapshots go in data/ under a scratch dir
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="bench_chains")
+    os.chdir(workdir)
+    results = {}
+    try:
+        for size in sizes:
+            expirations, strikes = SIZES[size]
+            results.update(run_size(size, expirations, strikes, repeat=repeat))
+            clear_cache()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    if out_file:
+        meta = {}
+        meta["time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        meta["python"] = platform.python_version()
+        meta["numpy"] = np.__version__
+        meta["pandas"] = pd.__version__
+        meta["platform"] = platform.platform()
+        meta["repeat"] = repeat
+        with open(out_file, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+        eprint(f"saved results to {out_file}")
+
+    if base is not None:
+        regressions = compare(results, base, threshold=threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions: {regressions}")
+            sys.exit(1)
@@ -0,0 +1,86 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import pytest
+import opchain.opchain as oc
+from opchain.synth import make_chains
+
+# test_chains.py is a script against live chains (it needs an auth_token),
+# not a pytest module
+collect_ignore = ["test_chains.py"]
+
+RUN_DATE = "2021-04-01"
+
+
+@pytest.fixture
+def chains_dir(tmp_path, monkeypatch):
+    # an empty data/ directory in a temp working directory, with the chain
+    # cache cleared either side
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    oc.clear_chain_cache()
+    yield tmp_path
+    oc.clear_chain_cache()
+
+
+@pytest.fixture
+def write_chains(chains_dir):
+    # write_chains(symbol, **make_chains args) saves a synthetic chain where
+    # get_dataframe looks for it, and returns it
+    def write(symbol, run_date=RUN_DATE, **kwargs):
+        chains = make_chains(symbol=symbol, run_date=run_date, **kwargs)
+        oc.save_chains(symbol, chains, oc.get_chains_path(symbol, run_date))
+        return chains
+    return write
+
+
+class ChainHandler(BaseHTTPRequestHandler):
+    # a stub chains api: each request takes the next of server.script[symbol]
+    # - a status code, (status code, headers) or "FAILED" - and once those
+    # run out replays make_chains(symbol, **server.chain_args.get(symbol, {}))
+    def do_GET(self):
+        server = self.server
+        symbol = parse_qs(urlparse(self.path).query)["symbol"][0]
+        with server.lock:
+            server.requests.append((symbol, self.headers.get("Authorization")))
+            script = server.script.get(symbol)
+            action = script.pop(0) if script else 200
+        headers = {}
+        if isinstance(action, tuple):
+            action, headers = action
+        if action == "FAILED":
+            action = 200
+            body = json.dumps({"symbol": symbol, "status": "FAILED"})
+        elif action == 200:
+            body = json.dumps(server.get_chains(symbol))
+        else:
+            body = json.dumps({"error": f"status {action}"})
+        body = body.encode("utf-8")
+        self.send_response(action)
+        for k in headers:
+            self.send_header(k, headers[k])
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def chain_server():
+    # ChainHandler on a local port, server.url being its chains url
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ChainHandler)
+    server.script = {}
+    server.chain_args = {}
+    server.requests = []
+    server.lock = threading.Lock()
+    server.get_chains = lambda symbol: make_chains(symbol=symbol, **server.chain_args.get(symbol, {}))
+    server.url = f"http://127.0.0.1:{server.server_port}/v1/marketdata/chains"
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -2,8 +2,11 @@ import sys
 import os
 import logging
 import pandas as pd
-import opchain
 import time
+from opchain.scan import scan_symbols
+from opchain.pipeline import scan_pipeline
+from opchain.opchain import set_compact_dtypes
+from opchain import metrics
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
@@ -18,6 +21,16 @@ MAX_DAY = 80
 MIN_EW = -0.5
 MIN_DME_W = 0.0
 NUM_EWS = 100
+# minmaxFilter's thresholds, applied in the scan workers to the NUM_EWS
+# best spreads of each expiration so only rows that make it into the output
+# files are sent back (expirations outside the days aren't scanned at all)
+SCAN_FILTERS = [("days_exp", ">=", MIN_DAY),
+                ("days_exp", "<=", MAX_DAY),
+                ("e_w", ">", MIN_EW),
+                ("dmu", ">=", MIN_DMU),
+                ("dmu2", ">=", MIN_DMU2),
+                ("dme_w", ">", MIN_DME_W),
+                ("mg", ">=", MIN_MG)]
 
 
 BEST_EW_COLUMNS = ["symbol",
@@ -60,83 +73,12 @@ RENAME_COLUMNS = {"underlyingPrice": "underlying",
                   "b_strikePrice": "b_strike",
                   "days_exp": "days"}
 
-def getMMM(candidates, target):
-    mmm = 0.0
-    if target is None:
-        target = 7
-    if "mmm" in candidates.attrs and candidates.attrs["mmm"]:
-        mmm_map = candidates.attrs["mmm"]
-        mmm_diff = 999
-        for day in mmm_map:
-            if abs(day - target) < mmm_diff:
-                mmm_diff = abs(day - target)
-                mmm = mmm_map[day]
-    return mmm
-
-def getExpDateFromDesc(desc):
-    # "CMG Dec 31 2021 1745 Put (Weekly)" -> DEC 31 21"
-    fields = desc.split()
-    month = fields[1]
-    day = fields[2]
-    year = fields[3]
-    exp_date = f"{day} {month.upper()} {year[-2:]}"
-    return exp_date
-
-def getBestEw(df, daysToExpiration=None, count=1):
-    rows = []
-    candidates = opchain.get_candidates(df)
-    if candidates is None or len(candidates) == 0:
-        return rows
-    candidates = candidates.sort_values(by="e_w", ascending=False)
-    for i in range(count):
-        if i >= len(candidates):
-            return rows
-        candidate = candidates.iloc[i]
-        mmm = getMMM(candidates, 7)
-        row = {}
-        row["exp_date"] = getExpDateFromDesc(candidate["s_description"])
-        row["mmm"] = mmm
-        mmm2 = getMMM(candidates, daysToExpiration)
-        row["mmm2"] = mmm2
-
-        underlying = candidates.attrs["underlyingPrice"]
-              
-        s_strike = candidate["s_strikePrice"]
-            
-        desc = candidate["s_description"]
-        if desc.find("Put") >= 0:
-            dm = underlying - mmm - s_strike
-            dm2 = underlying - mmm2 - s_strike
-        else:
-            dm = s_strike - underlying - mmm
-            dm2 = s_strike - underlying - mmm2
-        row["dm"] = dm
-        row["dm2"] = dm2
-        dmu = (dm/underlying)*100.0
-        row["dmu"] = dmu
-        dmu2 = (dm2/underlying)*100.0
-        row["dmu2"] = dmu2
-
-        for k in candidates.attrs:
-            if k == "mmm":
-                continue
-            v = candidates.attrs[k]
-            row[k] = v
-        for k in candidate.keys():
-            v = candidate[k]            
-            row[k] = v
-        row['days_exp'] = daysToExpiration
-        rows.append(row)
-    return rows
- 
-
-def getBestEUs(stocklist_file, rows, run_date=None, exp_days=None):
+def read_symbols(stocklist_file):
     if not os.path.isfile(stocklist_file):
         eprint(f"{stocklist_file} not found")
         sys.exit(1)
 
     symbols = []
-    failcount = 0
     with open(stocklist_file, "r") as f:
         line = f.readline()
         while line:
@@ -149,174 +91,216 @@ def getBestEUs(stocklist_file, rows, run_date=None, exp_days=None):
                 eprint(f"ignoring symbol: {symbol}")
                 line = f.readline()
                 continue
-            add_count = 0
-            for putCall in ("PUT", "CALL"):
-                df = opchain.get_dataframe(symbol, putCall=putCall, run_date=run_date, daysToExpiration=exp_days)
-                if df is None or len(df) == 0:
-                    eprint(f"unable to get data for {symbol}")
-                    failcount += 1
-                    if failcount == 3:
-                        eprint("too many failures, quitting")
-                        sys.exit()
-                else:
-                    if exp_days is None:
-                        # iterate through all the days of expiration
-                        days = df['daysToExpiration']
-                        days = list(set(list(days.values)))
-                        days.sort()
-                        for day in days:
-                            days_df = df.drop(df[df.daysToExpiration != day].index)
-                            bestews = getBestEw(days_df, daysToExpiration=day, count=NUM_EWS)
-                            rows.extend(bestews)
-                            add_count += len(bestews)
-                            failcount = 0  # reset
-                    else:
-                        row = getBestEw(df, daysToExpiration=exp_days)
-                        if row:
-                            rows.append(row)
-                            add_count += 1
-                        failcount = 0  # reset
-            if add_count:
-                symbols.append(symbol)
+            symbols.append(symbol)
             line = f.readline()
-       
+    return symbols
+
+
+def getBestEUs(stocklist_file, rows, run_date=None, exp_days=None, workers=None, pipeline=False, shared=False,
+               index=None, offset=0, filters=None):
+    # appends the scanned rows passing filters to rows, and their row numbers
+    # (as if no row had been filtered out) to index.  Returns the next row
+    # number.
+    symbols = []
+    symbolList = read_symbols(stocklist_file)
+    if pipeline:
+        # the pipeline fetches missing chains ahead of the scan
+        statuses = scan_pipeline(symbolList, run_date=run_date, exp_days=exp_days, count=NUM_EWS,
+                                 columns=BEST_EW_COLUMNS, filters=filters, workers=workers)
+    else:
+        # shared loads the chains once for all the workers
+        statuses = scan_symbols(symbolList, run_date=run_date, exp_days=exp_days, count=NUM_EWS,
+                                columns=BEST_EW_COLUMNS, filters=filters, workers=workers, shared=shared)
+    for status in statuses:
+        symbol = status["symbol"]
+        if status["error"]:
+            eprint(f"unable to scan {symbol}: {status['error']}")
+            continue
+        for putCall in status["failed"]:
+            eprint(f"unable to get data for {symbol}")
+        rows.extend(status["rows"])
+        if index is not None:
+            index.extend(offset + i for i in status["row_ids"])
+        offset += status["row_count"]
+        if status["rows"]:
+            symbols.append(symbol)
+
     eprint(f"got data for {len(symbols)} symbols {symbols} from file: {stocklist_file}")
+    return offset
+
+
+def getMinMaxMask(df):
+    # minmaxFilter's thresholds as one row mask
+    mask = (df.days_exp >= MIN_DAY) & (df.days_exp <= MAX_DAY)
+    mask &= df.e_w > MIN_EW
+    mask &= df.dmu >= MIN_DMU
+    mask &= df.dmu2 >= MIN_DMU2
+    mask &= df.dme_w > MIN_DME_W
+    mask &= df.mg >= MIN_MG
+    return mask
 
 
 def minmaxFilter(df, use_odd_day_symbols=False):
     logging.info(f"df minmaxstart:  {len(df)} rows")
-    df = df[df.days_exp >= MIN_DAY]
-    df = df[df.days_exp <= MAX_DAY]
-    logging.info(f"len after min/max days: {len(df)}")
-    df = df[df.e_w > MIN_EW]
-    logging.info(f"len after > MIN_EW: {len(df)}")
-    #df = df.drop(df[df.dmu <= MIN_DMU].index) 
-    df = df[df.dmu >= MIN_DMU]
-    logging.info(f"len after <= MIN_DMU: {len(df)}")
-    # df = df.drop(df[df.dmu2 <= MIN_DMU2].index)
-    df = df[df.dmu2 >= MIN_DMU2]
-    logging.info(f"len after <= MIN_DMU2: {len(df)}")
-    # df = df.drop(df[df.dme_u <= MIN_DME_U].index)
-    logging.debug(f"dme_w max: {df.dme_w.max()}")
-    logging.debug(f"dme_w min: {df.dme_w.min()}")
-    #df = df.drop(df[df.dme_w <= MIN_DME_W].index)
-    df = df[df.dme_w > MIN_DME_W]
-    logging.info(f"len after > MIN_DME_W: {len(df)}")
-    # df = df.drop(df[df.mg <= MIN_MG].index)
-    df = df[df.mg >= MIN_MG]
-    logging.info(f"len after <= MIN_MG: {len(df)}")
+    df = df[getMinMaxMask(df)]
+    logging.info(f"len after min/max filters: {len(df)}")
     if len(df) == 0:
         logging.info("no rows, returning empty dataframe")
         return df
-           
-    #eprint("symbols:", df['symbol'])
-    eprint("df minmaxstart start filter symbols:", len(df))
     if use_odd_day_symbols:
         df = df[df.symbol.isin(ODD_DAY_SYMBOLS)]
     else:
-        eprint("filtered symbols")
         df = df[~df.symbol.isin(ODD_DAY_SYMBOLS)]
-
-    eprint("trimed df:", len(df))
-    
     df = df.sort_values(by="dme_w", ascending=False)  # DME_u
     return df
-     
+
+
+def writeBestEw(df, filepath, out_format="csv"):
+    # write one output file straight from the frame
+    df = df.rename(columns=RENAME_COLUMNS)
+    with metrics.timer("write"):
+        if out_format == "parquet":
+            df.to_parquet(filepath)
+        else:
+            with open(filepath, 'w') as f:
+                df.to_csv(f, float_format="%.2f")
+                # the files used to be written with print(), keep its newline
+                f.write("\n")
+
+
+def writeBestEUs(df, out_dir, run_date, out_format="csv"):
+    # best_ew_{run_date}_{day} files of the minmaxFilter rows for each day,
+    # without the odd day symbols, and best_ew_{run_date}_index of the odd
+    # day symbols' rows - all from one pass over the rows
+    ext = "parquet" if out_format == "parquet" else "csv"
+    df = df[getMinMaxMask(df)]
+    odd = df.symbol.isin(ODD_DAY_SYMBOLS).to_numpy()
+    count = 0
+    for day, df_day in df[~odd].groupby("days_exp", sort=True):
+        logging.info(f"day: {day}, {len(df_day)} rows")
+        df_day = df_day.sort_values(by="dme_w", ascending=False)  # DME_u
+        writeBestEw(df_day, f"{out_dir}/best_ew_{run_date}_{day}.{ext}", out_format=out_format)
+        count += 1
+    df_odd = df[odd].sort_values(by="dme_w", ascending=False)
+    writeBestEw(df_odd, f"{out_dir}/best_ew_{run_date}_index.{ext}", out_format=out_format)
+    return count
+
 
 # main
 #
-if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
-    print("usage: python get_besteu.py [--rundate YYYY-MM-DD ] [--expdays DD] [--outdir dir] [stocklist_file1] [stocklist_file2]")
-    sys.exit(0)
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        print("usage: python get_besteu.py [--rundate YYYY-MM-DD ] [--expdays DD] [--outdir dir] [--format csv|parquet] [--workers N] [--pipeline | --shared] [--profile] [--compact] [--float32] [stocklist_file1] [stocklist_file2]")
+        sys.exit(0)
 
+    run_date = None
+    exp_days = None
+    out_dir = None
+    out_format = None
+    workers = None
+    profile = False
+    pipeline = False
+    shared = False
+    compact = False
+    float32 = False
+    csv_files = []
 
-run_date = None
-exp_days = None
-out_dir = None
-csv_files = []
-
-for arg in sys.argv:
-    if arg.endswith(".py"):
-        continue
-    if run_date is None and arg == "--rundate":
-        run_date = arg
-    elif run_date == "--rundate":
-        run_date = arg
-    elif exp_days is None and arg == "--expdays":
-        exp_days = arg
-    elif exp_days == "--expdays":
-        exp_days = int(arg)
-    elif out_dir is None and arg == "--outdir":
-        out_dir = "--outdir"
-    elif out_dir == "--outdir":
-        out_dir = arg
-    else:
-        csv_files.append(arg)
+    for arg in sys.argv:
+        if arg.endswith(".py"):
+            continue
+        if run_date is None and arg == "--rundate":
+            run_date = arg
+        elif run_date == "--rundate":
+            run_date = arg
+        elif exp_days is None and arg == "--expdays":
+            exp_days = arg
+        elif exp_days == "--expdays":
+            exp_days = int(arg)
+        elif out_dir is None and arg == "--outdir":
+            out_dir = "--outdir"
+        elif out_dir == "--outdir":
+            out_dir = arg
+        elif out_format is None and arg == "--format":
+            out_format = arg
+        elif out_format == "--format":
+            out_format = arg
+        elif workers is None and arg == "--workers":
+            workers = arg
+        elif workers == "--workers":
+            workers = int(arg)
+        elif arg == "--pipeline":
+            pipeline = True
+        elif arg == "--shared":
+            shared = True
+        elif arg == "--profile":
+            profile = True
+        elif arg == "--compact":
+            compact = True
+        elif arg == "--float32":
+            # float32 implies the compact frames
+            compact = True
+            float32 = True
+        else:
+            csv_files.append(arg)
 
-loglevel = logging.ERROR
-logging.basicConfig(format='%(asctime)s %(message)s', level=loglevel)
+    if out_format is None:
+        out_format = "csv"
+    if out_format not in ("csv", "parquet"):
+        eprint(f"unknown --format: {out_format}, expected csv or parquet")
+        sys.exit(1)
+    if pipeline and shared:
+        eprint("--shared loads every chain before the scan, it can't be used with --pipeline")
+        sys.exit(1)
+    if out_format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            eprint("--format parquet needs pyarrow (pip install pyarrow)")
+            sys.exit(1)
 
-# assume it's a csv file of symbols
-rows = []
-start_time = time.time()
-eprint("getBestEUs start")
-for csv_file in csv_files:
-    getBestEUs(csv_file, rows, run_date=run_date, exp_days=exp_days)
-eprint(f"getBestEUs done - {int(time.time() - start_time)}")     
-if not rows:
-    eprint("no rows found!")
-    sys.exit()
-# row = rows[0]
-# columns = list(row.keys())
-df = pd.DataFrame(rows, columns=BEST_EW_COLUMNS, )
+    loglevel = logging.ERROR
+    logging.basicConfig(format='%(asctime)s %(message)s', level=loglevel)
+    if profile:
+        metrics.enable()
+    if compact:
+        set_compact_dtypes(compact=True, float32=float32)
 
-days = df['days_exp']
-print(df.columns)
-print("days:", days)
-print("row count:", len(df))
-days = list(set(list(days.values)))
-days.sort()
+    # assume it's a csv file of symbols
+    rows = []
+    start_time = time.time()
+    eprint("getBestEUs start")
+    index = []
+    offset = 0
+    # without --outdir every row is printed, not just the output files' ones
+    filters = SCAN_FILTERS if out_dir else None
+    for csv_file in csv_files:
+        offset = getBestEUs(csv_file, rows, run_date=run_date, exp_days=exp_days, workers=workers, pipeline=pipeline,
+                            shared=shared, index=index, offset=offset, filters=filters)
+    eprint(f"getBestEUs done - {int(time.time() - start_time)}")     
+    if offset == 0:
+        # (rows that were all filtered out still give an empty index file)
+        eprint("no rows found!")
+        sys.exit()
+    # row = rows[0]
+    # columns = list(row.keys())
+    df = pd.DataFrame(rows, columns=BEST_EW_COLUMNS, index=index)
 
-if out_dir:
-    original_stdout = sys.stdout # Save a reference to the original standard output
-    eprint(f"days start  - {int(time.time() - start_time)}")     
+    days = df['days_exp']
+    print(df.columns)
+    print("days:", days)
+    print("row count:", len(df))
 
-    for day in days:  
-        if day < MIN_DAY:
-            #eprint(f"{day} less than {MIN_DAY}, skipping")
-            continue
-        if day > MAX_DAY:
-            #eprint(f"{day} greater than {MAX_DAY}, skipping")
-            continue
-        logging.info(f"running day: {day}")
-        df_day = df[df.days_exp == day]
-        logging.info(f"df_day: {len(df_day)} rows")
-        if len(df_day.index) == 0:
-            logging.info("no rows")
-            continue # no rows
-        df_day = minmaxFilter(df_day)
-         
-        if len(df_day.index) > 0:
-            filename = f"{out_dir}/best_ew_{run_date}_{day}.csv"
-            df_day = df_day.rename(columns=RENAME_COLUMNS)
-            with open(filename, 'w') as f:
-                sys.stdout = f # Change the standard output to the file we created.
-                output = df_day.to_csv(float_format="%.2f")
-                print(output)
-    eprint(f"days done  - {int(time.time() - start_time)}")     
+    if out_dir:
+        eprint(f"days start  - {int(time.time() - start_time)}")     
+        count = writeBestEUs(df, out_dir, run_date, out_format=out_format)
+        eprint(f"{count} day files, odds done  - {int(time.time() - start_time)}")     
+    else:
+        print(df)
 
-    # odd days file
-    filename = f"{out_dir}/best_ew_{run_date}_index.csv"
-    df = pd.DataFrame(rows, columns=BEST_EW_COLUMNS)
-    df_odd = minmaxFilter(df, use_odd_day_symbols=True)
-    df_odd = df_odd.rename(columns=RENAME_COLUMNS)
-    with open(filename, 'w') as f:
-        sys.stdout = f # Change the standard output to the file we created.
-        output = df_odd.to_csv(float_format="%.2f")
-        print(output)
-    eprint(f"odds done  - {int(time.time() - start_time)}")     
+    if profile:
+        eprint(f"profile - {time.time() - start_time:.2f}s total")
+        eprint(metrics.format_breakdown())
 
 
-    sys.stdout = original_stdout # Reset the standard output to its original value
-else:
-    print(df)
+if __name__ == "__main__":
+    main()
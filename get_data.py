@@ -1,16 +1,14 @@
-
 import sys
 import os
 import opchain
  
 
-def get_data(stocklist_file):
+def read_symbols(stocklist_file):
     if not os.path.isfile(stocklist_file):
         print(f"{stocklist_file} not found")
         sys.exit(1)
 
     symbols = []
-    failcount = 0
     with open(stocklist_file, "r") as f:
         line = f.readline()
         while line:
@@ -26,35 +24,99 @@ def get_data(stocklist_file):
                 print(f"ignoring symbol: {symbol}")
                 line = f.readline()
                 continue
-            print(symbol)
-            df = opchain.get_dataframe(symbol, reload=True)
-            if df is None or len(df) == 0:
-                print("unable to get data for {symbol}")
-                failcount += 1
-                if failcount == 10:
-                    print("too many failures, quitting")
-                    sys.exit()
-            else:
-                print(f"got {len(df)} rows for symbol {symbol}")
-                symbols.append(symbol)
-                failcount = 0  # reset
-         
+            symbols.append(symbol)
             line = f.readline()
-        
+    return symbols
+
+
+def get_data(stocklist_file):
+    symbols = []
+    failcount = 0
+    for symbol in read_symbols(stocklist_file):
+        print(symbol)
+        df = opchain.get_dataframe(symbol, reload=True)
+        if df is None or len(df) == 0:
+            print("unable to get data for {symbol}")
+            failcount += 1
+            if failcount == 10:
+                print("too many failures, quitting")
+                sys.exit()
+        else:
+            print(f"got {len(df)} rows for symbol {symbol}")
+            symbols.append(symbol)
+            failcount = 0  # reset
 
     print(f"got data for {len(symbols)} symbols from file: {stocklist_file}")
 
 
+def get_data_concurrent(stocklist_file, workers):
+    symbols = read_symbols(stocklist_file)
+    statuses = opchain.fetch_many(symbols, workers=workers, reload=True)
+    failed = []
+    for status in statuses:
+        if status["status"] == "failed":
+            print(f"{status['symbol']}: failed after {status['attempts']} attempts - {status['error']}")
+            failed.append(status["symbol"])
+        else:
+            print(f"{status['symbol']}: {status['status']}")
+    print(f"got data for {len(symbols) - len(failed)} symbols from file: {stocklist_file}")
+    if failed:
+        print(f"failed symbols: {failed}")
+
+
 #
 # main
 #
 if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
-    print("usage: python get_all.py  [stocklist_file1] [stocklist_file2]")
+    print("usage: python get_all.py [--workers N] [--store] [--schedule [--rpm N]] [stocklist_file1] [stocklist_file2]")
     sys.exit(0)
 
-for file_list in sys.argv:
-    if file_list.endswith(".py"):
+workers = None
+store = False
+schedule = False
+rpm = None
+file_lists = []
+for arg in sys.argv:
+    if arg.endswith(".py"):
         continue
-    get_data(file_list)
+    if arg == "--store":
+        store = True
+    elif arg == "--schedule":
+        schedule = True
+    elif rpm is None and arg == "--rpm":
+        rpm = arg
+    elif rpm == "--rpm":
+        rpm = float(arg)
+    elif workers is None and arg == "--workers":
+        workers = arg
+    elif workers == "--workers":
+        workers = int(arg)
+    else:
+        file_lists.append(arg)
+
+if schedule:
+    # keep refreshing intraday snapshots, by priority, until interrupted
+    symbols = []
+    for file_list in file_lists:
+        symbols.extend(read_symbols(file_list))
+    if rpm is None:
+        rpm = opchain.fetch.REQUESTS_PER_MINUTE
+    scheduler = opchain.RefreshScheduler(symbols, requests_per_minute=rpm)
+    print(f"refreshing {len(symbols)} symbols, {rpm} requests per minute")
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        print(scheduler.get_schedule())
+    sys.exit(0)
+
+for file_list in file_lists:
+    if workers:
+        get_data_concurrent(file_list, workers)
+    else:
+        get_data(file_list)
+    if store:
+        # add today's snapshots to the historical store
+        count = opchain.update_store(read_symbols(file_list))
+        print(f"added {count} snapshots to the store")
 
-print('done!')
\ No newline at end of file
+print('done!')
@@ -2,5 +2,28 @@
 from .opchain import get_chains
 from .opchain import get_dataframe
 from .opchain import get_candidates
+from .opchain import count_candidates
 from .opchain import get_derived
 from .opchain import get_prb
+from .chainindex import ChainIndex
+from .opchain import set_chain_cache_size
+from .opchain import clear_chain_cache
+from .fetch import fetch_many
+from .opchain import get_mmm_frame
+from .scan import scan_symbols
+from .incremental import update_candidates
+from .store import update_store
+from .store import get_catalog
+from .store import query_history
+from .store import iter_history
+from .opchain import read_chain
+from .opchain import set_compact_dtypes
+from .derived import register_derived
+from .pipeline import scan_pipeline
+from .service import ChainService
+from .service import serve
+from .scheduler import RefreshScheduler
+from .shared import SharedChains
+from .sweep import sweep_candidates
+from .sweep import sweep_symbols
+from .condor import get_condors
@@ -0,0 +1,184 @@
+import numpy as np
+
+
+class ChainIndex:
+    # sorted strike/delta/mark arrays per (putCall, daysToExpiration)
+    #
+    # Built once per chain (get_dataframe attaches one to df.attrs["chainIndex"])
+    # so lookups that used to rescan the option list are a binary search.
+    # Where several options share a strike the first one in frame order is
+    # used, which is what the old scanning loops did.
+
+    def __init__(self):
+        self._groups = {}
+
+    @classmethod
+    def from_frame(cls, df):
+        index = cls()
+        if len(df) == 0:
+            return index
+        labels = df.index.to_numpy()
+        strikes = df['strikePrice'].to_numpy(dtype=float)
+        deltas = df['delta'].to_numpy(dtype=float)
+        marks = df['mark'].to_numpy(dtype=float)
+        groups = df.groupby(['putCall', 'daysToExpiration'], sort=False, observed=True).indices
+        for key in groups:
+            pos = groups[key]
+            putCall, days = key
+            index.add(putCall, days, strikes[pos], deltas[pos], marks=marks[pos], labels=labels[pos])
+        return index
+
+    def add(self, putCall, days, strikes, deltas, marks=None, labels=None):
+        # strikes, deltas, marks (and labels) are in frame order
+        if marks is None:
+            marks = np.full(len(strikes), np.nan)
+        if labels is None:
+            labels = np.arange(len(strikes))
+        order = np.argsort(strikes, kind="stable")
+        strike, first = np.unique(strikes[order], return_index=True)
+        first = order[first]
+        abs_delta = abs(deltas)
+        delta_order = np.argsort(abs_delta, kind="stable")
+        group = {}
+        group["labels"] = labels
+        # the frame's values, for matches()
+        group["strikes"] = strikes
+        group["deltas"] = deltas
+        group["marks"] = marks
+        group["strike"] = strike
+        group["delta"] = deltas[first]
+        group["mark"] = marks[first]
+        group["abs_delta"] = abs_delta[delta_order]
+        group["delta_order"] = delta_order
+        self._groups[(putCall, days)] = group
+
+    def __contains__(self, key):
+        return key in self._groups
+
+    def __len__(self):
+        return len(self._groups)
+
+    def __repr__(self):
+        return f"<ChainIndex {len(self._groups)} expirations>"
+
+    def __deepcopy__(self, memo):
+        # the index is never modified after it's built, so don't copy it
+        # every time pandas copies a frame's attrs - a copy whose values are
+        # edited afterwards no longer matches() it
+        return self
+
+    @property
+    def nbytes(self):
+        # memory held by the index's arrays
+        nbytes = 0
+        for group in self._groups.values():
+            for values in group.values():
+                nbytes += values.nbytes
+        return nbytes
+
+    def keys(self):
+        return list(self._groups.keys())
+
+    def days(self, putCall=None):
+        days = set()
+        for key in self._groups:
+            if putCall is None or key[0] == putCall:
+                days.add(key[1])
+        days = list(days)
+        days.sort()
+        return days
+
+    def _get_group(self, putCall, days):
+        key = (putCall, days)
+        if key not in self._groups:
+            raise KeyError(f"no options for {putCall} daysToExpiration: {days}")
+        return self._groups[key]
+
+    def matches(self, putCall, days, labels, strikes=None, deltas=None, marks=None):
+        # True if the index was built from exactly these rows - and these
+        # strikes, deltas and marks (in the same order) where they're given
+        if (putCall, days) not in self._groups:
+            return False
+        group = self._groups[(putCall, days)]
+        if not np.array_equal(group["labels"], np.asarray(labels)):
+            return False
+        for name, values in (("strikes", strikes), ("deltas", deltas), ("marks", marks)):
+            if values is None:
+                continue
+            if not np.array_equal(group[name], np.asarray(values, dtype=float), equal_nan=True):
+                return False
+        return True
+
+    def labels(self, putCall, days):
+        return self._get_group(putCall, days)["labels"]
+
+    def strikes(self, putCall, days):
+        # sorted unique strikes
+        return self._get_group(putCall, days)["strike"]
+
+    def deltas(self, putCall, days):
+        # delta for each of strikes()
+        return self._get_group(putCall, days)["delta"]
+
+    def marks(self, putCall, days):
+        # mark for each of strikes()
+        return self._get_group(putCall, days)["mark"]
+
+    def bracket(self, putCall, days, value):
+        # positions in strikes() of the highest strike below value and the
+        # lowest strike at or above value - None where there isn't one
+        strike = self._get_group(putCall, days)["strike"]
+        pos = int(np.searchsorted(strike, value, side="left"))
+        lo = pos - 1 if pos > 0 else None
+        hi = pos if pos < len(strike) else None
+        return (lo, hi)
+
+    def delta_range(self, putCall, days, low, high, inclusive=True):
+        # positions (in frame order) of the options with low <= abs(delta) <= high,
+        # or low < abs(delta) < high if inclusive is False
+        group = self._get_group(putCall, days)
+        abs_delta = group["abs_delta"]
+        if inclusive:
+            start = np.searchsorted(abs_delta, low, side="left")
+            stop = np.searchsorted(abs_delta, high, side="right")
+        else:
+            start = np.searchsorted(abs_delta, low, side="right")
+            stop = np.searchsorted(abs_delta, high, side="left")
+        if stop <= start:
+            return np.zeros(0, dtype=np.intp)
+        return np.sort(group["delta_order"][start:stop])
+
+    def interp_delta(self, putCall, days, values):
+        # abs(delta) linearly interpolated at each value - see interp_delta()
+        group = self._get_group(putCall, days)
+        return interp_delta(values, group["strike"], group["delta"])
+
+
+def interp_delta(values, strike, delta):
+    # batched get_prb: returns (prbs, valid) where valid is False for each
+    # value without a strike on both sides (get_prb returned None).
+    # strike must be sorted and unique.
+    values = np.asarray(values, dtype=float)
+    prbs = np.full(len(values), np.nan)
+    valid = np.zeros(len(values), dtype=bool)
+    n = len(strike)
+    if n == 0:
+        return prbs, valid
+
+    pos = np.searchsorted(strike, values, side="left")
+    at = np.minimum(pos, n - 1)
+    exact = (pos < n) & (strike[at] == values)
+    prbs[exact] = abs(delta[at[exact]])
+
+    bracket = ~exact & (pos > 0) & (pos < n)
+    x = values[bracket]
+    hi = pos[bracket]
+    lo = hi - 1
+    x1 = strike[lo]
+    x2 = strike[hi]
+    y1 = delta[lo]
+    y2 = delta[hi]
+    # same expression as get_prb's linear() so results are bit-identical
+    prbs[bracket] = abs(y1 + (x - x1)*(y2 - y1)/(x2 - x1))
+    valid = exact | bracket
+    return prbs, valid
@@ -0,0 +1,247 @@
+import heapq
+import logging
+import numpy as np
+import pandas as pd
+from .chainindex import ChainIndex
+from .opchain import get_dataframe
+from .opchain import get_candidates
+from . import metrics
+
+# iron condors from a put and a call spread of the same expiration
+#
+# A condor is the sum of its two verticals, so its expected value is the
+# sum of theirs - the e get_candidates already computed for each side with
+# gete().  Its credit is the sum of the credits, and as only one side can
+# finish in the money its max loss is the wider spread's width less the
+# credit.  So e_w = 100 * (p_e + c_e) / max(p_width, c_width).  pop is the
+# chance of finishing between the condor's break evens, which are further
+# out than either vertical's (the credit is bigger), interpolated from the
+# chain the same way get_candidates does.
+#
+#   puts = get_candidates(get_dataframe("SPY", "PUT", daysToExpiration=45))
+#   calls = get_candidates(get_dataframe("SPY", "CALL", daysToExpiration=45))
+#   condors = get_condors(puts, calls, top_k=20, min_credit=1.0, max_loss=20.0, min_pop=60.0)
+#
+# Rather than pairing every put spread with every call spread, the top
+# top_k are kept in a heap.  Put spreads are taken best bound first and
+# call spreads by e, so once a spread's bound on e_w (computed with the
+# narrower of the two widths) can't beat the heap's worst, the rest of the
+# call spreads for that put spread - and once the bound with the best call
+# spread can't, the rest of the put spreads - are skipped.
+
+CONDOR_TOP_K = 20
+CONDOR_BLOCK = 256  # call spreads evaluated at a time for each put spread
+
+# candidate columns carried over for each leg, sell and buy
+CONDOR_LEG_COLUMNS = ("description", "strikePrice", "delta", "mark", "last")
+
+
+def _get_side(candidates):
+    # column arrays of a side's candidates, with e as a float array and NaN e dropped
+    side = {}
+    side["e"] = candidates["e"].to_numpy(dtype=float)
+    side["mg"] = candidates["mg"].to_numpy(dtype=float)
+    side["width"] = candidates["width"].to_numpy(dtype=float)
+    side["pos"] = np.flatnonzero(~np.isnan(side["e"]) & (side["width"] > 0))
+    for name in ("e", "mg", "width"):
+        side[name] = side[name][side["pos"]]
+    side["strike"] = candidates["s_strikePrice"].to_numpy(dtype=float)[side["pos"]]
+    return side
+
+
+def _get_bound(e, width, max_width):
+    # upper bound on 100 * e / max(width, w) over widths w <= max_width
+    return np.where(e > 0, 100 * e / width, 100 * e / np.maximum(width, max_width))
+
+
+def _join(puts, calls, index_p, index_c, daysToExpiration, top_k, min_credit, max_loss, min_e_w, min_pop):
+    # top_k (e_w, -put, -call) keys and their values for one expiration,
+    # put and call being positions in each side's candidates
+    heap = []
+    threshold = -np.inf if min_e_w is None else min_e_w
+    if len(puts["e"]) == 0 or len(calls["e"]) == 0:
+        return heap
+
+    # call spreads by e (ties in candidate order), and each put spread's
+    # bound with the best of them
+    c_order = np.lexsort((calls["pos"], -calls["e"]))
+    c_e = calls["e"][c_order]
+    c_mg = calls["mg"][c_order]
+    c_width = calls["width"][c_order]
+    c_strike = calls["strike"][c_order]
+    c_pos = calls["pos"][c_order]
+    max_width = max(np.max(c_width), np.max(puts["width"]))
+    p_bound = _get_bound(puts["e"] + c_e[0], puts["width"], max_width)
+    p_order = np.lexsort((puts["pos"], -p_bound))
+
+    evaluated = 0
+    for p in p_order:
+        if p_bound[p] < threshold:
+            # puts are in bound order, so no later put can make the cut either
+            break
+        p_e = puts["e"][p]
+        p_width = puts["width"][p]
+        p_mg = puts["mg"][p]
+        # the bound falls with c_e, so the calls worth trying are a prefix
+        bound = _get_bound(p_e + c_e, p_width, max_width)
+        n = int(np.searchsorted(-bound, -threshold, side="right"))
+        for start in range(0, n, CONDOR_BLOCK):
+            stop = min(n, start + CONDOR_BLOCK)
+            if bound[start] < threshold:
+                break
+            c = np.arange(start, stop)
+            evaluated += len(c)
+            mg = p_mg + c_mg[c]
+            width = np.maximum(p_width, c_width[c])
+            e_w = 100 * (p_e + c_e[c]) / width
+            # short strikes mustn't cross
+            mask = ~(puts["strike"][p] >= c_strike[c]) & ~(e_w < threshold)
+            if min_credit is not None:
+                mask &= ~(mg < min_credit)
+            if max_loss is not None:
+                mask &= ~(width - mg > max_loss)
+            c = c[mask]
+            if len(c) == 0:
+                continue
+            mg = mg[mask]
+            e_w = e_w[mask]
+            # the condor's break evens, moved out by the whole credit
+            p_delta, p_valid = index_p.interp_delta("PUT", daysToExpiration, puts["strike"][p] - mg)
+            c_delta, c_valid = index_c.interp_delta("CALL", daysToExpiration, c_strike[c] + mg)
+            pop = 100.0 * (1 - p_delta - c_delta)
+            mask = p_valid & c_valid
+            if min_pop is not None:
+                mask &= ~(pop < min_pop)
+            for i in np.flatnonzero(mask):
+                key = (e_w[i], -puts["pos"][p], -c_pos[c[i]])
+                if len(heap) < top_k:
+                    heapq.heappush(heap, (key, pop[i]))
+                elif key > heap[0][0]:
+                    heapq.heapreplace(heap, (key, pop[i]))
+                if len(heap) == top_k:
+                    threshold = max(threshold, heap[0][0][0])
+    metrics.count("condors_evaluated", evaluated)
+    return heap
+
+
+def _get_days(candidates):
+    if "daysToExpiration" in candidates.columns:
+        return candidates["daysToExpiration"].to_numpy()
+    return np.full(len(candidates), candidates.attrs["daysToExpiration"])
+
+
+def _get_leg_values(candidates, rows, name):
+    # a column of both legs of the candidates' rows, sell then buy
+    return np.concatenate([candidates["s_" + name].to_numpy(dtype=float)[rows],
+                           candidates["b_" + name].to_numpy(dtype=float)[rows]])
+
+
+def _get_index(candidates, putCall, days):
+    # the chainIndex get_candidates attached, if it has every leg's strike
+    # for each expiration.  Otherwise (the attr was dropped, or is from
+    # another chain) an index rebuilt from the legs, which pop is then
+    # interpolated over - only the candidates' strikes rather than the chain's.
+    index = candidates.attrs.get("chainIndex")
+    if index is not None:
+        for day in set(days):
+            strikes = _get_leg_values(candidates, np.flatnonzero(days == day), "strikePrice")
+            if (putCall, day) not in index or not np.isin(strikes, index.strikes(putCall, day)).all():
+                logging.warning(f"get_condors, {putCall} chainIndex doesn't match the candidates")
+                index = None
+                break
+    else:
+        logging.warning(f"get_condors, no {putCall} chainIndex, using the candidates' legs")
+    if index is not None:
+        return index
+    index = ChainIndex()
+    for day in set(days):
+        rows = np.flatnonzero(days == day)
+        index.add(putCall, day, _get_leg_values(candidates, rows, "strikePrice"),
+                  _get_leg_values(candidates, rows, "delta"), marks=_get_leg_values(candidates, rows, "mark"))
+    return index
+
+
+def get_condors(put_candidates, call_candidates, top_k=CONDOR_TOP_K, min_credit=None, max_loss=None, min_e_w=None,
+                min_pop=None):
+    # the best top_k iron condors by e_w (largest first) for each expiration
+    # in both put_candidates and call_candidates (get_candidates frames of
+    # one expiration, or several with a daysToExpiration column).  Condors
+    # have ps_, pb_, cs_ and cb_ leg columns, the put and call spreads'
+    # p_/c_ mg, e and width, their rows in the candidates as p_row and c_row,
+    # and mg, ml, width, e, e_w, mg_w and pop.  min_credit, max_loss (as a
+    # positive amount), min_e_w and min_pop are bounds on those.  pop comes
+    # from each side's chainIndex attr (see _get_index).
+    if put_candidates is None or call_candidates is None or len(put_candidates) == 0 or len(call_candidates) == 0:
+        logging.info("get_condors, no candidates")
+        return None
+    multi = "daysToExpiration" in put_candidates.columns or "daysToExpiration" in call_candidates.columns
+    p_days = _get_days(put_candidates)
+    c_days = _get_days(call_candidates)
+    index_p = _get_index(put_candidates, "PUT", p_days)
+    index_c = _get_index(call_candidates, "CALL", c_days)
+
+    columns = []
+    for prefix in ("ps_", "pb_", "cs_", "cb_"):
+        for name in CONDOR_LEG_COLUMNS:
+            columns.append(prefix + name)
+    columns += ["p_row", "c_row", "p_mg", "c_mg", "p_e", "c_e", "p_width", "c_width", "mg", "ml", "width", "e",
+                "e_w", "mg_w", "pop"]
+    if multi:
+        columns.append("daysToExpiration")
+
+    parts = []
+    with metrics.timer("condors"):
+        for day in sorted(set(p_days) & set(c_days)):
+            p_rows = np.flatnonzero(p_days == day)
+            c_rows = np.flatnonzero(c_days == day)
+            puts = _get_side(put_candidates.iloc[p_rows])
+            calls = _get_side(call_candidates.iloc[c_rows])
+            heap = _join(puts, calls, index_p, index_c, day, top_k, min_credit, max_loss, min_e_w, min_pop)
+            if not heap:
+                continue
+            heap.sort(reverse=True)
+            p = p_rows[np.array([-key[1] for key, pop in heap], dtype=np.intp)]
+            c = c_rows[np.array([-key[2] for key, pop in heap], dtype=np.intp)]
+            data = {}
+            for side, prefix, rows in ((put_candidates, "p", p), (call_candidates, "c", c)):
+                for leg in ("s_", "b_"):
+                    for name in CONDOR_LEG_COLUMNS:
+                        data[prefix + leg + name] = side[leg + name].to_numpy()[rows]
+                data[prefix + "_row"] = side.index.to_numpy()[rows]
+                for name in ("mg", "e", "width"):
+                    data[prefix + "_" + name] = side[name].to_numpy(dtype=float)[rows]
+            data["mg"] = data["p_mg"] + data["c_mg"]
+            data["width"] = np.maximum(data["p_width"], data["c_width"])
+            data["ml"] = -(data["width"] - data["mg"])
+            data["e"] = data["p_e"] + data["c_e"]
+            data["e_w"] = 100 * data["e"] / data["width"]
+            data["mg_w"] = 100 * data["mg"] / data["width"]
+            data["pop"] = np.array([pop for key, pop in heap], dtype=float)
+            if multi:
+                data["daysToExpiration"] = np.full(len(heap), day)
+            parts.append(data)
+    if not parts:
+        return pd.DataFrame([], columns=columns)
+    data = {}
+    for name in columns:
+        data[name] = np.concatenate([part[name] for part in parts])
+    condors = pd.DataFrame(data, columns=columns)
+    for k in ("symbol", "underlyingPrice", "runDate"):
+        if k in put_candidates.attrs:
+            condors.attrs[k] = put_candidates.attrs[k]
+    return condors
+
+
+def get_symbol_condors(symbol, run_date=None, daysToExpiration="all", top_k=CONDOR_TOP_K, min_credit=None,
+                       max_loss=None, min_e_w=None, min_pop=None, filters=None):
+    # get_condors for a symbol's chain, from every put and call spread
+    # get_candidates finds (with filters) for the expirations
+    sides = {}
+    for putCall in ("PUT", "CALL"):
+        df = get_dataframe(symbol, putCall=putCall, run_date=run_date)
+        if df is None or len(df) == 0:
+            logging.warning(f"get_symbol_condors, no {putCall} data for {symbol}")
+            return None
+        sides[putCall] = get_candidates(df, putCall=putCall, daysToExpiration=daysToExpiration, filters=filters)
+    return get_condors(sides["PUT"], sides["CALL"], top_k=top_k, min_credit=min_credit, max_loss=max_loss,
+                       min_e_w=min_e_w, min_pop=min_pop)
@@ -0,0 +1,110 @@
+import weakref
+import numpy as np
+import pandas as pd
+
+# lazy derived columns for contracts frames
+#
+# Columns computed from a contracts frame's own columns are registered here
+# rather than added to every frame get_dataframe builds.  Each is computed
+# the first time it's read, on whatever rows the frame holds (usually one
+# expiration, not the whole chain), and cached on that frame.
+#
+#   df = get_dataframe("TSLA", putCall="PUT", daysToExpiration=45)
+#   df.derived["meg"]  # or df.derived.meg, a Series on df's index
+#   df.derived.add("pom", "megu")  # as real columns, e.g. for to_csv
+#   register_derived("theta_mark", lambda df: df["theta"] / df["mark"])
+#
+# The cache belongs to the frame object, so a filtered copy computes its own
+# values.  Changing a column a derived value depends on doesn't reset it -
+# call df.derived.clear().
+
+# name -> func(df) returning an array or Series of len(df)
+DERIVED_COLUMNS = {}
+
+# id(df) -> (weak reference to df, {name: Series}).  pandas builds a new
+# accessor object on each df.derived, and attrs are copied to every slice
+# of a frame, so computed values are kept here until the frame goes.
+_caches = {}
+
+
+def register_derived(name, func):
+    # make func(df) available as df.derived[name], replacing any existing one
+    if not callable(func):
+        raise ValueError(f"derived column {name} needs a function of the frame, got: {func}")
+    DERIVED_COLUMNS[name] = func
+
+def get_derived_names():
+    return list(DERIVED_COLUMNS.keys())
+
+
+def _get_cache(df):
+    key = id(df)
+    entry = _caches.get(key)
+    if entry is None or entry[0]() is not df:
+        ref = weakref.ref(df, lambda ref, key=key: _caches.pop(key, None))
+        entry = (ref, {})
+        _caches[key] = entry
+    return entry[1]
+
+
+def _abs_delta(df):
+    return np.abs(df["delta"].to_numpy(dtype=float))
+
+def _meg(df):
+    # last * prob out of money
+    return df["last"].to_numpy(dtype=float) * (1.0 - _abs_delta(df))
+
+def _megu(df):
+    return _meg(df) / df.attrs["underlyingPrice"]
+
+def _pom(df):
+    # prob out of money = 1.0 - delta
+    return 1.0 - _abs_delta(df)
+
+register_derived("meg", _meg)
+register_derived("megu", _megu)
+register_derived("pom", _pom)
+
+
+@pd.api.extensions.register_dataframe_accessor("derived")
+class DerivedAccessor:
+    def __init__(self, df):
+        self._df = df
+        self._cache = _get_cache(df)
+
+    def __getitem__(self, name):
+        df = self._df
+        if name in df.columns:
+            # already added as a column
+            return df[name]
+        if name not in self._cache:
+            func = DERIVED_COLUMNS.get(name)
+            if func is None:
+                raise KeyError(f"unknown derived column: {name}, expected one of {get_derived_names()}")
+            values = np.asarray(func(df))
+            self._cache[name] = pd.Series(values, index=df.index, name=name)
+        return self._cache[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError as e:
+            raise AttributeError(str(e))
+
+    def __contains__(self, name):
+        return name in DERIVED_COLUMNS or name in self._df.columns
+
+    def add(self, *names):
+        # add names (default all registered) to the frame as columns
+        if not names:
+            names = get_derived_names()
+        for name in names:
+            if name not in self._df.columns:
+                self._df[name] = self[name].to_numpy()
+        return self._df
+
+    def clear(self):
+        _caches.pop(id(self._df), None)
+        self._cache = _get_cache(self._df)
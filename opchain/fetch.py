@@ -0,0 +1,213 @@
+import os
+import time
+import random
+import shutil
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as ReadError
+from .opchain import CHAINS_URL
+from .opchain import get_today
+from .opchain import get_chains_path
+from .opchain import get_chain_params
+from .opchain import get_auth_token
+from .opchain import clear_chain_cache
+from .stream import get_chain_values, READ_SIZE
+
+REQUESTS_PER_MINUTE = 120  # td ameritrade quota
+FETCH_WORKERS = 8
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5   # seconds, doubled for each retry
+BACKOFF_MAX = 30.0
+REQUEST_TIMEOUT = 30.0
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    # thread safe token bucket - acquire() blocks until a request is allowed
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate  # tokens per second
+        if capacity is None:
+            capacity = max(1.0, rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        # take a token if there is one, else return the seconds to wait for one
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return 0.0
+            return (1.0 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0.0:
+                return
+            self.sleep(wait)
+
+
+def get_session(pool_size=FETCH_WORKERS):
+    # shared session so connections to the api are reused across requests
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _get_backoff(attempt, rsp=None):
+    # seconds to wait before retry number attempt (0 based)
+    if rsp is not None and "Retry-After" in rsp.headers:
+        try:
+            return min(BACKOFF_MAX, float(rsp.headers["Retry-After"]))
+        except ValueError:
+            pass
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+    # jitter so retrying workers don't all come back at once
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _save_response(rsp, filepath):
+    # copy the response body to filepath, returns the chain's top level
+    # values (its expiration maps aren't decoded until it's loaded).  Raises
+    # ValueError if it doesn't start like a chain, and the file is only
+    # replaced by one that isn't a FAILED status.
+    rsp.raw.decode_content = True
+    tmppath = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmppath, "wb") as f:
+            shutil.copyfileobj(rsp.raw, f, READ_SIZE)
+        with open(tmppath, "rb") as f:
+            data = get_chain_values(f)
+        if data.get("status") != "FAILED":
+            os.replace(tmppath, filepath)
+    finally:
+        if os.path.isfile(tmppath):
+            os.remove(tmppath)
+    return data
+
+
+def fetch_chains(symbol, session=None, token=None, limiter=None, url=CHAINS_URL,
+                 retries=MAX_RETRIES, timeout=REQUEST_TIMEOUT, sleep=time.sleep, filepath=None):
+    # request one chain with retries, returns (data, status) - data is None
+    # on failure and status is a dict describing what happened.  With
+    # filepath the chain is streamed to that file rather than decoded, and
+    # data only has its top level values.
+    if session is None:
+        session = get_session(pool_size=1)
+    if token is None:
+        token = get_auth_token()
+    headers = {"Authorization": "Bearer " + token}
+    params = get_chain_params(symbol)
+    status = {"symbol": symbol, "status": "failed", "attempts": 0, "status_code": None, "error": None}
+    start = time.time()
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        status["attempts"] += 1
+        rsp = None
+        try:
+            rsp = session.get(url, params=params, headers=headers, timeout=timeout, stream=filepath is not None)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            status["error"] = f"{type(e).__name__}: {e}"
+            logging.warning(f"fetch_chains {symbol}, attempt {attempt+1}: {status['error']}")
+        except requests.RequestException as e:
+            status["error"] = f"{type(e).__name__}: {e}"
+            break
+        else:
+            # closed on every path, read or not, so the connection goes back to the pool
+            with rsp:
+                status["status_code"] = rsp.status_code
+                if rsp.status_code == 200:
+                    try:
+                        if filepath is None:
+                            data = rsp.json()
+                        else:
+                            data = _save_response(rsp, filepath)
+                    except ValueError as e:
+                        status["error"] = f"bad json: {e}"
+                        data = None
+                    except (OSError, ReadError, requests.RequestException) as e:
+                        # the connection went while reading the body
+                        status["error"] = f"{type(e).__name__}: {e}"
+                        data = None
+                    if data is not None and data.get("status") == "FAILED":
+                        # the api doesn't have this symbol, no point retrying
+                        status["error"] = "got FAILED status"
+                        break
+                    if data is not None:
+                        status["status"] = "ok"
+                        status["error"] = None
+                        status["elapsed"] = time.time() - start
+                        return (data, status)
+                elif rsp.status_code not in RETRY_STATUS:
+                    status["error"] = f"got bad status code: {rsp.status_code}"
+                    break
+                else:
+                    status["error"] = f"got status code: {rsp.status_code}"
+                    logging.warning(f"fetch_chains {symbol}, attempt {attempt+1}: {status['error']}")
+        if attempt < retries:
+            sleep(_get_backoff(attempt, rsp=rsp))
+    logging.error(f"fetch_chains {symbol} failed: {status['error']}")
+    status["elapsed"] = time.time() - start
+    return (None, status)
+
+
+def fetch_chain_file(symbol, run_date, session=None, token=None, limiter=None, url=CHAINS_URL,
+                     retries=MAX_RETRIES, reload=False):
+    # fetch_chains() saved to the data dir like get_chains, unless it's
+    # already there.  Returns the status dict.
+    filepath = get_chains_path(symbol, run_date)
+    if not reload and os.path.isfile(filepath):
+        return {"symbol": symbol, "status": "cached", "attempts": 0, "status_code": None, "error": None}
+    if not os.path.isdir("data"):
+        # nowhere to save it, as with save_chains
+        data, status = fetch_chains(symbol, session=session, token=token, limiter=limiter, url=url,
+                                    retries=retries)
+        return status
+    try:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    except OSError as e:
+        return {"symbol": symbol, "status": "failed", "attempts": 0, "status_code": None,
+                "error": f"unable to save {filepath}: {e}"}
+    # streamed straight to the file, it's parsed when it's loaded
+    data, status = fetch_chains(symbol, session=session, token=token, limiter=limiter, url=url, retries=retries,
+                                filepath=filepath)
+    if data is not None:
+        clear_chain_cache(symbol, run_date)
+    return status
+
+
+def fetch_many(symbols, run_date=None, workers=FETCH_WORKERS, requests_per_minute=REQUESTS_PER_MINUTE,
+               retries=MAX_RETRIES, reload=False, url=CHAINS_URL, token=None, session=None):
+    # download chains for symbols concurrently and save them to the data dir
+    # like get_chains.  Returns a status dict for each symbol, in order.
+    if run_date is None:
+        run_date = get_today()
+    if token is None:
+        token = get_auth_token()
+    if session is None:
+        session = get_session(pool_size=workers)
+    limiter = TokenBucket(requests_per_minute / 60.0)
+
+    def fetch_one(symbol):
+        return fetch_chain_file(symbol, run_date, session=session, token=token, limiter=limiter, url=url,
+                                retries=retries, reload=reload)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        statuses = list(executor.map(fetch_one, symbols))
+    return statuses
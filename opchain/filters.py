@@ -0,0 +1,71 @@
+import operator
+import numpy as np
+
+# declarative filters - a list of (column, op, value) tuples, e.g.
+#
+#   [("days_exp", "<=", 80), ("mg", ">=", 0.5), ("e_w", ">", -0.5)]
+#
+# A row passes if it passes every filter.  Comparisons with NaN fail, the
+# same as filtering a frame with df[df.col > value].  "in" takes a list (or
+# set) of allowed values.
+
+def _isin(values, allowed):
+    values = np.asarray(values)
+    if values.dtype == object:
+        # strings - a set lookup each is much quicker than np.isin's sort
+        if not isinstance(allowed, (set, frozenset)):
+            allowed = set(allowed)
+        return np.fromiter((v in allowed for v in values), dtype=bool, count=len(values))
+    return np.isin(values, list(allowed))
+
+
+OPS = {">": operator.gt,
+       ">=": operator.ge,
+       "<": operator.lt,
+       "<=": operator.le,
+       "==": operator.eq,
+       "!=": operator.ne,
+       "in": _isin}
+
+DAY_COLUMNS = ("daysToExpiration", "days_exp")
+
+
+def check_filters(filters):
+    # raises ValueError for anything that isn't a (column, op, value) tuple
+    if filters is None:
+        return []
+    filters = list(filters)
+    for f in filters:
+        if len(f) != 3:
+            raise ValueError(f"expected (column, op, value) filter, got: {f}")
+        if f[1] not in OPS:
+            raise ValueError(f"unknown filter op: {f[1]}, expected one of {list(OPS.keys())}")
+    return filters
+
+
+def split_filters(filters, columns):
+    # (filters on one of columns, the rest)
+    matched = []
+    rest = []
+    for f in filters:
+        if f[0] in columns:
+            matched.append(f)
+        else:
+            rest.append(f)
+    return (matched, rest)
+
+
+def get_mask(values, filters, n):
+    # values is a dict (or frame) of column -> array of length n
+    mask = np.ones(n, dtype=bool)
+    for column, op, value in filters:
+        mask &= np.asarray(OPS[op](values[column], value), dtype=bool)
+    return mask
+
+
+def passes(value, filters):
+    # True if a single value passes every filter, whatever their column
+    for column, op, limit in filters:
+        if not bool(np.all(OPS[op](np.asarray([value]), limit))):
+            return False
+    return True
@@ -0,0 +1,284 @@
+import logging
+import numpy as np
+import pandas as pd
+from .filters import check_filters, split_filters
+from .opchain import get_candidates
+from .opchain import _get_legs
+from .opchain import _get_pairs
+from .opchain import _get_leg_columns
+from .opchain import _check_index
+from .opchain import LEG_COLUMNS
+from .opchain import SPREAD_COLUMNS
+from .opchain import USE_PRICE
+from .opchain import PSR_PS_DELTA_RANGE, PSR_PB_DELTA_RANGE, CSR_CS_DELTA_RANGE, CSR_CB_DELTA_RANGE
+from . import metrics
+
+# incremental get_candidates between two snapshots of the same chain
+#
+# Options are matched by description.  A pair is recomputed if either leg
+# is new or had any of LEG_COLUMNS change, or if its break even strike falls
+# in a bracket of the strike/delta curve that changed (a strike added,
+# removed or with a new delta).  Every other pair keeps its row from the
+# previous candidates.  The result is the same table get_candidates would
+# return for the new contracts.
+
+# candidate columns compared for the change set
+VALUE_COLUMNS = ("s_last", "b_last", "s_mark", "b_mark", "s_delta", "b_delta", "s_totalVolume", "b_totalVolume",
+                 "e", "e_w", "mg", "ml", "width", "eml", "dme", "dme_w", "mg_w", "pop")
+
+
+def _same(a, b):
+    # elementwise equality, with NaN equal to NaN
+    same = np.asarray(a == b, dtype=bool)
+    if a.dtype.kind == "f" or b.dtype.kind == "f":
+        a = a.astype(float)
+        b = b.astype(float)
+        same |= np.isnan(a) & np.isnan(b)
+    return same
+
+
+def _get_side(contracts, putCall, daysToExpiration):
+    # (column arrays, positions of the expiration's options, chain index)
+    cols = {}
+    for name in set(LEG_COLUMNS) | {USE_PRICE}:
+        cols[name] = contracts[name].to_numpy()
+    side = (contracts['putCall'] == putCall).to_numpy()
+    pos = np.flatnonzero(side & (contracts['daysToExpiration'].to_numpy() == daysToExpiration))
+    index = _check_index(contracts.attrs.get("chainIndex"), contracts, cols, putCall, daysToExpiration, pos)
+    return (cols, pos, index)
+
+
+def _get_columns(candidates):
+    # column arrays of a candidates frame
+    values = {}
+    for name in candidates.columns:
+        values[name] = candidates[name].to_numpy()
+    return values
+
+
+def _diff_rows(old, new):
+    # (added, removed, updated) lists of (s_description, b_description)
+    # keys, old and new are dicts of column arrays
+    old_keys = list(zip(old["s_description"], old["b_description"]))
+    keys = list(zip(new["s_description"], new["b_description"]))
+    old_rows = dict(zip(old_keys, range(len(old_keys))))
+    rows = dict(zip(keys, range(len(keys))))
+    added = [key for key in keys if key not in old_rows]
+    removed = [key for key in old_keys if key not in rows]
+    common = [key for key in keys if key in old_rows]
+    updated = []
+    if common:
+        i = np.array([rows[key] for key in common])
+        j = np.array([old_rows[key] for key in common])
+        same = np.ones(len(common), dtype=bool)
+        for name in VALUE_COLUMNS:
+            if name in new and name in old:
+                same &= _same(new[name][i], old[name][j])
+        updated = [common[k] for k in np.flatnonzero(~same)]
+    return (added, removed, updated)
+
+
+def _get_changes(old, new, options, recomputed, full):
+    # old and new are the rows that were dropped and recomputed, None if none were
+    if old is None:
+        added, removed, updated = ([], [], [])
+    else:
+        added, removed, updated = _diff_rows(old, new)
+    changes = {}
+    changes["options"] = options
+    changes["added"] = added
+    changes["removed"] = removed
+    changes["updated"] = updated
+    changes["recomputed"] = recomputed
+    changes["full"] = full
+    return changes
+
+
+def _set_attrs(candidates, contracts, putCall, daysToExpiration):
+    # a (shallow) copy of candidates with the attrs get_candidates sets
+    candidates = candidates.copy(deep=False)
+    candidates.attrs = {}
+    for k in contracts.attrs:
+        candidates.attrs[k] = contracts.attrs[k]
+    candidates.attrs['daysToExpiration'] = daysToExpiration
+    candidates.attrs["putCall"] = putCall
+    return candidates
+
+
+def update_candidates(prev_contracts, prev_candidates, contracts, sell_range=None, buy_range=None, rank_by="e_w",
+                      filters=None):
+    # candidates for contracts given the candidates get_candidates returned
+    # for prev_contracts (one expiration, no top_k, the same ranges, rank_by
+    # and filters).  Returns (candidates, changes) where changes is a dict of:
+    #   options - {"added", "changed", "removed"} option descriptions
+    #   added, removed, updated - (s_description, b_description) pairs
+    #   recomputed - number of rows recomputed
+    #   full - True if everything had to be recomputed
+    putCall = prev_candidates.attrs.get("putCall")
+    daysToExpiration = prev_candidates.attrs.get("daysToExpiration")
+    if putCall not in ("PUT", "CALL") or not np.isscalar(daysToExpiration):
+        raise ValueError("prev_candidates should be from get_candidates for one expiration")
+    filters = check_filters(filters)
+    pair_filters, leg_filters = split_filters(filters, SPREAD_COLUMNS)
+    for column, op, value in leg_filters:
+        if not column.startswith(("s_", "b_")) or column[2:] not in LEG_COLUMNS:
+            # a pair filtered out on a derived value isn't in prev_candidates,
+            # so there'd be no way to tell if a changed bracket brings it back
+            raise ValueError(f"update_candidates can only filter on leg and {SPREAD_COLUMNS} columns, not: {column}")
+    if putCall == "PUT":
+        if sell_range is None:
+            sell_range = PSR_PS_DELTA_RANGE
+        if buy_range is None:
+            buy_range = PSR_PB_DELTA_RANGE
+    else:
+        if sell_range is None:
+            sell_range = CSR_CS_DELTA_RANGE
+        if buy_range is None:
+            buy_range = CSR_CB_DELTA_RANGE
+
+    def full_update(options):
+        candidates = get_candidates(contracts, putCall=putCall, sell_range=sell_range, buy_range=buy_range,
+                                    daysToExpiration=daysToExpiration, rank_by=rank_by, filters=filters)
+        if candidates is None:
+            candidates = _set_attrs(prev_candidates.iloc[0:0], contracts, putCall, daysToExpiration)
+        old = _get_columns(prev_candidates)
+        return (candidates, _get_changes(old, _get_columns(candidates), options, len(candidates), True))
+
+    cols, pos, index = _get_side(contracts, putCall, daysToExpiration)
+    prev_cols, prev_pos, prev_index = _get_side(prev_contracts, putCall, daysToExpiration)
+    if len(pos) == 0 or len(prev_pos) == 0:
+        logging.info(f"update_candidates, no {putCall} options for daysToExpiration: {daysToExpiration}")
+        return full_update(None)
+
+    # match options by description
+    desc = cols["description"][pos]
+    prev_desc = prev_cols["description"][prev_pos]
+    desc_index = pd.Index(desc)
+    prev_desc_index = pd.Index(prev_desc)
+    if not desc_index.is_unique or not prev_desc_index.is_unique:
+        logging.info("update_candidates, descriptions aren't unique, recomputing everything")
+        return full_update(None)
+    j = prev_desc_index.get_indexer(desc)
+    matched = j >= 0
+    i = np.flatnonzero(matched)
+    j = j[i]
+    same = np.ones(len(i), dtype=bool)
+    for name in set(LEG_COLUMNS) | {USE_PRICE}:
+        same &= _same(cols[name][pos[i]], prev_cols[name][prev_pos[j]])
+    dirty = ~matched
+    dirty[i[~same]] = True
+    options = {}
+    options["added"] = list(desc[~matched])
+    options["changed"] = list(desc[i[~same]])
+    options["removed"] = list(prev_desc[desc_index.get_indexer(prev_desc) < 0])
+    # compact candidates (see set_compact_dtypes) have contracts row labels
+    # that have to be looked up again even if nothing changed
+    compact = "s_row" in prev_candidates.columns
+    if not dirty.any() and not options["removed"] and not compact:
+        logging.info("update_candidates, no changes")
+        return (_set_attrs(prev_candidates, contracts, putCall, daysToExpiration),
+                _get_changes(None, None, options, 0, False))
+
+    # strikes of the interpolation curve that changed
+    strike = index.strikes(putCall, daysToExpiration)
+    prev_strike = prev_index.strikes(putCall, daysToExpiration)
+    if len(strike) == 0 or len(prev_strike) == 0 or strike[0] != prev_strike[0] or strike[-1] != prev_strike[-1]:
+        # the curve's range moved, so pairs that had no bracket may have one now
+        logging.info("update_candidates, strike range changed, recomputing everything")
+        return full_update(options)
+    common, k, prev_k = np.intersect1d(strike, prev_strike, assume_unique=True, return_indices=True)
+    delta_same = _same(index.deltas(putCall, daysToExpiration)[k], prev_index.deltas(putCall, daysToExpiration)[prev_k])
+    dirty_strikes = np.concatenate([np.setxor1d(strike, prev_strike, assume_unique=True), common[~delta_same]])
+    dirty_strikes.sort()
+
+    legs = _get_legs(contracts, cols, pos, index, putCall, daysToExpiration, buy_range, sell_range,
+                     leg_filters=leg_filters)
+    if legs is None:
+        return full_update(options)
+    buy_pos, sell_pos = legs
+    # dirty flags by position in contracts, then for each leg
+    dirty_at = np.zeros(len(cols["description"]), dtype=bool)
+    dirty_at[pos[dirty]] = True
+    b_dirty = dirty_at[buy_pos]
+    s_dirty = dirty_at[sell_pos]
+
+    # previous pairs with both legs unchanged, and whether their bracket changed
+    columns = list(prev_candidates.columns)
+    b_leg = pd.Index(cols["description"][buy_pos])
+    s_leg = pd.Index(cols["description"][sell_pos])
+    b_idx = b_leg.get_indexer(prev_candidates["b_description"])
+    s_idx = s_leg.get_indexer(prev_candidates["s_description"])
+    keep = (b_idx >= 0) & (s_idx >= 0)
+    keep[keep] = ~b_dirty[b_idx[keep]] & ~s_dirty[s_idx[keep]]
+    mg = prev_candidates["mg"].to_numpy(dtype=float)
+    s_strike = prev_candidates["s_strikePrice"].to_numpy(dtype=float)
+    if putCall == "CALL":
+        be_strike = s_strike + mg
+    else:
+        be_strike = s_strike - mg
+    # the old bracket is [x1, x2] around be_strike - it changed if a dirty strike is in it
+    at = np.searchsorted(prev_strike, be_strike, side="left")
+    x2 = prev_strike[np.minimum(at, len(prev_strike) - 1)]
+    x1 = np.where(x2 == be_strike, x2, prev_strike[np.maximum(at - 1, 0)])
+    moved = np.searchsorted(dirty_strikes, x1, side="left") < np.searchsorted(dirty_strikes, x2, side="right")
+    redo = keep & moved
+    keep &= ~moved
+
+    # recompute pairs with a dirty leg, and the clean pairs whose bracket moved
+    parts = []
+    if b_dirty.any():
+        parts.append(_get_pairs(cols, buy_pos[b_dirty], sell_pos, putCall=putCall, index=index,
+                                daysToExpiration=daysToExpiration, filters=pair_filters))
+    if s_dirty.any():
+        parts.append(_get_pairs(cols, buy_pos[~b_dirty], sell_pos[s_dirty], putCall=putCall, index=index,
+                                daysToExpiration=daysToExpiration, filters=pair_filters))
+    if redo.any():
+        n = int(redo.sum())
+        parts.append(_get_pairs(cols, buy_pos[b_idx[redo]], sell_pos[s_idx[redo]], putCall=putCall, index=index,
+                                daysToExpiration=daysToExpiration, filters=pair_filters,
+                                pair_idx=(np.arange(n), np.arange(n))))
+    new = {}
+    for name in columns:
+        new[name] = []
+        for part in parts:
+            if name in part:
+                new[name].append(part[name])
+            else:
+                new[name].append(np.full(len(part["e"]), np.nan))
+        new[name] = np.concatenate(new[name]) if parts else np.zeros(0)
+    recomputed = len(new["e"])
+    metrics.count("pairs_kept", recomputed)
+    if recomputed == 0 and keep.all() and not compact:
+        logging.info("update_candidates, no candidates changed")
+        return (_set_attrs(prev_candidates, contracts, putCall, daysToExpiration),
+                _get_changes(None, None, options, 0, False))
+
+    # new rows plus the kept rows, put back in pair order so the final sort
+    # gives the same table as get_candidates
+    b_order = np.concatenate([b_idx[keep], b_leg.get_indexer(new["b_description"])])
+    s_order = np.concatenate([s_idx[keep], s_leg.get_indexer(new["s_description"])])
+    order = np.lexsort((s_order, b_order))
+    prev = _get_columns(prev_candidates)
+    if len(order) == 0:
+        candidates = pd.DataFrame([], columns=columns)
+    else:
+        data = {}
+        for name in columns:
+            if recomputed:
+                data[name] = np.concatenate([prev[name][keep], new[name]])[order]
+            else:
+                data[name] = prev[name][keep][order]
+        if compact:
+            s_pos = np.concatenate([sell_pos[s_idx[keep]]] + [part["s_pos"] for part in parts])[order]
+            b_pos = np.concatenate([buy_pos[b_idx[keep]]] + [part["b_pos"] for part in parts])[order]
+            data.update(_get_leg_columns(contracts, putCall, s_pos, b_pos))
+        candidates = pd.DataFrame(data, columns=columns)
+    candidates = _set_attrs(candidates, contracts, putCall, daysToExpiration)
+    with metrics.timer("sort"):
+        candidates = candidates.sort_values(by=rank_by, ascending=False)
+    logging.info(f"update_candidates, recomputed {recomputed} pairs, kept {int(keep.sum())}")
+    # kept rows are the same in both, so only the dropped ones need comparing
+    old = {}
+    for name in prev:
+        old[name] = prev[name][~keep]
+    return (candidates, _get_changes(old, new, options, recomputed, False))
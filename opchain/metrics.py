@@ -0,0 +1,184 @@
+import time
+import threading
+
+# per stage wall time and call counts, plus event counters, for the scan
+#
+# Off by default.  When disabled timer() hands back a shared no-op context
+# manager, start() returns None and count() returns straight away, so the
+# instrumented code only pays for a function call and a flag check.
+#
+#   metrics.enable()
+#   with metrics.timer("parse"):
+#       ...
+#   t = metrics.start()
+#   ...
+#   metrics.stop("pairs", t)
+#   metrics.count("pairs_kept", n)
+#   metrics.snapshot() / metrics.to_prometheus()
+#
+# Stages don't overlap: time spent in a stage timed inside a timer() (say
+# mmm while a streamed chain is loaded) is counted under the inner stage
+# only, so the stages add up to the time spent in them.
+
+STAGES = ("load", "parse", "mmm", "filter", "pairs", "derive", "sort", "write")
+COUNTERS = ("contracts_parsed", "deltas_skipped", "pairs_evaluated", "pairs_kept")
+
+_enabled = False
+_lock = threading.Lock()
+_timings = {}  # stage -> [calls, seconds]
+_counters = {}  # name -> count
+_local = threading.local()  # .timers - this thread's open timer()s, innermost last
+
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+def disable():
+    enable(False)
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+
+
+def add_time(stage, seconds, calls=1):
+    with _lock:
+        timing = _timings.get(stage)
+        if timing is None:
+            _timings[stage] = [calls, seconds]
+        else:
+            timing[0] += calls
+            timing[1] += seconds
+
+def count(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def start():
+    # pair with stop() to time part of a function
+    if not _enabled:
+        return None
+    return time.perf_counter()
+
+def stop(stage, started, calls=1):
+    # calls=0 adds the time to a stage already counted by an earlier stop()
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    _exclude(seconds)
+    add_time(stage, seconds, calls=calls)
+
+def _exclude(seconds):
+    # take seconds counted under an inner stage out of the enclosing timer()'s
+    timers = getattr(_local, "timers", None)
+    if timers:
+        timers[-1].inner += seconds
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_timer = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, stage):
+        self.stage = stage
+        self.started = None
+        self.inner = 0.0
+
+    def __enter__(self):
+        if not hasattr(_local, "timers"):
+            _local.timers = []
+        _local.timers.append(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.started
+        _local.timers.pop()
+        _exclude(seconds)
+        add_time(self.stage, seconds - self.inner)
+        return False
+
+
+def timer(stage):
+    if not _enabled:
+        return _null_timer
+    return _Timer(stage)
+
+
+def snapshot():
+    # {"stages": {stage: {"calls": n, "seconds": s}}, "counters": {name: n}}
+    with _lock:
+        stages = {}
+        for stage in _timings:
+            calls, seconds = _timings[stage]
+            stages[stage] = {"calls": calls, "seconds": seconds}
+        counters = dict(_counters)
+    return {"stages": stages, "counters": counters}
+
+def merge(snap):
+    # add a snapshot from another process (see scan.scan_symbols)
+    for stage in snap["stages"]:
+        timing = snap["stages"][stage]
+        add_time(stage, timing["seconds"], calls=timing["calls"])
+    with _lock:
+        for name in snap["counters"]:
+            _counters[name] = _counters.get(name, 0) + snap["counters"][name]
+
+
+def _get_order(names, known):
+    # known names first in their usual order, then anything else sorted
+    ordered = [name for name in known if name in names]
+    others = [name for name in names if name not in known]
+    others.sort()
+    return ordered + others
+
+def to_prometheus(snap=None, prefix="opchain"):
+    # prometheus text exposition format
+    if snap is None:
+        snap = snapshot()
+    lines = []
+    stages = _get_order(snap["stages"], STAGES)
+    lines.append(f"# HELP {prefix}_stage_seconds_total Wall time spent in each stage.")
+    lines.append(f"# TYPE {prefix}_stage_seconds_total counter")
+    for stage in stages:
+        lines.append(f'{prefix}_stage_seconds_total{{stage="{stage}"}} {snap["stages"][stage]["seconds"]:.6f}')
+    lines.append(f"# HELP {prefix}_stage_calls_total Number of times each stage ran.")
+    lines.append(f"# TYPE {prefix}_stage_calls_total counter")
+    for stage in stages:
+        lines.append(f'{prefix}_stage_calls_total{{stage="{stage}"}} {snap["stages"][stage]["calls"]}')
+    for name in _get_order(snap["counters"], COUNTERS):
+        lines.append(f"# TYPE {prefix}_{name}_total counter")
+        lines.append(f"{prefix}_{name}_total {snap['counters'][name]}")
+    return "\n".join(lines) + "\n"
+
+def format_breakdown(snap=None):
+    # human readable table of the stages and counters
+    if snap is None:
+        snap = snapshot()
+    stages = _get_order(snap["stages"], STAGES)
+    total = sum(snap["stages"][stage]["seconds"] for stage in stages)
+    lines = [f"{'stage':10} {'calls':>8} {'seconds':>10} {'ms/call':>10} {'%':>6}"]
+    for stage in stages:
+        calls = snap["stages"][stage]["calls"]
+        seconds = snap["stages"][stage]["seconds"]
+        per_call = 1000 * seconds / calls if calls else 0.0
+        pct = 100 * seconds / total if total else 0.0
+        lines.append(f"{stage:10} {calls:8d} {seconds:10.3f} {per_call:10.3f} {pct:6.1f}")
+    for name in _get_order(snap["counters"], COUNTERS):
+        lines.append(f"{name:20} {snap['counters'][name]:12d}")
+    return "\n".join(lines)
@@ -4,8 +4,17 @@ import sys
 import time
 import json
 import logging
+import threading
+from collections import OrderedDict
 import requests
+import numpy as np
 import pandas as pd
+from .chainindex import ChainIndex
+from . import metrics
+from .filters import check_filters, split_filters, get_mask, passes, DAY_COLUMNS
+from .snapshot import get_snapshot_path, write_snapshot, read_snapshot
+from .stream import iter_chain, TeeReader
+from . import derived  # registers the df.derived accessor
 """
 OPTION_PROPS = ("description", "symbol", "putCall", "strikePrice", "bid", "ask", "last", "mark", "bidAskSize",
     "highPrice", "lowPrice", "openPrice", "closePrice", "totalVolume", "expirationDate", "daysToExpiration", 
@@ -26,6 +35,25 @@ OPTION_PROPS = ["description",
                 "theoreticalOptionValue", 
                 "totalVolume"]
 
+# dtype of each OPTION_PROPS column
+OPTION_DTYPES = {"description": object,
+                 "symbol": object,
+                 "expirationDate": np.int64,
+                 "daysToExpiration": np.int64,
+                 "putCall": object,
+                 "strikePrice": np.float64,
+                 "delta": np.float64,
+                 "last": np.float64,
+                 "mark": np.float64,
+                 "bidAskSize": object,
+                 "openInterest": np.int64,
+                 "theoreticalOptionValue": np.float64,
+                 "totalVolume": np.int64}
+# python types each OPTION_PROPS column takes as is (None for object
+# columns, which take anything) - anything else goes through _set_row
+PROP_TYPES = tuple(None if OPTION_DTYPES[name] is object else (float, int) if OPTION_DTYPES[name] is np.float64
+                   else (int,) for name in OPTION_PROPS)
+
 MIN_VAL = -999.0 
 DEFAULT_DAYS = 45
 CSR_CS_DELTA_RANGE = (0.05, 0.15)     #was .18 .17
@@ -34,6 +62,27 @@ PSR_PS_DELTA_RANGE = (0.05, 0.12)    #.15 .14
 PSR_PB_DELTA_RANGE = (0.009, 0.12)  
 MIN_WIDTH = 25.0
 USE_PRICE = "mark"
+CHAIN_CACHE_BYTES = 512 * 1024 * 1024  # memory cap for parsed chains
+USE_SNAPSHOTS = True  # save/load parsed chains as .npz next to the json
+STREAM_CHAINS = True  # decode chain json an expiration at a time rather than json.load
+# saved chains smaller than this are json.load'ed even with STREAM_CHAINS -
+# it's quicker, and its peak memory (a few times the file) is small there
+STREAM_MIN_BYTES = 8 * 1024 * 1024
+STREAM_CHUNK_ROWS = 4096  # rows per column chunk from iter_chain_chunks
+# meg, megu and pom are df.derived columns (see derived.py), computed when
+# read.  False adds them to every contracts frame as columns, as before.
+LAZY_DERIVED = True
+CHAINS_URL = "https://api.tdameritrade.com/v1/marketdata/chains"
+# memory optimized schema, see set_compact_dtypes()
+COMPACT_DTYPES = False
+COMPACT_FLOAT32 = False
+CATEGORY_COLUMNS = ("description", "symbol", "putCall", "bidAskSize")
+COMPACT_INTS = {"daysToExpiration": np.int16, "openInterest": np.int32, "totalVolume": np.int32}
+FLOAT32_COLUMNS = ("last", "mark", "delta", "theoreticalOptionValue", "meg", "megu", "pom")
+LEG_COLUMNS = ("description", "last", "mark", "delta", "strikePrice", "totalVolume")
+# candidate columns known before the break even interpolation
+SPREAD_COLUMNS = ("mg", "ml", "width")
+DERIVED_COLUMNS = ("putcall", "e", "e_w", "eml", "dme", "dme_w", "mg_w", "pop")
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
@@ -45,33 +94,144 @@ def get_today():
     return run_date
     
 
-def get_chains(symbol, run_date=None, dt_min=None, dt_max=None, reload=False):
-    logging.info(f"get_chains {symbol}, run_date: {run_date} reload=True")
+def _get_mtime(filepath):
+    # modification time of filepath, None if it isn't there
+    try:
+        return os.path.getmtime(filepath)
+    except OSError:
+        return None
+
+def _get_frames_nbytes(frames):
+    # memory held by a chain's frames and their attrs (the chainIndex and
+    # mmm map), counting what the sides share once
+    nbytes = 0
+    seen = set()
+    for putCall in frames:
+        df = frames[putCall]
+        nbytes += int(df.memory_usage(deep=True).sum())
+        for v in df.attrs.values():
+            if id(v) in seen:
+                continue
+            seen.add(id(v))
+            if isinstance(v, ChainIndex):
+                nbytes += v.nbytes
+            elif isinstance(v, dict):
+                nbytes += sys.getsizeof(v) + sum(sys.getsizeof(k) + sys.getsizeof(v[k]) for k in v)
+    return nbytes
+
+class _ChainCache:
+    # LRU map of (symbol, run_date) -> parsed PUT/CALL contract frames,
+    # evicting least recently used chains once max_bytes is exceeded.  Each
+    # entry keeps the mtime of the json it was parsed from, so a chain saved
+    # again since (by another process, say) is reloaded.
+    def __init__(self, max_bytes=CHAIN_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, mtime=None):
+        # the frames for key, None if they're not cached or the json's
+        # mtime is newer than the one they were parsed from
+        with self._lock:
+            if key not in self._entries:
+                return None
+            entry = self._entries[key]
+            if mtime is not None and (entry[2] is None or mtime > entry[2]):
+                logging.info(f"chain cache, {key} has been saved since it was cached")
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, frames, mtime=None):
+        nbytes = _get_frames_nbytes(frames)
+        with self._lock:
+            self._remove(key)
+            if nbytes > self.max_bytes:
+                logging.info(f"chain cache, {key} is {nbytes} bytes, not caching")
+                return
+            self._entries[key] = (frames, nbytes, mtime)
+            self.nbytes += nbytes
+            self._evict()
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def discard(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+
+    def _evict(self):
+        while self._entries and self.nbytes > self.max_bytes:
+            key, (frames, nbytes, mtime) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+            logging.info(f"chain cache, evicted {key}")
+
+    def __len__(self):
+        return len(self._entries)
+
+_chain_cache = _ChainCache()
+
+def set_chain_cache_size(max_bytes):
+    # set the memory cap for parsed chains, 0 disables the cache
+    _chain_cache.resize(max_bytes)
+
+def clear_chain_cache(symbol=None, run_date=None):
+    # drop every cached chain, or just the one for symbol and run_date
+    if symbol is None:
+        _chain_cache.clear()
+    else:
+        if run_date is None:
+            run_date = get_today()
+        _chain_cache.discard((symbol, run_date))
+
+def set_compact_dtypes(compact=True, float32=False):
+    # compact contracts frames use categoricals for the string columns,
+    # int16/int32 for the counts and NaN for missing numbers (rather than
+    # '' in an object column), and float32 prices and greeks if float32 is
+    # set.  Candidates from them refer to their legs by contracts row
+    # (s_row, b_row) with categorical descriptions.
+    global COMPACT_DTYPES, COMPACT_FLOAT32
+    COMPACT_DTYPES = compact
+    COMPACT_FLOAT32 = float32
+    # cached frames have the old dtypes
+    _chain_cache.clear()
+
+def get_compact_dtypes():
+    # (compact, float32) as passed to set_compact_dtypes
+    return (COMPACT_DTYPES, COMPACT_FLOAT32)
+
+def get_chains_path(symbol, run_date):
+    return f"data/{symbol}/{symbol}-{run_date}.json"
+
+def get_auth_token(filepath="auth_token"):
+    # we'll need an auth token to call td ameritrade
+    with open(filepath, "r") as f:
+        token = f.read().strip()
+    return token
+
+def get_chain_params(symbol, dt_min=None, dt_max=None):
+    # query params for the td ameritrade chains request
     now = time.time()
-    logging.info(f"start time: {int(now)}")
     if dt_min is None:
         # use current time
         dt_min = datetime.fromtimestamp(now)
     if dt_max is None:
         # use current time + 1 year
-        then = time.time() + 365*24*60*60
+        then = now + 365*24*60*60
         dt_max = datetime.fromtimestamp(then)
-    if run_date is None:
-        # no date_str, use current day
-        run_date = get_today()
-        
-    filepath = f"data/{symbol}/{symbol}-{run_date}.json"
-    if not reload and os.path.isfile(filepath):
-        logging.info(f"returning data from: {filepath}")
-        with open(filepath) as json_file:
-            data = json.load(json_file)
-        return data
-
-    # we'll need an auth token to call td ameritrade     
-    with open("auth_token", "r") as f:
-        data = f.read().strip()
-    headers = {"Authorization": "Bearer " + data}
-
     params = {}
     params["symbol"] = symbol
     params["strikeCount"] = 200
@@ -80,169 +240,395 @@ def get_chains(symbol, run_date=None, dt_min=None, dt_max=None, reload=False):
     params["interval"] = 1
     params["fromDate"] = f"{dt_min.year}-{dt_min.month}-{dt_min.day}"
     params["toDate"] = f"{dt_max.year}-{dt_max.month}-{dt_max.day}"
-    logging.info(f"fromDate: {dt_min.year}-{dt_min.month}-{dt_min.day}")
-    logging.info(f"toDate: {dt_max.year}-{dt_max.month}-{dt_max.day}")
     # params["daysToExpiration"] = 45
-    req = "https://api.tdameritrade.com/v1/marketdata/chains"
-    rsp = requests.get(req, params=params, headers=headers)
+    return params
+
+def save_chains(symbol, data, filepath):
+    # save result if data dir exists
+    if os.path.isdir("data"):
+        if not os.path.isdir(f"data/{symbol}"):
+            os.makedirs(f"data/{symbol}", exist_ok=True)
+        with open(filepath, 'w') as json_file:
+            json.dump(data, json_file)
+
+def _request_chains(symbol, dt_min=None, dt_max=None, stream=False):
+    # td ameritrade chains response, None if the request failed
+    headers = {"Authorization": "Bearer " + get_auth_token()}
+    params = get_chain_params(symbol, dt_min=dt_min, dt_max=dt_max)
+    logging.info(f"fromDate: {params['fromDate']}")
+    logging.info(f"toDate: {params['toDate']}")
+    req = CHAINS_URL
+    rsp = requests.get(req, params=params, headers=headers, stream=stream)
     logging.info(f"making request to tdameritrade: {req}")
     if rsp.status_code != 200:
         logging.error(f"got bad status code: {rsp.status_code}")
         return None
+    return rsp
+
+def get_chains(symbol, run_date=None, dt_min=None, dt_max=None, reload=False):
+    logging.info(f"get_chains {symbol}, run_date: {run_date} reload=True")
+    now = time.time()
+    logging.info(f"start time: {int(now)}")
+    if run_date is None:
+        # no date_str, use current day
+        run_date = get_today()
+        
+    filepath = get_chains_path(symbol, run_date)
+    if not reload and os.path.isfile(filepath):
+        logging.info(f"returning data from: {filepath}")
+        with metrics.timer("load"):
+            with open(filepath) as json_file:
+                data = json.load(json_file)
+        return data
+
+    rsp = _request_chains(symbol, dt_min=dt_min, dt_max=dt_max)
+    if rsp is None:
+        return None
     data = rsp.json()
     if data["status"] == "FAILED":
         logging.error(f"got FAILED status: {data}")
         return None
     #logging.info(rsp_json)
 
-    # save result if data dir exists
-    if os.path.isdir("data"):
-        if not os.path.isdir(f"data/{symbol}"):
-           os.mkdir(f"data/{symbol}")
-        with open(filepath, 'w') as json_file:
-            json.dump(data, json_file)
+    save_chains(symbol, data, filepath)
         
     return data
 
-def _descIsCall(desc):
-    if desc.find("Call") > 0:
-        return True
-    else:
-        return False
-
-def _descIsPut(desc):
-    if desc.find("Put") > 0:
-        return True
-    else:
-        return False
-
 def _descIsPM(desc):
     if desc.find("(PM)") > 0:
         return True
     else:
         return False
 
-def _get_mapdata(option_map, rows, underlying=None):
+def _set_row(columns, n, option):
+    # fill row n for an option with a missing or unexpected value: '' for
+    # anything missing, and values are never cast to fit a column - an int
+    # column with a float becomes a float column and otherwise the column
+    # becomes an object one, with the values as they were in the json (see
+    # _compact_frame for turning those to numbers)
+    for i in range(len(OPTION_PROPS)):
+        name = OPTION_PROPS[i]
+        value = option.get(name, '')
+        kind = columns[i].dtype.kind
+        if kind == "i" and type(value) is float and abs(value) < 2**53:
+            if value != int(value):
+                logging.warning(f"{name} has a non integer value: {value}, keeping it as float")
+            columns[i] = columns[i].astype(np.float64)
+        elif (kind == "i" and type(value) is not int) or (kind == "f" and type(value) not in (float, int)):
+            if name in option:
+                logging.warning(f"{name} has a non numeric value: {value!r}, keeping it as object")
+            columns[i] = columns[i].astype(object)
+        try:
+            columns[i][n] = value
+        except (ValueError, TypeError, OverflowError):
+            # out of range for the column
+            logging.warning(f"{name} value out of range: {value}, keeping it as object")
+            columns[i] = columns[i].astype(object)
+            columns[i][n] = value
+
+def _get_mapdata(option_map, putCall, underlying=None):
+    # returns a dict of column name -> array for the options in a
+    # putExpDateMap or callExpDateMap, filled straight into preallocated arrays
     if underlying is None:
         msg = "underlying not supplied"
         logging.error(msg)
         raise ValueError(msg)
+    if putCall not in ("PUT", "CALL"):
+        raise ValueError("putCall should be either PUT or CALL")
+    # check the log level once rather than formatting messages per option
+    log_info = logging.getLogger().isEnabledFor(logging.INFO)
+    log_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    count = 0
+    for expDate in option_map:
+        bundle = option_map[expDate]
+        for strikePrice in bundle:
+            count += len(bundle[strikePrice])
+    columns = []
+    for propname in OPTION_PROPS:
+        columns.append(np.empty(count, dtype=OPTION_DTYPES[propname]))
+
+    n = 0
+    skipped = 0
     for expDate in option_map:
         bundle = option_map[expDate]
+        for strikePrice in bundle:
+            strike = float(strikePrice)
+            # only keep out of the money options
+            if putCall == "PUT":
+                otm = underlying > strike
+            else:
+                otm = underlying < strike
+            for option in bundle[strikePrice]:
+                delta = option["delta"]
+                if  not isinstance(delta, float) or delta == MIN_VAL:
+                    skipped += 1
+                    if log_debug:
+                        logging.debug(f"skipping delta value: {delta}")
+                    continue
+                if _descIsPM(option["description"]):
+                    if log_info:
+                        logging.info(f"skip PM option: {option['description']}")
+                    continue
+                if not otm:
+                    if log_info:
+                        logging.info(f"skip {putCall.lower()}, underlying: {underlying} strike: {strike}")
+                    continue
+
+                try:
+                    for i in range(len(OPTION_PROPS)):
+                        value = option[OPTION_PROPS[i]]
+                        # numpy would cast "NaN" or 1.5 into a typed column
+                        if PROP_TYPES[i] is not None and type(value) not in PROP_TYPES[i]:
+                            raise TypeError(OPTION_PROPS[i])
+                        columns[i][n] = value
+                except (KeyError, ValueError, TypeError, OverflowError):
+                    _set_row(columns, n, option)
+                n += 1
+
+    if log_info:
+        logging.info(f"_get_mapdata {putCall}, kept {n} of {count} options")
+    metrics.count("contracts_parsed", count)
+    metrics.count("deltas_skipped", skipped)
+    data = {}
+    for i in range(len(OPTION_PROPS)):
+        data[OPTION_PROPS[i]] = columns[i][:n]
+    return data
+
+def _new_chunk(chunk_rows):
+    # (columns, strikes, rows filled) for iter_chain_chunks
+    columns = []
+    for propname in OPTION_PROPS:
+        columns.append(np.empty(chunk_rows, dtype=OPTION_DTYPES[propname]))
+    return (columns, np.empty(chunk_rows), 0)
+
+def _take_chunk(chunk, underlying, putCall):
+    # dict of column -> array of a chunk's rows, dropping any in the money
+    # rows kept while the underlying price wasn't known
+    columns, strikes, n = chunk
+    data = {}
+    for i in range(len(OPTION_PROPS)):
+        data[OPTION_PROPS[i]] = columns[i][:n]
+    if underlying is not None:
+        if putCall == "PUT":
+            otm = underlying > strikes[:n]
+        else:
+            otm = underlying < strikes[:n]
+        if not otm.all():
+            for name in data:
+                data[name] = data[name][otm]
+    return data
+
+def iter_chain_chunks(fp, putCalls=None, days=None, chunk_rows=STREAM_CHUNK_ROWS):
+    # decode a chain payload from fp (see stream.py) and yield (putCall,
+    # columns) chunks of up to chunk_rows of the options _get_mapdata would
+    # keep, then ("meta", meta) with the top level values (underlyingPrice,
+    # volatility, status...) and the mmm map.  Only the putCalls and days
+    # asked for are decoded, and mmm only covers what was decoded (it's None
+    # unless both sides are).
+    log_info = logging.getLogger().isEnabledFor(logging.INFO)
+    log_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    meta = {}
+    underlying = None
+    chunks = {}
+    pending = []  # chunks filled before the underlying price was read
+    # strike -> first mark of each expiration, all get_mmm looks at
+    mark_maps = {"PUT": {}, "CALL": {}}
+    count = 0
+    skipped = 0
+    for event in iter_chain(fp, sides=putCalls, days=days):
+        if event[0] == "value":
+            meta[event[1]] = event[2]
+            if event[1] == "underlyingPrice":
+                underlying = event[2]
+            continue
+        putCall, expDate, bundle = event[1:]
+        mark_map = {}
+        chunk = chunks.get(putCall)
+        if chunk is None:
+            chunk = _new_chunk(chunk_rows)
+        columns, strikes, n = chunk
         for strikePrice in bundle:
             options = bundle[strikePrice]
+            mark_map[strikePrice] = [{"mark": options[0]["mark"]}] if options else []
+            strike = float(strikePrice)
+            count += len(options)
             for option in options:
-                logging.debug(f"in: {option}")
                 delta = option["delta"]
-                if  not isinstance(delta, float) or delta == MIN_VAL:
-                    logging.debug(f"skipping delta value: {delta}")
-                    continue  
-                description = option["description"]
-                #if option_symbol and option["symbol"] != option_symbol:
-                #    continue
-                #if not option_symbol:
-                #    option_symbol = optiaon["symbol"]
-                option_symbol = option["symbol"]
-                logging.info(f"description: {description}, option_symbol: {option_symbol}")
-        
-                strike = float(strikePrice)
-                if _descIsPM(description):
-                    logging.info(f"skip PM option: {description}")
+                if not isinstance(delta, float) or delta == MIN_VAL:
+                    skipped += 1
+                    if log_debug:
+                        logging.debug(f"skipping delta value: {delta}")
                     continue
-                elif _descIsPut(description):
-                    if underlying <= strike:
-                        logging.info(f"skip put, underlying: {underlying} strike: {strike}")
-                        continue
-                elif _descIsCall(description):
-                    if underlying >= strike:
-                        logging.info(f"skip call, underlying: {underlying} strike: {strike}")
+                if _descIsPM(option["description"]):
+                    if log_info:
+                        logging.info(f"skip PM option: {option['description']}")
+                    continue
+                if underlying is not None:
+                    # only keep out of the money options
+                    if putCall == "PUT":
+                        otm = underlying > strike
+                    else:
+                        otm = underlying < strike
+                    if not otm:
+                        if log_info:
+                            logging.info(f"skip {putCall.lower()}, underlying: {underlying} strike: {strike}")
                         continue
-                else:
-                    msg = f"unexpected description: {description}"
-                    logging.error(msg)
-                    raise ValueError(msg)
-                 
-                logging.debug(f"adding option: {option}")
-                row = []
-                for propname in OPTION_PROPS:
-                    if propname in option:
-                        row.append(option[propname])
+
+                try:
+                    for i in range(len(OPTION_PROPS)):
+                        value = option[OPTION_PROPS[i]]
+                        if PROP_TYPES[i] is not None and type(value) not in PROP_TYPES[i]:
+                            raise TypeError(OPTION_PROPS[i])
+                        columns[i][n] = value
+                except (KeyError, ValueError, TypeError, OverflowError):
+                    _set_row(columns, n, option)
+                strikes[n] = strike
+                n += 1
+                if n == chunk_rows:
+                    if underlying is None or pending:
+                        pending.append((putCall, (columns, strikes, n)))
                     else:
-                        row.append('')
-                rows.append(row)
+                        yield (putCall, _take_chunk((columns, strikes, n), None, putCall))
+                    columns, strikes, n = _new_chunk(chunk_rows)
+        mark_maps[putCall][expDate] = mark_map
+        chunks[putCall] = (columns, strikes, n)
 
-def get_mmm(chains, underlying=None):
+    for putCall in chunks:
+        if chunks[putCall][2] > 0:
+            pending.append((putCall, chunks[putCall]))
+    if pending and underlying is None:
+        msg = "underlying not supplied"
+        logging.error(msg)
+        raise ValueError(msg)
+    for putCall, chunk in pending:
+        yield (putCall, _take_chunk(chunk, underlying, putCall))
+    if log_info:
+        logging.info(f"iter_chain_chunks, decoded {count} options")
+    metrics.count("contracts_parsed", count)
+    metrics.count("deltas_skipped", skipped)
+    mmm_map = None
+    if underlying is not None and (putCalls is None or ("PUT" in putCalls and "CALL" in putCalls)):
+        with metrics.timer("mmm"):
+            mmm_map = get_mmm({"putExpDateMap": mark_maps["PUT"], "callExpDateMap": mark_maps["CALL"]},
+                              underlying=underlying)
+    meta["mmm"] = mmm_map
+    yield ("meta", meta)
 
-    def get_DaysFromExpDate(expDate):
+def read_chain(fp, putCalls=None, days=None, chunk_rows=STREAM_CHUNK_ROWS):
+    # (meta, {putCall: columns}) from iter_chain_chunks, columns being the
+    # dict _get_mapdata returns for each side
+    parts = {"PUT": [], "CALL": []}
+    meta = None
+    for putCall, chunk in iter_chain_chunks(fp, putCalls=putCalls, days=days, chunk_rows=chunk_rows):
+        if putCall == "meta":
+            meta = chunk
+        else:
+            parts[putCall].append(chunk)
+    sides = {}
+    for putCall in parts:
+        data = {}
+        for name in OPTION_PROPS:
+            if parts[putCall]:
+                data[name] = np.concatenate([chunk[name] for chunk in parts[putCall]])
+            else:
+                data[name] = np.empty(0, dtype=OPTION_DTYPES[name])
+        sides[putCall] = data
+    return (meta, sides)
+
+def _get_days_map(expDateMap):
+    # map of daysToExpiration -> bundle, in one pass over the expiration keys
+    days_map = {}
+    for expDate in expDateMap:
+        # key is in the form "2021-04-01:45" - expiration date:days to expiration
         fields = expDate.split(':')
         if len(fields) != 2:
             logging.error(f"get_mmm = unexpected key: {expDate}")
             return None
         daysToExpiration = int(fields[1])
-        return daysToExpiration
-
-    def get_bracket(expDateMap, daysToExpiration=None, underlying=None):
-        bundle = None
-        for expDate in expDateMap:
-            days = get_DaysFromExpDate(expDate)
-            if days == daysToExpiration:
-                bundle = expDateMap[expDate]
-                break
-        if bundle is None:
-            logging.error(f"get_mmm, couldn't find bundle for daysToExpiration: {daysToExpiration}")
-            return None
-        s1 = None
-        s2 = None
-        a1 = None
-        a2 = None
-        for bundle_key in bundle:
-            options = bundle[bundle_key]
-            #logging.debug(f"{len(options)} options, underlying: {underlying}")
-            for option in options:
-                strikePrice = float(option["strikePrice"])
-                ask = float(option['mark'])
-                if strikePrice < underlying:
-                    if s1 is None or strikePrice > s1:
-                        s1 = strikePrice
-                        a1 = ask
-                else:
-                    if s2 is None or strikePrice < s2:
-                        s2 = strikePrice
-                        a2 = ask
-        if a1 is None:
-            a1 = underlying
-        if a2 is None:
-            a2 = underlying 
-        return (a1, a2)
-
-    put_map = chains["putExpDateMap"]
-    call_map = chains["callExpDateMap"]
+        if daysToExpiration not in days_map:
+            days_map[daysToExpiration] = expDateMap[expDate]
+    return days_map
+
+def _get_bracket(bundle, underlying):
+    # marks of the options at the strikes either side of the underlying -
+    # the highest strike below it and the lowest strike at or above it
+
+    def get_mark(mask, values):
+        # mark of the first option at the smallest of values[mask]
+        while mask.any():
+            i = np.where(mask, values, np.inf).argmin()
+            options = bundle[keys[i]]
+            if options:
+                return float(options[0]["mark"])
+            mask[i] = False
+        return underlying
+
+    # bundle keys are the strike prices
+    keys = list(bundle)
+    strikes = np.fromiter(map(float, keys), dtype=float, count=len(keys))
+    below = strikes < underlying
+    a1 = get_mark(below, -strikes)
+    a2 = get_mark(~below, strikes)
+    return (a1, a2)
+
+def get_mmm(chains, underlying=None):
+    put_map = _get_days_map(chains["putExpDateMap"])
+    call_map = _get_days_map(chains["callExpDateMap"])
+    if put_map is None or call_map is None:
+        return None
     #print(f"get_mmm, underlying: {underlying}")
     mmm_map = {} # map days To Expiration to mmm
-    
-    for expDate in put_map:
-        # key is in the form "2021-04-01:45" - expiration date:days to expiration
-        # sep out days to Expiration and use tht for mmm_map
-        fields = expDate.split(':')
-        if len(fields) != 2:
-            logging.error(f"get_mmm = unexpected key: {expDate}")
-            return None
-        daysToExpiration = get_DaysFromExpDate(expDate)
-        put_bracket = get_bracket(put_map, daysToExpiration=daysToExpiration, underlying=underlying )
+
+    for daysToExpiration in put_map:
+        put_bracket = _get_bracket(put_map[daysToExpiration], underlying)
         #print(f"expDate: {expDate} got put_bracket: {put_bracket}")
-        call_bracket = get_bracket(call_map, daysToExpiration=daysToExpiration, underlying=underlying )
-        #print(f"expDate: {expDate} got call_bracket: {call_bracket}")
-        if put_bracket is  None:
-            logging.warning("couldn't determine put bracket")
-            return None
-        elif call_bracket is None:
+        if daysToExpiration not in call_map:
+            logging.error(f"get_mmm, couldn't find bundle for daysToExpiration: {daysToExpiration}")
             logging.warning("couldn't determine call bracket")
             return None
-        else:
-            mmm = 0.5 * (call_bracket[0] + call_bracket[1] + put_bracket[0] + put_bracket[1])
-            mmm_map[daysToExpiration] = mmm
+        call_bracket = _get_bracket(call_map[daysToExpiration], underlying)
+        #print(f"expDate: {expDate} got call_bracket: {call_bracket}")
+        mmm = 0.5 * (call_bracket[0] + call_bracket[1] + put_bracket[0] + put_bracket[1])
+        mmm_map[daysToExpiration] = mmm
     return mmm_map
 
+def get_mmm_frame(symbols, run_date=None):
+    # expected move (mmm) for each expiration of each symbol as a dataframe
+    # with symbol, daysToExpiration and mmm columns.  Uses the parsed chain
+    # cache or snapshot metadata where available, so contracts aren't parsed.
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    if run_date is None:
+        run_date = get_today()
+    rows = []
+    for symbol in symbols:
+        mmm_map = None
+        filepath = get_chains_path(symbol, run_date)
+        snappath = get_snapshot_path(filepath)
+        frames = _chain_cache.get((symbol, run_date), mtime=_get_mtime(filepath))
+        if frames is not None:
+            mmm_map = frames["PUT"].attrs["mmm"]
+        elif USE_SNAPSHOTS and os.path.isfile(snappath) and \
+                (not os.path.isfile(filepath) or os.path.getmtime(filepath) <= os.path.getmtime(snappath)):
+            snapshot = read_snapshot(snappath, columns=[])
+            if snapshot is not None and snapshot[0]["mmm"] is not None:
+                mmm_map = {days: mmm for days, mmm in snapshot[0]["mmm"]}
+        if mmm_map is None:
+            chains = get_chains(symbol, run_date=run_date)
+            if not chains:
+                logging.error(f"get_mmm_frame, no data found for symbol: {symbol}")
+                continue
+            with metrics.timer("mmm"):
+                mmm_map = get_mmm(chains, underlying=chains["underlyingPrice"])
+            if mmm_map is None:
+                continue
+        days = list(mmm_map.keys())
+        days.sort()
+        for day in days:
+            rows.append((symbol, day, mmm_map[day]))
+    return pd.DataFrame(rows, columns=["symbol", "daysToExpiration", "mmm"])
+
 def get_working_days(df, daysToExpiration=DEFAULT_DAYS):
     days = df['daysToExpiration']
     unique_days = list(set(list(days.values)))
@@ -255,38 +641,247 @@ def get_working_days(df, daysToExpiration=DEFAULT_DAYS):
             closest = day
     return closest
 
+def _get_sideframe(chains, putCall, symbol=None, run_date=None, mmm_map=None):
+    # contracts dataframe for one side of the chain
+    started = metrics.start()
+    underlying = chains["underlyingPrice"]
+    if putCall == "PUT":
+        data = _get_mapdata(chains["putExpDateMap"], putCall, underlying=underlying)
+    else:
+        data = _get_mapdata(chains["callExpDateMap"], putCall, underlying=underlying)
+
+    df = _new_sideframe(data, chains, symbol=symbol, run_date=run_date, mmm_map=mmm_map)
+    metrics.stop("parse", started)
+    return df
+
+def _new_sideframe(data, chains, symbol=None, run_date=None, mmm_map=None):
+    # contracts dataframe from a side's columns, chains is the chain dict
+    # (or stream meta) for the chain level values
+    # construct pandas dataframe
+    if len(data["symbol"]) == 0:
+        df = pd.DataFrame([], columns=OPTION_PROPS)
+    else:
+        df = pd.DataFrame(data, columns=OPTION_PROPS)
+    attrs = {}
+    attrs["underlyingPrice"] = chains["underlyingPrice"]
+    attrs["volatility"] = chains["volatility"]
+    attrs["interestRate"] = chains["interestRate"]
+    attrs["runDate"] = run_date
+    attrs["symbol"] = symbol
+    attrs["mmm"] = mmm_map
+    _set_sideframe(df, attrs)
+    return df
+
+def _set_sideframe(df, attrs):
+    # add attrs and the chain index to a contracts frame
+    for k in attrs:
+        df.attrs[k] = attrs[k]
+    df.attrs["chainIndex"] = ChainIndex.from_frame(df)
+    if not LAZY_DERIVED:
+        df.derived.add("meg", "megu", "pom")
+    if COMPACT_DTYPES:
+        _compact_frame(df)
+
+def _compact_frame(df):
+    # switch a contracts frame to the compact dtypes, in place
+    for name in OPTION_DTYPES:
+        if OPTION_DTYPES[name] is not object and df[name].dtype == object:
+            # '' for missing values - NaN instead
+            df[name] = pd.to_numeric(df[name].replace('', np.nan), errors="coerce")
+    for name in CATEGORY_COLUMNS:
+        df[name] = df[name].astype("category")
+    for name in COMPACT_INTS:
+        values = df[name]
+        info = np.iinfo(COMPACT_INTS[name])
+        if values.dtype.kind == "i" and (len(values) == 0 or (values.min() >= info.min and values.max() <= info.max)):
+            df[name] = values.astype(COMPACT_INTS[name])
+    if COMPACT_FLOAT32:
+        for name in FLOAT32_COLUMNS:
+            if name in df.columns:
+                df[name] = df[name].astype(np.float32)
+
+def _save_snapshot(filepath, frames):
+    if COMPACT_FLOAT32:
+        # float32 columns would lose precision for everyone else
+        logging.info(f"float32 frames, not saving snapshot {filepath}")
+        return
+    attrs = frames["PUT"].attrs
+    meta = {}
+    for k in ("symbol", "runDate", "underlyingPrice", "volatility", "interestRate"):
+        meta[k] = attrs[k]
+    mmm_map = attrs["mmm"]
+    if mmm_map is None:
+        meta["mmm"] = None
+    else:
+        # json keys are strings, so store days/mmm pairs
+        meta["mmm"] = [[int(days), mmm_map[days]] for days in mmm_map]
+    meta["columns"] = OPTION_PROPS
+    try:
+        write_snapshot(filepath, frames, meta)
+    except OSError as e:
+        logging.warning(f"unable to save snapshot {filepath}: {e}")
+
+def _get_snapshot_attrs(meta):
+    # frame attrs from a snapshot's meta (see _save_snapshot)
+    attrs = {}
+    for k in ("underlyingPrice", "volatility", "interestRate"):
+        attrs[k] = meta[k]
+    attrs["runDate"] = meta["runDate"]
+    attrs["symbol"] = meta["symbol"]
+    if meta["mmm"] is None:
+        attrs["mmm"] = None
+    else:
+        attrs["mmm"] = {days: mmm for days, mmm in meta["mmm"]}
+    return attrs
+
+def _load_snapshot(filepath):
+    with metrics.timer("load"):
+        snapshot = read_snapshot(filepath)
+    if snapshot is None:
+        return None
+    started = metrics.start()
+    meta, sidecols = snapshot
+    attrs = _get_snapshot_attrs(meta)
+    frames = {}
+    for putCall in sidecols:
+        if meta["rows_" + putCall] == 0:
+            df = pd.DataFrame([], columns=OPTION_PROPS)
+        else:
+            df = pd.DataFrame(sidecols[putCall], columns=OPTION_PROPS)
+        _set_sideframe(df, attrs)
+        frames[putCall] = df
+    metrics.stop("parse", started)
+    logging.info(f"get_dataframe, loaded snapshot: {filepath}")
+    return frames
+
+def _stream_chains(symbol, run_date=None, reload=False):
+    # read_chain() of the saved json, or of the response as it's fetched
+    # (saving it as it's read).  None if there's no data.  The decode time
+    # (columns included) is counted as load, less the mmm map's (see metrics).
+    if run_date is None:
+        run_date = get_today()
+    filepath = get_chains_path(symbol, run_date)
+    if not reload and os.path.isfile(filepath):
+        logging.info(f"streaming data from: {filepath}")
+        with metrics.timer("load"):
+            with open(filepath, "rb") as f:
+                return read_chain(f)
+
+    rsp = _request_chains(symbol, stream=True)
+    if rsp is None:
+        return None
+    rsp.raw.decode_content = True
+    copy = None
+    if os.path.isdir("data"):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        tmppath = f"{filepath}.{os.getpid()}.tmp"
+        copy = open(tmppath, "wb")
+    try:
+        with metrics.timer("load"):
+            meta, sides = read_chain(TeeReader(rsp.raw, copy))
+    except Exception:
+        if copy is not None:
+            copy.close()
+            os.remove(tmppath)
+        raise
+    failed = meta.get("status") == "FAILED"
+    if copy is not None:
+        copy.close()
+        if failed:
+            os.remove(tmppath)
+        else:
+            os.replace(tmppath, filepath)
+    if failed:
+        logging.error(f"got FAILED status: {meta}")
+        return None
+    return (meta, sides)
+
+def _use_stream(filepath, reload=False):
+    # stream fetched chains, and saved ones of at least STREAM_MIN_BYTES
+    if not STREAM_CHAINS:
+        return False
+    if reload or not os.path.isfile(filepath):
+        return True
+    return os.path.getsize(filepath) >= STREAM_MIN_BYTES
+
+def _get_chainframes(symbol, run_date=None, reload=False):
+    # parse a chain snapshot into PUT and CALL contract frames - parsed
+    # frames are kept in the chain cache so each snapshot is only loaded once
+    key = (symbol, run_date)
+    filepath = get_chains_path(symbol, run_date)
+    # taken before loading, so a json saved while it's loaded is newer
+    mtime = _get_mtime(filepath)
+    if not reload:
+        frames = _chain_cache.get(key, mtime=mtime)
+        if frames is not None:
+            logging.info(f"get_dataframe, using cached chain for {symbol} {run_date}")
+            return frames
+
+    # use the columnar snapshot unless the json is newer
+    snappath = get_snapshot_path(filepath)
+    if USE_SNAPSHOTS and not reload and os.path.isfile(snappath):
+        if mtime is None or mtime <= os.path.getmtime(snappath):
+            frames = _load_snapshot(snappath)
+            if frames is not None:
+                _chain_cache.put(key, frames, mtime=mtime)
+                return frames
+
+    frames = {}
+    if _use_stream(filepath, reload=reload):
+        decoded = _stream_chains(symbol, run_date=run_date, reload=reload)
+        if decoded is None:
+            return None
+        meta, sides = decoded
+        started = metrics.start()
+        for putCall in ("PUT", "CALL"):
+            frames[putCall] = _new_sideframe(sides[putCall], meta, symbol=symbol, run_date=run_date,
+                                             mmm_map=meta["mmm"])
+        metrics.stop("parse", started)
+    else:
+        chains = get_chains(symbol, run_date=run_date, reload=reload)
+        if not chains:
+            return None
+
+        underlying = chains["underlyingPrice"]
+        with metrics.timer("mmm"):
+            mmm_map = get_mmm(chains, underlying=underlying)
+        for putCall in ("PUT", "CALL"):
+            frames[putCall] = _get_sideframe(chains, putCall, symbol=symbol, run_date=run_date, mmm_map=mmm_map)
+    if USE_SNAPSHOTS and os.path.isdir(os.path.dirname(snappath)):
+        _save_snapshot(snappath, frames)
+    if reload or mtime is None:
+        # fetched (and saved, if there's a data dir)
+        mtime = _get_mtime(filepath)
+    _chain_cache.put(key, frames, mtime=mtime)
+    return frames
+
 def get_dataframe(symbol, putCall=None, run_date=None, reload=False, daysToExpiration=None):
     if not symbol or symbol[0] == '#':
         eprint("unexpected symbol:", symbol)
         raise ValueError("bad symbol")
-    chains = get_chains(symbol, run_date=run_date, reload=reload)
-    if not chains:
-        logging.error(f"no data found for symbol: {symbol}")
-        return None
 
     if run_date is None:
         run_date = get_today()
 
-    df_rows = []
-    underlying = chains["underlyingPrice"]
-    volatility = chains["volatility"]
-    interestRate = chains["interestRate"]
-    if not putCall or putCall.upper() == "PUT":
-        _get_mapdata(chains["putExpDateMap"], df_rows, underlying=underlying)
-    if not putCall or putCall.upper() == "CALL":
-        _get_mapdata(chains["callExpDateMap"], df_rows, underlying=underlying)
-    logging.info(f"get_dataframe, got: {len(df_rows)}")
-
-    # construct pandas dataframe
-    df =  pd.DataFrame(df_rows, columns=OPTION_PROPS)
-    df.attrs["underlyingPrice"] = underlying
-    df.attrs["volatility"] = volatility
-    df.attrs["interestRate"] = interestRate
-    df.attrs["runDate"] = run_date
-    df.attrs["symbol"] = symbol
+    frames = _get_chainframes(symbol, run_date=run_date, reload=reload)
+    if not frames:
+        logging.error(f"no data found for symbol: {symbol}")
+        return None
 
-    mmm_map = get_mmm(chains, underlying=underlying)
-    df.attrs["mmm"] = mmm_map
+    if not putCall:
+        df = pd.concat([frames["PUT"], frames["CALL"]], ignore_index=True)
+        for k in frames["PUT"].attrs:
+            df.attrs[k] = frames["PUT"].attrs[k]
+        if COMPACT_DTYPES:
+            # each side has its own categories, so concat gave object columns
+            for name in CATEGORY_COLUMNS:
+                df[name] = df[name].astype("category")
+        df.attrs["chainIndex"] = ChainIndex.from_frame(df)
+    elif putCall.upper() in frames:
+        # copy so callers can't change the cached frame
+        df = frames[putCall.upper()].copy()
+    else:
+        df = frames["PUT"].iloc[0:0].copy()
 
     if daysToExpiration:
         # return just those rows that are closest to desired daysToExpiration
@@ -294,16 +889,6 @@ def get_dataframe(symbol, putCall=None, run_date=None, reload=False, daysToExpir
         logging.info(f"filter contracts for daysToExpiration={daysToExpiration}")
         df = df.drop(df[df.daysToExpiration != filterDays].index)
 
-    # add derived columns
-    
-    meg = df['last'] * (1.0 - abs(df['delta']))
-    df['meg'] = meg
-    megu = meg / underlying
-    df['megu'] = megu
-    # pom - prob out of money = 1.0 - delta
-    pom = 1.0 - abs(df['delta'])
-    df['pom'] = pom
-
     return df
 
 def get_prb(value, options=None):
@@ -314,31 +899,14 @@ def get_prb(value, options=None):
         logging.warn("get_prb, expecting at least two options")
         return None
      
-    p1 = None
-    p2 = None
-    for i, option in options.iterrows():
-        if option.strikePrice == value:
-            return abs(option.delta)
-        elif option.strikePrice < value:
-            if p1 is None or  option.strikePrice > p1.strikePrice:
-                p1 = option
-        else:
-            if p2 is None or option.strikePrice < p2.strikePrice:
-                p2 = option
-    
-    if p1 is None or p2 is None:
+    index = ChainIndex()
+    index.add(None, None, options['strikePrice'].to_numpy(dtype=float), options['delta'].to_numpy(dtype=float))
+    prbs, valid = index.interp_delta(None, None, [value])
+    if not valid[0]:
         logging.warn("get_prb, no option_list strike values in range")
         return None
-    #logging.debug("option_low:", p1)
-    #logging.debug("value:", value)
-    #logging.debug("option_high:", p2)
-    
-    def linear(x, x1, x2, y1, y2):
-        return y1 + (x - x1)*(y2 - y1)/(x2 - x1)
-   
-    prb = linear(value, p1.strikePrice, p2.strikePrice, p1.delta, p2.delta)
- 
-    return abs(prb)
+
+    return prbs[0]
 
 def gete(mg, ml, sell_delta, buy_delta, be_delta):
 
@@ -456,7 +1024,222 @@ def get_derived(row, putCall=None, underlying=1.0, options=None):
     return True
 
 
-def get_candidates(contracts, putCall=None, sell_range=None, buy_range=None, daysToExpiration=None):
+
+def _get_pairs(cols, buy_pos, sell_pos, putCall=None, index=None, daysToExpiration=None, filters=None,
+               pair_idx=None, min_width=None, count_only=False):
+    # build every buy x sell pair for one expiration as arrays and apply the
+    # get_candidates/get_derived rules as masks.  Pairs are kept in the order
+    # the nested buy/sell loops would have produced them.
+    # cols is a dict of contract column arrays, buy_pos and sell_pos the
+    # positions of each leg's options in them.  pair_idx, if given, is a
+    # (buy, sell) tuple of index arrays into buy_pos/sell_pos to use in place
+    # of every combination.
+    # filters on SPREAD_COLUMNS are applied before the break even delta is
+    # interpolated, those on DERIVED_COLUMNS once they've been computed.
+    # min_width defaults to MIN_WIDTH.  With count_only just the number of
+    # pairs left once the break even delta is interpolated is returned, so
+    # filters on DERIVED_COLUMNS aren't applied.
+    if min_width is None:
+        min_width = MIN_WIDTH
+    buy_prefix = "b_"
+    sell_prefix = "s_"
+    keep_list = ["description", "last", "mark", "delta", "strikePrice", "totalVolume"]
+    if filters is None:
+        filters = []
+    spread_filters, derived_filters = split_filters(filters, SPREAD_COLUMNS)
+
+    started = metrics.start()
+    b_strike = cols['strikePrice'][buy_pos].astype(float)
+    s_strike = cols['strikePrice'][sell_pos].astype(float)
+    b_delta = abs(cols['delta'][buy_pos].astype(float))
+    s_delta = abs(cols['delta'][sell_pos].astype(float))
+
+    if pair_idx is None:
+        b_idx = np.repeat(np.arange(len(buy_pos)), len(sell_pos))
+        s_idx = np.tile(np.arange(len(sell_pos)), len(buy_pos))
+    else:
+        b_idx, s_idx = pair_idx
+    evaluated = len(b_idx)
+
+    # strike order and delta order - written as the negation of the skip
+    # tests so NaN comparisons behave the same as in the loop
+    if putCall == "PUT":
+        mask = ~(b_strike[b_idx] >= s_strike[s_idx])
+    else:
+        mask = ~(b_strike[b_idx] <= s_strike[s_idx])
+    mask &= ~(b_delta[b_idx] > s_delta[s_idx])
+    b_idx = b_idx[mask]
+    s_idx = s_idx[mask]
+
+    sell_price = cols[USE_PRICE][sell_pos].astype(float)[s_idx]
+    buy_price = cols[USE_PRICE][buy_pos].astype(float)[b_idx]
+    npr = sell_price - buy_price
+    width = abs(s_strike[s_idx] - b_strike[b_idx])
+    mask = ~(npr <= 0) & ~(width < min_width)
+    b_idx = b_idx[mask]
+    s_idx = s_idx[mask]
+    npr = npr[mask]
+    width = width[mask]
+    if spread_filters:
+        mask = get_mask({"mg": npr, "ml": -(width - npr), "width": width}, spread_filters, len(npr))
+        b_idx = b_idx[mask]
+        s_idx = s_idx[mask]
+        npr = npr[mask]
+        width = width[mask]
+
+    if putCall == "CALL":
+        be_strike = s_strike[s_idx] + npr
+    else:
+        be_strike = s_strike[s_idx] - npr
+    be_delta, valid = index.interp_delta(putCall, daysToExpiration, be_strike)
+    b_idx = b_idx[valid]
+    s_idx = s_idx[valid]
+    npr = npr[valid]
+    width = width[valid]
+    be_delta = be_delta[valid]
+    metrics.stop("pairs", started)
+    metrics.count("pairs_evaluated", evaluated)
+    if count_only:
+        return len(npr)
+
+    started = metrics.start()
+    pairs = {}
+    # leg positions in cols, for get_candidates' compact leg columns
+    pairs["s_pos"] = sell_pos[s_idx]
+    pairs["b_pos"] = buy_pos[b_idx]
+    for name in keep_list:
+        pairs[sell_prefix+name] = cols[name][pairs["s_pos"]]
+        pairs[buy_prefix+name] = cols[name][pairs["b_pos"]]
+    sell_delta = pairs[sell_prefix+"delta"].astype(float)
+    buy_delta = pairs[buy_prefix+"delta"].astype(float)
+
+    mg = npr
+    ml = -(width - npr)
+    e = gete(mg, ml, sell_delta, buy_delta, be_delta)
+    mg_w = 100 * mg / width
+    eml = width * abs(sell_delta)
+
+    pairs["putcall"] = np.full(len(mg), putCall, dtype=object)
+    pairs["e"] = e
+    pairs["e_w"] = 100 * e / width
+    pairs["mg"] = mg
+    pairs["ml"] = ml
+    pairs["width"] = width
+    pairs["eml"] = eml
+    pairs["dme"] = mg - eml
+    pairs["dme_w"] = mg_w - 100 * abs(sell_delta)
+    pairs["mg_w"] = mg_w
+    pairs["pop"] = 100.0 * (1 - be_delta)
+    if derived_filters:
+        mask = get_mask(pairs, derived_filters, len(mg))
+        for name in pairs:
+            pairs[name] = pairs[name][mask]
+    metrics.stop("derive", started)
+    return pairs
+
+def _get_top_k(values, k):
+    # positions of the k largest values, largest first.  NaNs go last and
+    # ties keep pair order, so which of several equal values make the cut
+    # doesn't depend on argpartition
+    key = -np.asarray(values, dtype=float)
+    key[np.isnan(key)] = np.inf
+    n = len(key)
+    if k < n:
+        kth = np.partition(key, k - 1)[k - 1]
+        pos = np.flatnonzero(key < kth)
+        ties = np.flatnonzero(key == kth)[:k - len(pos)]
+        pos = np.concatenate([pos, ties])
+    else:
+        pos = np.arange(n)
+    return pos[np.lexsort((pos, key[pos]))]
+
+def _filter_leg(cols, pos, prefix, leg_filters):
+    # positions in pos passing the filters on prefixed leg columns (e.g. s_strikePrice)
+    if not leg_filters:
+        return pos
+    filters = [(column[len(prefix):], op, value) for column, op, value in leg_filters if column.startswith(prefix)]
+    if not filters:
+        return pos
+    values = {}
+    for column, op, value in filters:
+        values[column] = cols[column][pos]
+    return pos[get_mask(values, filters, len(pos))]
+
+def _get_legs(contracts, cols, pos, index, putCall, daysToExpiration, buy_range, sell_range, leg_filters=None):
+    # (buy positions, sell positions) in contracts for one expiration, or
+    # None if either leg has no options in its delta range (and passing
+    # leg_filters on s_/b_ columns).  pos is the positions of the
+    # expiration's options in contracts.
+    if len(pos) == 0:
+        logging.info("get_candidates, no buy rows")
+        return None
+    buy_pos = pos[index.delta_range(putCall, daysToExpiration, buy_range[0], buy_range[1])]
+    buy_pos = _filter_leg(cols, buy_pos, "b_", leg_filters)
+    
+    if len(buy_pos) == 0:
+        logging.info("get_candidates, no buy rows")
+        return None
+    logging.info(f"get_candidates {putCall} buy rows: {len(buy_pos)}")
+
+    sell_pos = pos[index.delta_range(putCall, daysToExpiration, sell_range[0], sell_range[1], inclusive=False)]
+    sell_pos = _filter_leg(cols, sell_pos, "s_", leg_filters)
+    if len(sell_pos) == 0:
+        logging.debug("no rows in sell range")
+        return None
+    logging.info(f"get_candidates {putCall} sell rows: {len(sell_pos)}")
+    return (buy_pos, sell_pos)
+
+def _get_leg_columns(contracts, putCall, s_pos, b_pos):
+    # compact candidates columns for legs at positions s_pos, b_pos in
+    # contracts - their row labels, and the descriptions as categoricals
+    # sharing the contracts' categories rather than copies of the strings
+    legs = {}
+    labels = contracts.index.to_numpy()
+    legs["s_row"] = labels[s_pos]
+    legs["b_row"] = labels[b_pos]
+    desc = contracts["description"]
+    if isinstance(desc.dtype, pd.CategoricalDtype):
+        codes = desc.cat.codes.to_numpy()
+        legs["s_description"] = pd.Categorical.from_codes(codes[s_pos], dtype=desc.dtype)
+        legs["b_description"] = pd.Categorical.from_codes(codes[b_pos], dtype=desc.dtype)
+    legs["putcall"] = pd.Categorical.from_codes(np.zeros(len(s_pos), dtype=np.int8), categories=[putCall])
+    return legs
+
+def _check_index(index, contracts, cols, putCall, daysToExpiration, pos):
+    # index if it was built from the contracts' rows at pos as they are now,
+    # otherwise a new one (rows added, dropped or edited since, or no index)
+    if index is not None and index.matches(putCall, daysToExpiration, contracts.index[pos], cols['strikePrice'][pos],
+                                           cols['delta'][pos], cols['mark'][pos]):
+        return index
+    logging.debug("building chain index")
+    return ChainIndex.from_frame(contracts)
+
+def _get_ranges(putCall, sell_range, buy_range):
+    # (sell_range, buy_range) with the side's default delta ranges for any not given
+    if putCall.upper() == "PUT":
+        if sell_range is None:
+            sell_range = PSR_PS_DELTA_RANGE
+        if buy_range is None:
+            buy_range = PSR_PB_DELTA_RANGE
+    if putCall.upper() == "CALL":
+        if sell_range is None:
+            sell_range = CSR_CS_DELTA_RANGE
+        if buy_range is None:
+            buy_range = CSR_CB_DELTA_RANGE
+    return (sell_range, buy_range)
+
+def get_candidates(contracts, putCall=None, sell_range=None, buy_range=None, daysToExpiration=None,
+                   top_k=None, rank_by="e_w", filters=None):
+    # spreads for one expiration sorted by rank_by (largest first).  With
+    # top_k only the best top_k pairs are turned into rows.  filters is a
+    # list of (column, op, value) tuples (see filters.py), each applied as
+    # early as its column is known - so top_k is the best of the pairs that
+    # pass the filters.
+    #
+    # daysToExpiration can also be a list, set or range of days or "all".
+    # The expirations are then done in one pass and returned as one table
+    # with a daysToExpiration column, ordered by day and then rank_by, with
+    # top_k applied to each expiration.
     if len(contracts) == 0:
         logging.warning("no contracts")
         return None
@@ -471,7 +1254,10 @@ def get_candidates(contracts, putCall=None, sell_range=None, buy_range=None, day
         raise ValueError("putCall should be either PUT or CALL")
     
     logging.info(f"get_candidates - {len(contracts)} contracts - using putCall: {putCall}")
-            
+
+    side = (contracts['putCall'] == putCall).to_numpy()
+    all_days = contracts['daysToExpiration'].to_numpy()
+    multi = False
     if daysToExpiration is None:
         days = contracts['daysToExpiration']
         unique_days = list(set(list(days.values)))
@@ -479,19 +1265,34 @@ def get_candidates(contracts, putCall=None, sell_range=None, buy_range=None, day
         if len(unique_days) != 1:
             raise ValueError(f"set daysToExpiration to one of the values in: {unique_days}")
         daysToExpiration = unique_days[0]
+    elif isinstance(daysToExpiration, str):
+        if daysToExpiration != "all":
+            raise ValueError(f"unexpected daysToExpiration: {daysToExpiration}")
+        multi = True
+        daysToExpiration = list(set(list(all_days[side])))
+    elif not np.isscalar(daysToExpiration):
+        multi = True
+        daysToExpiration = list(set(daysToExpiration))
+    if multi:
+        daysToExpiration.sort()
+        day_list = daysToExpiration
+    else:
+        day_list = [daysToExpiration]
     logging.info(f"get_candidates - using daysToExpiration: {daysToExpiration}")
+
+    filters = check_filters(filters)
+    day_filters, filters = split_filters(filters, DAY_COLUMNS)
+    leg_columns = ["s_" + name for name in LEG_COLUMNS] + ["b_" + name for name in LEG_COLUMNS]
+    leg_filters, filters = split_filters(filters, leg_columns)
+    pair_filters, filters = split_filters(filters, SPREAD_COLUMNS + DERIVED_COLUMNS)
+    if filters:
+        raise ValueError(f"can't filter candidates on: {[f[0] for f in filters]}")
+    day_list = [day for day in day_list if passes(day, day_filters)]
+    if not day_list:
+        logging.info(f"get_candidates, daysToExpiration: {daysToExpiration} filtered out")
+        return None
     
-    if putCall.upper() == "PUT":
-        if sell_range is None:
-            sell_range = PSR_PS_DELTA_RANGE
-        if buy_range is None:
-            buy_range = PSR_PB_DELTA_RANGE
-        
-    if putCall.upper() == "CALL":
-        if sell_range is None:
-            sell_range = CSR_CS_DELTA_RANGE
-        if buy_range is None:
-            buy_range = CSR_CB_DELTA_RANGE
+    sell_range, buy_range = _get_ranges(putCall, sell_range, buy_range)
 
     buy_prefix = "b_"
     sell_prefix = "s_"
@@ -506,137 +1307,119 @@ def get_candidates(contracts, putCall=None, sell_range=None, buy_range=None, day
     derived_list = ["putcall", "e", "mg", "eml", "dme", "dme_u", "dme_w", "width", "mg_w", "mg_u", "mgp_u", "pop", "popt", "e_u", "e_w", "mtp", "ml", "ml_u" ]
     for name in derived_list:
         columns.append(name)
-          
-    candidate_rows = []
+    if multi:
+        columns.append("daysToExpiration")
+    if COMPACT_DTYPES:
+        columns.append("s_row")
+        columns.append("b_row")
+
     logging.debug(f"get_candidates - {len(contracts)} rows")
     start = time.time()
-    df = contracts[contracts.putCall == putCall]
-    if daysToExpiration is not None:
-        df = df[df.daysToExpiration == daysToExpiration]
-    buy_df = df[abs(df.delta) >= buy_range[0]]
-    buy_df = buy_df[abs(buy_df.delta) <= buy_range[1]]
-    
-    #if abs(b.delta) < buy_range[0] or buy_range[1] < abs(b.delta):
-    #        logging.debug(f"skipping row {i}, b delta {b.delta} out of range: {buy_range}")
-    #        continue
-    
-    #buy_df = df[(df.delta < buy_range[0]) & (df.delta > buy_range[1])]
-    if len(buy_df) == 0:
-        logging.info("get_candidates, no buy rows")
-        return None
-    logging.info(f"get_candidates {putCall} buy rows: {len(buy_df)}")
+    # column arrays for the whole frame, legs are positions into them
+    cols = {}
+    for name in set(LEG_COLUMNS) | {USE_PRICE}:
+        cols[name] = contracts[name].to_numpy()
+    # use the index get_dataframe built unless the rows have changed since
+    index = contracts.attrs.get("chainIndex")
+    day_pairs = []
+    for day in day_list:
+        with metrics.timer("filter"):
+            pos = np.flatnonzero(side & (all_days == day))
+            index = _check_index(index, contracts, cols, putCall, day, pos)
+            legs = _get_legs(contracts, cols, pos, index, putCall, day, buy_range, sell_range,
+                             leg_filters=leg_filters)
+        if legs is None:
+            continue
+        buy_pos, sell_pos = legs
 
-    sell_df = df[abs(df.delta) > sell_range[0]]
-    if len(sell_df) == 0:
-        logging.debug("no rows in sell_range")
+        pairs = _get_pairs(cols, buy_pos, sell_pos, putCall=putCall, index=index, daysToExpiration=day,
+                           filters=pair_filters)
+        npairs = len(pairs["e"])
+        logging.debug(f"candidate rows: {npairs}")
+        metrics.count("pairs_kept", npairs)
+        if (top_k is not None or multi) and npairs > 0:
+            # single expirations without top_k are sorted as a frame below
+            with metrics.timer("sort"):
+                order = _get_top_k(pairs[rank_by], npairs if top_k is None else top_k)
+                for name in pairs:
+                    pairs[name] = pairs[name][order]
+        if multi:
+            pairs["daysToExpiration"] = np.full(len(pairs["e"]), day, dtype=all_days.dtype)
+        day_pairs.append(pairs)
+    if not day_pairs:
         return None
-    logging.debug(f"get_candidates sell rows > sell_range: {len(sell_df)}")
-    sell_df = sell_df[abs(sell_df.delta) < sell_range[1]]
-    if len(sell_df) == 0:
-        logging.debug("no rows in sell range")
-        return None
-    logging.info(f"get_candidates {putCall} sell rows: {len(sell_df)}")
 
-    """
-    sp = sell_df["strikePrice"]
-    logging.debug(f"b.strike: {b.strikePrice} sell - strike range: {sp.min()}, {sp.max()}")
-    if putCall == "PUT":
-        sell_df = sell_df[sell_df.strikePrice > b.strikePrice]
+    started = metrics.start()
+    if len(day_pairs) == 1:
+        pairs = day_pairs[0]
     else:
-        # CALL
-        sell_df = sell_df[sell_df.strikePrice < b.strikePrice]
-    """
-    
-    for i, b in buy_df.iterrows(): 
-        logging.debug(f"buy iter {i}, strike: {b.strikePrice}")
-        if b.daysToExpiration != daysToExpiration:
-            logging.debug(f"skipping buy row {i}, daysToExpiration[{b.daysToExpiration}] != {daysToExpiration}")
-            continue
-        if b.putCall != putCall:
-            logging.debug(f"skipping buy row {i}, putCall[{b.putCall}] != {putCall}")
-            continue
-        if abs(b.delta) < buy_range[0] or buy_range[1] < abs(b.delta):
-            logging.debug(f"skipping row {i}, b delta {b.delta} out of range: {buy_range}")
-            # DEBUG:root:skipping row 452, b delta -0.01 out of range: (-0.1, -0.01)
-            continue
-
-        logging.debug(f"get_candidates - inner iteration loop: {len(contracts)} rows")
-        
-
-        
-        #if putCall == "PUT" and b.strikePrice >= s.strikePrice:  
-        #        logging.debug(f"skipping sell row {j}, buy price {b.strikePrice:.3f} >= sell price {s.strikePrice:.3f}")
-        #        continue
-        #if putCall == "CALL" and b.strikePrice <= s.strikePrice:  
-        #        logging.debug(f"skipping sell row {j}, buy price {b.strikePrice:.3f} <= sell price {s.strikePrice:.3f}")
-        #        continue
-        
-        """ 
-        sell_df = sell_df[sell_df.delta <= b.delta]
-        if len(sell_df) == 0:
-            logging.info("get_candidates no sell rows")
-            continue
-        logging.info(f"sell_df rows: {len(sell_df)}")
-        """
-
-        for j, s in sell_df.iterrows():
-            if s.daysToExpiration != daysToExpiration:
-                logging.debug(f"skipping sell row {j}, daysToExpiration[{s.daysToExpiration}] != {daysToExpiration}")
-                continue
-            if s.putCall != putCall:
-                logging.debug(f"skipping sell row {j}, putCall[{s.putCall}] != {putCall}")
-                continue
-            if abs(s.delta) < sell_range[0] or sell_range[1] < abs(s.delta):
-                logging.debug(f"skipping sell row {j},s  delta {abs(s.delta):.3f} out of range: {sell_range}")
-                continue
-            if putCall == "PUT" and b.strikePrice >= s.strikePrice:  
-                logging.debug(f"skipping sell row {j}, buy price {b.strikePrice:.3f} >= sell price {s.strikePrice:.3f}")
-                continue
-            if putCall == "CALL" and b.strikePrice <= s.strikePrice:  
-                logging.debug(f"skipping sell row {j}, buy price {b.strikePrice:.3f} <= sell price {s.strikePrice:.3f}")
-                continue                                                       
-            if abs(b.delta) > abs(s.delta):
-                logging.debug(f"skipping sell row {j}, b delta {b.delta} greater than ps_delta {s.delta}")
-                continue
-
-            # TBD: pre-elimination
-            row = {}
-            logging.debug(f"make row sell index: {s.index} buy_index: {b.index}")
-            for k in b.index:
-                if k not in keep_list:
-                    continue
-                b_key = buy_prefix + k
-                row[b_key] = b[k]
-            for k in s.index:
-                if k not in keep_list:
-                    continue
-                s_key = sell_prefix + k
-                row[s_key] = s[k]  
-            
-            if get_derived(row, putCall=putCall, underlying=underlying, options=contracts):
-                #if row["e"] > MIsN_VAL and row['e_u'] > MIN_VAL:
-                candidate_rows.append(row)   
-                logging.debug(f"add candidate row: {row}")
-            else:    
-                logging.warning("get_derived return none")                            
-                                                                
-    # construct candidates dataframe
-    logging.debug(f"candidate rows: {len(candidate_rows)}")
-    candidates =  pd.DataFrame(candidate_rows, columns=columns)
+        pairs = {}
+        for name in day_pairs[0]:
+            pairs[name] = np.concatenate([p[name] for p in day_pairs])
+    npairs = len(pairs["e"])
+    if npairs == 0:
+        candidates = pd.DataFrame([], columns=columns)
+    else:
+        data = {}
+        for name in columns:
+            if name in pairs:
+                data[name] = pairs[name]
+            else:
+                # derived values get_derived doesn't set
+                data[name] = np.full(npairs, np.nan)
+        if COMPACT_DTYPES:
+            data.update(_get_leg_columns(contracts, putCall, pairs["s_pos"], pairs["b_pos"]))
+        candidates = pd.DataFrame(data, columns=columns)
     for k in contracts.attrs:
         v = contracts.attrs[k]
         candidates.attrs[k] = v
     candidates.attrs['daysToExpiration'] = daysToExpiration
     candidates.attrs["putCall"] = putCall
+    metrics.stop("derive", started, calls=0)
     
     #candidates = candidates.sort_values(by="e", ascending=False)
 
     #candidates['pom'] = 1 - abs(candidates['s_delta'])
     logging.info(f"get_candidates, returning {len(candidates)} candidates from {len(contracts)} contracts")
     logging.info(f"time spent for {len(contracts)}: {(time.time() - start):.2f}")
-    candidates = candidates.sort_values(by="e_w", ascending=False)
+    if top_k is None and not multi:
+        with metrics.timer("sort"):
+            candidates = candidates.sort_values(by=rank_by, ascending=False)
     return candidates
 
+def count_candidates(contracts, putCall=None, sell_range=None, buy_range=None, daysToExpiration=None):
+    # {day: number of spreads} get_candidates would find (without filters)
+    # for each expiration of a side's contracts, without building them.
+    # daysToExpiration is a day, a list of days or None for all of them.
+    if len(contracts) == 0:
+        return {}
+    if putCall is None:
+        putCall = contracts['putCall'].iloc[0]
+    sell_range, buy_range = _get_ranges(putCall, sell_range, buy_range)
+    side = (contracts['putCall'] == putCall).to_numpy()
+    all_days = contracts['daysToExpiration'].to_numpy()
+    if daysToExpiration is None:
+        day_list = sorted(set(all_days[side]))
+    elif np.isscalar(daysToExpiration):
+        day_list = [daysToExpiration]
+    else:
+        day_list = sorted(set(daysToExpiration))
+    cols = {}
+    for name in set(LEG_COLUMNS) | {USE_PRICE}:
+        cols[name] = contracts[name].to_numpy()
+    index = contracts.attrs.get("chainIndex")
+    counts = {}
+    for day in day_list:
+        pos = np.flatnonzero(side & (all_days == day))
+        index = _check_index(index, contracts, cols, putCall, day, pos)
+        legs = _get_legs(contracts, cols, pos, index, putCall, day, buy_range, sell_range)
+        if legs is None:
+            counts[day] = 0
+            continue
+        counts[day] = _get_pairs(cols, legs[0], legs[1], putCall=putCall, index=index, daysToExpiration=day,
+                                 count_only=True)
+    return counts
+
 """
 def get_candidates(contracts, putCall=None, sell_range=None, buy_range=None, daysToExpiration=None):
     if len(contracts) == 0:
@@ -0,0 +1,191 @@
+import os
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .opchain import CHAINS_URL
+from .opchain import get_today
+from .opchain import get_chains_path
+from .opchain import get_auth_token
+from .opchain import _get_chainframes
+from .snapshot import get_snapshot_path
+from .fetch import FETCH_WORKERS, REQUESTS_PER_MINUTE, TokenBucket, get_session, fetch_chain_file
+from .scan import NUM_EWS, SCAN_WORKERS, scan_symbol, get_pool, merge_metrics
+from . import metrics
+
+# pipelined scan_symbols() for cold caches
+#
+#   fetch (threads) -> parse -> candidates
+#
+# The fetch stage downloads chains that aren't in the data dir yet, a few
+# symbols ahead of the scan, so the network waits overlap the parsing and
+# candidate generation of earlier symbols.  With a process pool the workers
+# parse and scan (so one symbol's parse overlaps another's candidates);
+# without one a parse thread loads the next chain into the chain cache
+# while this thread scans the current one.
+#
+# Each stage hands on through a bounded queue, so a fast stage blocks rather
+# than piling up downloads or parsed frames, and at most workers *
+# POOL_BACKLOG scans are submitted at once.  Results come back in symbol
+# order, the same as scan_symbols().
+
+PIPELINE_PREFETCH = 8  # symbols fetched ahead of the scan
+PARSE_AHEAD = 2  # parsed chains waiting to be scanned, without a pool
+POOL_BACKLOG = 2  # submitted scans per pool worker
+QUEUE_TIMEOUT = 0.5  # seconds between checks for a stopped pipeline
+
+_DONE = object()
+
+
+def _needs_fetch(symbol, run_date):
+    filepath = get_chains_path(symbol, run_date)
+    return not os.path.isfile(filepath) and not os.path.isfile(get_snapshot_path(filepath))
+
+
+def _put(q, item, stop):
+    # q.put that gives up (returning False) once stop is set
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=QUEUE_TIMEOUT)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    # q.get that returns _DONE once stop is set
+    while not stop.is_set():
+        try:
+            return q.get(timeout=QUEUE_TIMEOUT)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def _wait(future):
+    # wait for a fetch, a failed one just means the scan finds no data
+    if future is None:
+        return
+    try:
+        future.result()
+    except Exception as e:
+        logging.error(f"scan_pipeline, fetch failed: {e}")
+
+
+def _get_fetcher(symbols, run_date, fetch_workers, requests_per_minute, url):
+    # fetch(symbol) for the fetch stage, and the executor to run it in (None
+    # if every chain is already on disk)
+    missing = [symbol for symbol in symbols if _needs_fetch(symbol, run_date)]
+    if not missing:
+        return (None, None)
+    try:
+        token = get_auth_token()
+    except OSError as e:
+        # the scan will report these symbols as having no data
+        logging.error(f"scan_pipeline, {len(missing)} chains to fetch but no auth token: {e}")
+        return (None, None)
+    workers = max(1, min(fetch_workers, len(missing)))
+    session = get_session(pool_size=workers)
+    limiter = TokenBucket(requests_per_minute / 60.0)
+
+    def fetch(symbol):
+        if not _needs_fetch(symbol, run_date):
+            return None
+        with metrics.timer("load"):
+            status = fetch_chain_file(symbol, run_date, session=session, token=token, limiter=limiter,
+                                      url=url)
+        if status["status"] == "failed":
+            logging.warning(f"scan_pipeline, unable to fetch {symbol}: {status['error']}")
+        return status
+
+    return (fetch, ThreadPoolExecutor(max_workers=workers))
+
+
+def _fetch_stage(symbols, fetch, executor, out, stop):
+    # (symbol, future or None) to out, in symbol order
+    try:
+        for symbol in symbols:
+            future = None
+            if executor is not None:
+                future = executor.submit(fetch, symbol)
+            if not _put(out, (symbol, future), stop):
+                return
+    finally:
+        _put(out, _DONE, stop)
+
+
+def _parse_stage(run_date, fetched, out, stop):
+    # load each fetched symbol's chain into the chain cache
+    while True:
+        item = _get(fetched, stop)
+        if item is _DONE:
+            break
+        symbol, future = item
+        _wait(future)
+        try:
+            _get_chainframes(symbol, run_date=run_date)
+        except Exception as e:
+            # scan_symbol will hit (and report) the same error
+            logging.warning(f"scan_pipeline, unable to parse {symbol}: {e}")
+        if not _put(out, symbol, stop):
+            return
+    _put(out, _DONE, stop)
+
+
+def scan_pipeline(symbols, run_date=None, exp_days=None, count=NUM_EWS, columns=None, filters=None,
+                  workers=SCAN_WORKERS, fetch_workers=FETCH_WORKERS, prefetch=PIPELINE_PREFETCH,
+                  requests_per_minute=REQUESTS_PER_MINUTE, url=CHAINS_URL):
+    # scan_symbols() with the fetch, parse and candidate stages overlapped
+    # (see above).  Returns the statuses in symbol order.
+    if run_date is None:
+        run_date = get_today()
+    fetch, executor = _get_fetcher(symbols, run_date, fetch_workers, requests_per_minute, url)
+    stop = threading.Event()
+    fetched = queue.Queue(maxsize=max(1, prefetch))
+    threads = [threading.Thread(target=_fetch_stage, args=(symbols, fetch, executor, fetched, stop),
+                                name="scan-fetch", daemon=True)]
+    use_pool = workers is not None and workers > 1 and len(symbols) > 1
+    if use_pool:
+        ready = fetched
+    else:
+        ready = queue.Queue(maxsize=PARSE_AHEAD)
+        threads.append(threading.Thread(target=_parse_stage, args=(run_date, fetched, ready, stop),
+                                        name="scan-parse", daemon=True))
+    for thread in threads:
+        thread.start()
+
+    statuses = []
+    try:
+        if use_pool:
+            with get_pool(workers) as pool:
+                pending = deque()
+                while True:
+                    item = ready.get()
+                    if item is _DONE:
+                        break
+                    symbol, future = item
+                    _wait(future)
+                    pending.append(pool.submit(scan_symbol, symbol, run_date=run_date, exp_days=exp_days,
+                                               count=count, columns=columns, filters=filters))
+                    # backpressure - wait for the oldest scan once enough are queued
+                    while len(pending) >= workers * POOL_BACKLOG:
+                        statuses.append(pending.popleft().result())
+                while pending:
+                    statuses.append(pending.popleft().result())
+        else:
+            while True:
+                symbol = ready.get()
+                if symbol is _DONE:
+                    break
+                statuses.append(scan_symbol(symbol, run_date=run_date, exp_days=exp_days, count=count,
+                                            columns=columns, filters=filters))
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+    merge_metrics(statuses)
+    return statuses
@@ -0,0 +1,281 @@
+import os
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from .opchain import get_dataframe
+from .opchain import get_candidates
+from .opchain import count_candidates
+from .opchain import get_compact_dtypes, set_compact_dtypes
+from .shared import SharedChains
+from . import metrics
+from .filters import DAY_COLUMNS, check_filters, get_mask, passes, split_filters
+
+# best e_w scan over a list of symbols (used by get_besteu.py)
+#
+# Each symbol is independent, so scan_symbols() can spread them over a
+# process pool.  Workers only send back their list of best rows (dicts of
+# scalars), never the frames, and results are merged in symbol order so the
+# output is the same for any number of workers.
+#
+# With shared=True the parent loads every chain once into a SharedChains
+# block that the workers attach to, rather than each worker parsing (and
+# caching) the chains of the symbols it's handed.
+
+NUM_EWS = 100
+SCAN_WORKERS = os.cpu_count() or 1
+
+_in_worker = False  # set in pool worker processes
+_shared = None  # the SharedChains a pool worker attached to
+
+
+def getMMM(candidates, target):
+    mmm = 0.0
+    if target is None:
+        target = 7
+    if "mmm" in candidates.attrs and candidates.attrs["mmm"]:
+        mmm_map = candidates.attrs["mmm"]
+        mmm_diff = 999
+        for day in mmm_map:
+            if abs(day - target) < mmm_diff:
+                mmm_diff = abs(day - target)
+                mmm = mmm_map[day]
+    return mmm
+
+def getExpDateFromDesc(desc):
+    # "CMG Dec 31 2021 1745 Put (Weekly)" -> DEC 31 21"
+    fields = desc.split()
+    month = fields[1]
+    day = fields[2]
+    year = fields[3]
+    exp_date = f"{day} {month.upper()} {year[-2:]}"
+    return exp_date
+
+def _get_dm(s_strike, putCall, underlying, mmm, mmm2):
+    # distance of the sell strike outside the expected moves, and as % of underlying
+    if putCall == "PUT":
+        dm = underlying - mmm - s_strike
+        dm2 = underlying - mmm2 - s_strike
+    else:
+        dm = s_strike - underlying - mmm
+        dm2 = s_strike - underlying - mmm2
+    dmu = (dm/underlying)*100.0
+    dmu2 = (dm2/underlying)*100.0
+    return {"dm": dm, "dm2": dm2, "dmu": dmu, "dmu2": dmu2}
+
+def _get_mmm2(df, daysToExpiration, days):
+    # getMMM for each of days, or the one value if daysToExpiration is a single day
+    if days is None:
+        return getMMM(df, daysToExpiration)
+    unique_days, inverse = np.unique(days, return_inverse=True)
+    mmm2 = np.array([getMMM(df, day) for day in unique_days], dtype=float)
+    return mmm2[inverse]
+
+def _get_best_rows(df, daysToExpiration=None, count=1, filters=None):
+    # (rows, row_ids, total) - the best count candidates by e_w, as row dicts
+    # of those passing filters, with their positions among all total of
+    # them.  filters can be on any row column (e_w, dmu, days_exp...).
+    # daysToExpiration can be a list of days or "all" (see get_candidates),
+    # giving the best count for each expiration in one pass.
+    #
+    # The best count are picked per expiration, so expirations failing the
+    # filters on days are skipped before their spreads are built - they're
+    # only counted, to keep the positions of the rest.  The other filters
+    # are applied after the best count are picked, the same as minmaxFilter
+    # on getBestEw's rows, so they don't change which spreads make the cut.
+    multi = isinstance(daysToExpiration, str) or (daysToExpiration is not None and not np.isscalar(daysToExpiration))
+    filters = check_filters(filters)
+    day_filters, filters = split_filters(filters, DAY_COLUMNS)
+    if isinstance(daysToExpiration, str):
+        days = sorted(set(df["daysToExpiration"]))
+    elif multi:
+        days = sorted(set(daysToExpiration))
+    else:
+        days = [daysToExpiration]
+    kept = [day for day in days if day is None or passes(day, day_filters)]
+    skipped = [day for day in days if day not in kept]
+    sizes = {}
+    if skipped:
+        if multi:
+            counts = count_candidates(df, daysToExpiration=skipped)
+        else:
+            # a single expiration's df only holds that day
+            counts = {daysToExpiration: sum(count_candidates(df).values())}
+        for day in skipped:
+            sizes[day] = min(count, counts.get(day, 0))
+    candidates = None
+    if kept:
+        candidates = get_candidates(df, daysToExpiration=kept if multi else None, top_k=count)
+    if candidates is None or len(candidates) == 0:
+        return ([], [], sum(sizes.values()))
+
+    # each row's position among all the days' best rows, in day order
+    if multi:
+        row_days = candidates["daysToExpiration"].to_numpy()
+    else:
+        row_days = np.full(len(candidates), daysToExpiration)
+    for day in kept:
+        sizes[day] = int(np.count_nonzero(row_days == day))
+    offsets = {}
+    total = 0
+    for day in days:
+        offsets[day] = total
+        total += sizes[day]
+    positions = np.empty(len(candidates), dtype=np.int64)
+    for day in kept:
+        at = np.flatnonzero(row_days == day)
+        positions[at] = offsets[day] + np.arange(len(at))
+
+    if multi:
+        daysToExpiration = candidates["daysToExpiration"].to_numpy()
+    mmm = getMMM(candidates, 7)
+    mmm2 = _get_mmm2(candidates, daysToExpiration, daysToExpiration if multi else None)
+    underlying = candidates.attrs["underlyingPrice"]
+    s_strike = candidates["s_strikePrice"].to_numpy(dtype=float)
+    dm = _get_dm(s_strike, candidates.attrs["putCall"], underlying, mmm, mmm2)
+
+    # same keys in the same order as the rows used to be built with
+    data = {}
+    data["exp_date"] = [getExpDateFromDesc(desc) for desc in candidates["s_description"]]
+    data["mmm"] = mmm
+    data["mmm2"] = mmm2
+    data["dm"] = dm["dm"]
+    data["dm2"] = dm["dm2"]
+    data["dmu"] = dm["dmu"]
+    data["dmu2"] = dm["dmu2"]
+    for k in candidates.attrs:
+        if k in ("mmm", "chainIndex"):
+            continue
+        if k == "daysToExpiration" and multi:
+            data[k] = daysToExpiration
+        else:
+            data[k] = candidates.attrs[k]
+    for k in candidates.columns:
+        data[k] = candidates[k].to_numpy()
+    data['days_exp'] = daysToExpiration
+    rows = pd.DataFrame(data, index=range(len(candidates)))
+    row_ids = positions
+    if filters:
+        mask = get_mask(data, filters, len(candidates))
+        row_ids = row_ids[mask]
+        rows = rows[mask]
+    return (rows.to_dict("records"), list(row_ids), total)
+
+def getBestEw(df, daysToExpiration=None, count=1, filters=None):
+    # the best count candidates by e_w as a list of row dicts, less those
+    # failing filters (see _get_best_rows)
+    return _get_best_rows(df, daysToExpiration=daysToExpiration, count=count, filters=filters)[0]
+
+
+def _get_contracts(symbol, putCall, run_date, exp_days):
+    # a side's contracts, from the shared block if this worker has one
+    if _shared is not None and _shared.has(symbol, run_date):
+        return _shared.get_dataframe(symbol, putCall=putCall, daysToExpiration=exp_days)
+    return get_dataframe(symbol, putCall=putCall, run_date=run_date, daysToExpiration=exp_days)
+
+
+def scan_symbol(symbol, run_date=None, exp_days=None, count=NUM_EWS, columns=None, filters=None):
+    # best rows for both sides of one symbol.  Returns a status dict with the
+    # rows, the sides that had no data and the error if the scan raised.
+    # Rows failing filters are left out (see _get_best_rows) - row_ids has
+    # each row's position among all row_count best rows, so the caller can
+    # number them as if they'd been filtered afterwards.
+    status = {"symbol": symbol, "rows": [], "row_ids": [], "row_count": 0, "failed": [], "error": None}
+    try:
+        filters = check_filters(filters)
+        rows = []
+        row_ids = []
+        row_count = 0
+        for putCall in ("PUT", "CALL"):
+            df = _get_contracts(symbol, putCall, run_date, exp_days)
+            if df is None or len(df) == 0:
+                status["failed"].append(putCall)
+                continue
+            if exp_days is None:
+                # all the days of expiration in one pass
+                days = df['daysToExpiration']
+                days = list(set(list(days.values)))
+                best = _get_best_rows(df, daysToExpiration=days, count=count, filters=filters)
+            else:
+                best = _get_best_rows(df, daysToExpiration=exp_days, filters=filters)
+            rows.extend(best[0])
+            row_ids.extend(row_count + i for i in best[1])
+            row_count += best[2]
+    except Exception as e:
+        logging.error(f"scan_symbol {symbol} failed: {traceback.format_exc()}")
+        status["error"] = f"{type(e).__name__}: {e}"
+        return status
+    if columns is not None:
+        # only send back what the caller is going to use
+        trimmed = []
+        for row in rows:
+            trimmed.append({k: row[k] for k in columns if k in row})
+        rows = trimmed
+    status["rows"] = rows
+    status["row_ids"] = row_ids
+    status["row_count"] = row_count
+    if _in_worker and metrics.is_enabled():
+        # hand this symbol's metrics back to the parent to merge
+        status["metrics"] = metrics.snapshot()
+        metrics.reset()
+    return status
+
+
+def _init_worker(loglevel, profile, compact, shared=None):
+    global _in_worker, _shared
+    _in_worker = True
+    # spawned workers don't inherit the parent's module settings
+    set_compact_dtypes(*compact)
+    if shared is not None:
+        _shared = SharedChains.attach(*shared)
+    logging.basicConfig(format='%(asctime)s %(message)s', level=loglevel)
+    logging.getLogger().setLevel(loglevel)
+    metrics.reset()
+    metrics.enable(profile)
+
+
+def get_pool(workers, shared=None):
+    # process pool whose workers log, profile and use the dtypes this process
+    # does, and attach to the SharedChains shared if given
+    loglevel = logging.getLogger().getEffectiveLevel()
+    if shared is not None:
+        shared = (shared.name, shared.index)
+    initargs = (loglevel, metrics.is_enabled(), get_compact_dtypes(), shared)
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs)
+
+
+def merge_metrics(statuses):
+    # merge (and remove) the metrics pool workers sent back with their statuses
+    for status in statuses:
+        if "metrics" in status:
+            metrics.merge(status.pop("metrics"))
+
+
+def scan_symbols(symbols, run_date=None, exp_days=None, count=NUM_EWS, columns=None, filters=None,
+                 workers=SCAN_WORKERS, shared=False):
+    # scan_symbol() for each symbol, returns the statuses in symbol order.
+    # With workers <= 1 everything runs in this process (and shared is
+    # ignored).
+    if workers is None or workers <= 1 or len(symbols) <= 1:
+        statuses = []
+        for symbol in symbols:
+            statuses.append(scan_symbol(symbol, run_date=run_date, exp_days=exp_days, count=count, columns=columns,
+                                        filters=filters))
+        return statuses
+
+    n = len(symbols)
+    chains = None
+    if shared:
+        chains = SharedChains.create(symbols, run_date=run_date)
+    try:
+        with get_pool(workers, shared=chains) as executor:
+            # map() hands results back in symbol order whatever order they finish in
+            statuses = list(executor.map(scan_symbol, symbols, [run_date]*n, [exp_days]*n,
+                                         [count]*n, [columns]*n, [filters]*n, chunksize=1))
+    finally:
+        if chains is not None:
+            chains.close()
+            chains.unlink()
+    merge_metrics(statuses)
+    return statuses
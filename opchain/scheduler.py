@@ -0,0 +1,262 @@
+import os
+import glob
+import time
+import shutil
+import logging
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from .opchain import CHAINS_URL
+from .opchain import get_chains_path
+from .opchain import get_auth_token
+from .opchain import read_chain
+from .opchain import clear_chain_cache
+from .snapshot import get_snapshot_path, read_snapshot
+from .fetch import REQUESTS_PER_MINUTE, TokenBucket, get_session, fetch_chains
+
+# intraday refresh scheduler
+#
+# Keeps a list of symbols' chains fresh within a requests per minute budget.
+# Each symbol has its own refresh interval, from MIN_INTERVAL for the most
+# active chain (open interest plus volume, boosted near expiration) up to
+# MAX_INTERVAL for the least, and is only fetched once it's due - a symbol
+# whose latest snapshot is younger than its interval is left alone.  When
+# more symbols are due than the budget allows, the highest priority go
+# first and the rest wait for tokens.
+#
+# Each fetch is saved as a timestamped intraday snapshot next to the daily
+# file, data/{symbol}/{symbol}-{run_date}T{HHMMSS}.json, and copied over the
+# daily file that get_dataframe (and the service) read.
+#
+#   scheduler = RefreshScheduler(symbols, requests_per_minute=60)
+#   scheduler.run()  # forever, or run(until=t) to stop once clock() >= t
+#   scheduler.run_once()  # fetch what's due now that the budget allows
+#
+# clock, sleep, url and session can be swapped for a fake clock and a stub
+# server in tests.
+
+MIN_INTERVAL = 5 * 60.0  # seconds between refreshes of the most active symbol
+MAX_INTERVAL = 60 * 60.0  # and of the least active
+RETRY_INTERVAL = 60.0  # first retry after a failed fetch, doubled after each failure
+NEAR_EXPIRY_DAYS = 7  # chains with an expiration this close...
+NEAR_EXPIRY_BOOST = 4.0  # ...have their priority multiplied by this
+VOLUME_WEIGHT = 1.0  # priority is openInterest + VOLUME_WEIGHT * totalVolume
+MIN_SLEEP = 1.0  # shortest wait between scheduler passes
+STAT_COLUMNS = ("openInterest", "totalVolume", "daysToExpiration")
+
+
+def get_intraday_path(symbol, run_date, hhmmss):
+    return f"data/{symbol}/{symbol}-{run_date}T{hhmmss}.json"
+
+
+def _get_times(timestamp):
+    # (run_date, HHMMSS) for a clock() value
+    dt = datetime.fromtimestamp(timestamp)
+    return (f"{dt.year}-{dt.month:02d}-{dt.day:02d}", f"{dt.hour:02d}{dt.minute:02d}{dt.second:02d}")
+
+
+def get_stats(sidecols):
+    # {openInterest, totalVolume, minDays} totals of a chain's side columns
+    stats = {"openInterest": 0.0, "totalVolume": 0.0, "minDays": None}
+    for putCall in sidecols:
+        cols = sidecols[putCall]
+        for name in ("openInterest", "totalVolume"):
+            values = pd.to_numeric(pd.Series(cols[name]), errors="coerce").to_numpy(dtype=float)
+            stats[name] += float(np.nansum(values))
+        days = cols["daysToExpiration"]
+        if len(days):
+            min_days = int(np.min(days))
+            if stats["minDays"] is None or min_days < stats["minDays"]:
+                stats["minDays"] = min_days
+    return stats
+
+
+def get_priority(stats):
+    # bigger is refreshed more often, None (never fetched) comes first
+    if stats is None:
+        return float("inf")
+    priority = stats["openInterest"] + VOLUME_WEIGHT * stats["totalVolume"]
+    if stats["minDays"] is not None and stats["minDays"] <= NEAR_EXPIRY_DAYS:
+        priority *= NEAR_EXPIRY_BOOST
+    return priority
+
+
+def _read_stats(filepath):
+    # stats from a saved chain - its snapshot's columns if it has one
+    snappath = get_snapshot_path(filepath)
+    if os.path.isfile(snappath) and (not os.path.isfile(filepath) or
+                                     os.path.getmtime(filepath) <= os.path.getmtime(snappath)):
+        snapshot = read_snapshot(snappath, columns=list(STAT_COLUMNS))
+        if snapshot is not None:
+            return get_stats(snapshot[1])
+    if not os.path.isfile(filepath):
+        return None
+    try:
+        with open(filepath, "rb") as f:
+            meta, sides = read_chain(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"scheduler, unable to read {filepath}: {e}")
+        return None
+    return get_stats(sides)
+
+
+class RefreshScheduler:
+    def __init__(self, symbols, requests_per_minute=REQUESTS_PER_MINUTE, min_interval=MIN_INTERVAL,
+                 max_interval=MAX_INTERVAL, intervals=None, priority=get_priority, update_daily=True,
+                 clock=time.time, sleep=time.sleep, url=CHAINS_URL, session=None, token=None):
+        # intervals is an optional {symbol: seconds} overriding the
+        # priority based interval, priority a function of a symbol's stats
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.intervals = intervals or {}
+        self.priority = priority
+        self.update_daily = update_daily
+        self.clock = clock
+        self.sleep = sleep
+        self.url = url
+        self.session = session
+        self.token = token
+        self.limiter = TokenBucket(requests_per_minute / 60.0, clock=clock, sleep=sleep)
+        self._token_wait = 0.0
+        self.states = {}
+        for symbol in symbols:
+            self.states[symbol] = self._get_state(symbol)
+        self._set_intervals()
+
+    def _get_state(self, symbol):
+        # a symbol's schedule, starting from its latest snapshot on disk
+        run_date, hhmmss = _get_times(self.clock())
+        state = {"symbol": symbol, "last": None, "attempt": None, "failures": 0, "interval": self.min_interval,
+                 "stats": None, "fetches": 0}
+        latest = None
+        intraday = sorted(glob.glob(glob.escape(get_intraday_path(symbol, run_date, "")[:-len(".json")]) + "*.json"))
+        for filepath in reversed(intraday):
+            stamp = os.path.basename(filepath)[len(symbol) + 1:-len(".json")]
+            try:
+                state["last"] = datetime.strptime(stamp, "%Y-%m-%dT%H%M%S").timestamp()
+            except ValueError:
+                continue
+            latest = filepath
+            break
+        filepath = get_chains_path(symbol, run_date)
+        if os.path.isfile(filepath):
+            mtime = os.path.getmtime(filepath)
+            if state["last"] is None or mtime > state["last"]:
+                state["last"] = mtime
+                latest = filepath
+        if latest is not None:
+            state["stats"] = _read_stats(latest)
+        return state
+
+    def _set_intervals(self):
+        # spread the intervals geometrically over the symbols by priority
+        ranked = []
+        for symbol in self.states:
+            state = self.states[symbol]
+            if state["stats"] is not None:
+                ranked.append((-self.priority(state["stats"]), symbol))
+        ranked.sort()
+        n = len(ranked)
+        ratio = self.max_interval / self.min_interval
+        for rank, (priority, symbol) in enumerate(ranked):
+            scale = rank / (n - 1) if n > 1 else 0.0
+            self.states[symbol]["interval"] = self.min_interval * ratio ** scale
+        for symbol in self.states:
+            state = self.states[symbol]
+            if state["stats"] is None:
+                # find out how active it is soon
+                state["interval"] = self.min_interval
+            if symbol in self.intervals:
+                state["interval"] = self.intervals[symbol]
+
+    def get_due(self, state):
+        # clock() time the symbol is next due
+        if state["failures"]:
+            retry = RETRY_INTERVAL * 2 ** (state["failures"] - 1)
+            return state["attempt"] + min(retry, state["interval"])
+        if state["last"] is None:
+            return float("-inf")
+        return state["last"] + state["interval"]
+
+    def _fetch(self, state, now):
+        symbol = state["symbol"]
+        if self.token is None:
+            self.token = get_auth_token()
+        if self.session is None:
+            self.session = get_session(pool_size=1)
+        run_date, hhmmss = _get_times(now)
+        intraday_path = get_intraday_path(symbol, run_date, hhmmss)
+        os.makedirs(os.path.dirname(intraday_path), exist_ok=True)
+        state["attempt"] = now
+        # the scheduler spends a token per attempt and reschedules failures itself
+        data, status = fetch_chains(symbol, session=self.session, token=self.token, url=self.url, retries=0,
+                                    sleep=self.sleep, filepath=intraday_path)
+        if data is None:
+            state["failures"] += 1
+            logging.warning(f"scheduler, {symbol} failed ({state['failures']}): {status['error']}")
+            return status
+        state["failures"] = 0
+        state["last"] = now
+        state["fetches"] += 1
+        if self.update_daily:
+            filepath = get_chains_path(symbol, run_date)
+            tmppath = f"{filepath}.{os.getpid()}.tmp"
+            shutil.copyfile(intraday_path, tmppath)
+            os.replace(tmppath, filepath)
+            clear_chain_cache(symbol, run_date)
+        state["stats"] = _read_stats(intraday_path)
+        return status
+
+    def run_once(self):
+        # fetch the due symbols, highest priority first, while the budget
+        # has tokens.  Returns the symbols fetched (or tried).
+        now = self.clock()
+        due = [state for state in self.states.values() if self.get_due(state) <= now]
+        # python's sort is stable, so equal priorities keep symbol order
+        due.sort(key=lambda state: -self.priority(state["stats"]))
+        fetched = []
+        self._token_wait = 0.0
+        for state in due:
+            wait = self.limiter.try_acquire()
+            if wait > 0.0:
+                logging.info(f"scheduler, budget spent with {len(due) - len(fetched)} symbols due")
+                self._token_wait = wait
+                break
+            self._fetch(state, self.clock())
+            fetched.append(state["symbol"])
+        if fetched:
+            self._set_intervals()
+        return fetched
+
+    def get_wait(self):
+        # seconds until the next run_once() has something to do
+        now = self.clock()
+        if self._token_wait > 0.0:
+            return max(MIN_SLEEP, self._token_wait)
+        if not self.states:
+            return MIN_SLEEP
+        next_due = min(self.get_due(state) for state in self.states.values())
+        return max(MIN_SLEEP, next_due - now)
+
+    def run(self, until=None):
+        # run_once() as symbols come due, until clock() reaches until (or forever)
+        while until is None or self.clock() < until:
+            self.run_once()
+            wait = self.get_wait()
+            if until is not None:
+                wait = min(wait, max(0.0, until - self.clock()))
+            if wait > 0.0:
+                self.sleep(wait)
+
+    def get_schedule(self):
+        # a frame of each symbol's priority, interval and due time
+        rows = []
+        for symbol in self.states:
+            state = self.states[symbol]
+            stats = state["stats"] or {}
+            rows.append([symbol, self.priority(state["stats"]), state["interval"], self.get_due(state),
+                         state["last"], state["failures"], state["fetches"], stats.get("openInterest"),
+                         stats.get("totalVolume"), stats.get("minDays")])
+        columns = ["symbol", "priority", "interval", "due", "last", "failures", "fetches", "openInterest",
+                   "totalVolume", "minDays"]
+        return pd.DataFrame(rows, columns=columns).sort_values(by="due", kind="stable")
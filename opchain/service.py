@@ -0,0 +1,427 @@
+import os
+import re
+import sys
+import json
+import time
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from .opchain import get_today
+from .opchain import get_chains_path
+from .opchain import get_candidates
+from .opchain import clear_chain_cache
+from .opchain import _get_chainframes
+from .opchain import LEG_COLUMNS, SPREAD_COLUMNS, DERIVED_COLUMNS
+from .snapshot import get_snapshot_path, SIDES
+from .filters import check_filters, DAY_COLUMNS
+
+# local scan service
+#
+# Loads a day's chains once and answers get_candidates queries over http
+# from the parsed frames it keeps in memory, so a what-if query with a
+# different range or expiration doesn't pay for a new process, the imports
+# and a parse.  A background thread reloads a symbol when its json or
+# snapshot in data/ changes (and, when serving every symbol, picks up new
+# ones).
+#
+#   python -m opchain.service [--rundate YYYY-MM-DD] [--port N] [SYMBOL ...]
+#
+#   GET /symbols
+#   GET /candidates?symbol=TSLA&putCall=PUT&days=45&sell=0.05,0.12&buy=0.009,0.12
+#                   &top_k=20&rank_by=e_w&filter=mg>=0.5&format=json|arrow
+#   GET /contracts?symbol=TSLA&putCall=PUT&days=45
+#
+# days picks the closest expiration, the same as get_dataframe.  Results
+# are {"meta": {...}, "columns": [...], "data": [[...], ...]} with NaN as
+# null, or an Arrow IPC stream (needs pyarrow) for format=arrow.
+
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8642
+REFRESH_SECONDS = 30.0  # how often data/ is checked for new snapshots
+SERVICE_TOP_K = 100  # default top_k for /candidates, 0 for every candidate
+META_ATTRS = ("symbol", "runDate", "underlyingPrice", "volatility", "interestRate", "putCall", "daysToExpiration")
+
+# candidate columns /candidates can rank by and filter on
+RANK_COLUMNS = tuple(prefix + name for prefix in ("s_", "b_") for name in LEG_COLUMNS if name != "description") + \
+    tuple(name for name in SPREAD_COLUMNS + DERIVED_COLUMNS if name != "putcall")
+FILTER_COLUMNS = DAY_COLUMNS + tuple(prefix + name for prefix in ("s_", "b_") for name in LEG_COLUMNS) + \
+    SPREAD_COLUMNS + DERIVED_COLUMNS
+
+_filter_re = re.compile(r"^\s*(\w+)\s*(>=|<=|==|!=|>|<)\s*(\S+)\s*$")
+
+
+class QueryError(ValueError):
+    # a bad request - sent back as a 400
+    pass
+
+
+def _get_mtime(symbol, run_date):
+    # latest mtime of the symbol's json and snapshot, None if there's neither
+    filepath = get_chains_path(symbol, run_date)
+    mtimes = [os.path.getmtime(path) for path in (filepath, get_snapshot_path(filepath)) if os.path.isfile(path)]
+    if not mtimes:
+        return None
+    return max(mtimes)
+
+
+def _list_symbols(run_date):
+    # symbols in data/ with a json or snapshot for run_date
+    symbols = []
+    if not os.path.isdir("data"):
+        return symbols
+    for symbol in sorted(os.listdir("data")):
+        if _get_mtime(symbol, run_date) is not None:
+            symbols.append(symbol)
+    return symbols
+
+
+class ChainService:
+    # parsed chains for a run date - {symbol: entry} where entry has the
+    # side frames, their expirations and the file mtime they were loaded at
+    def __init__(self, symbols=None, run_date=None, refresh=REFRESH_SECONDS):
+        if run_date is None:
+            run_date = get_today()
+        self.run_date = run_date
+        self.watch_all = symbols is None
+        self.symbols = list(symbols) if symbols is not None else _list_symbols(run_date)
+        self.refresh_seconds = refresh
+        self._chains = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self, symbol):
+        # (re)load symbol's chain from its json or snapshot in data/, returns
+        # False if there's no data.  Never fetches - a missing chain is
+        # picked up by refresh() once something else saves it.
+        mtime = _get_mtime(symbol, self.run_date)
+        if mtime is None:
+            logging.warning(f"service, no data for {symbol} {self.run_date}")
+            return False
+        started = time.time()
+        # the file changed, so the cached frames are out of date
+        clear_chain_cache(symbol, self.run_date)
+        frames = _get_chainframes(symbol, run_date=self.run_date)
+        if not frames:
+            logging.warning(f"service, no data for {symbol} {self.run_date}")
+            return False
+        entry = {"frames": frames, "days": {}, "rows": {}}
+        for putCall in SIDES:
+            df = frames[putCall]
+            entry["days"][putCall] = np.unique(df["daysToExpiration"].to_numpy())
+            entry["rows"][putCall] = len(df)
+        # the mtime after loading, which may have written a snapshot
+        entry["mtime"] = max(mtime or 0.0, _get_mtime(symbol, self.run_date) or 0.0)
+        entry["loaded"] = time.time()
+        with self._lock:
+            self._chains[symbol] = entry
+        logging.info(f"service, loaded {symbol} in {time.time() - started:.2f}s")
+        return True
+
+    def _try_load(self, symbol):
+        # load() that logs rather than raises, so one bad file doesn't stop
+        # the others from loading
+        try:
+            return self.load(symbol)
+        except Exception as e:
+            logging.error(f"service, unable to load {symbol} {self.run_date}: {type(e).__name__}: {e}")
+            return False
+
+    def load_all(self):
+        for symbol in self.symbols:
+            self._try_load(symbol)
+
+    def refresh(self):
+        # reload symbols whose files changed, returns the symbols reloaded
+        if self.watch_all:
+            for symbol in _list_symbols(self.run_date):
+                if symbol not in self.symbols:
+                    self.symbols.append(symbol)
+        reloaded = []
+        for symbol in self.symbols:
+            mtime = _get_mtime(symbol, self.run_date)
+            with self._lock:
+                entry = self._chains.get(symbol)
+            if mtime is None or (entry is not None and mtime <= entry["mtime"]):
+                continue
+            if self._try_load(symbol):
+                reloaded.append(symbol)
+        return reloaded
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_seconds):
+            try:
+                reloaded = self.refresh()
+            except Exception as e:
+                logging.error(f"service, refresh failed: {e}")
+                continue
+            if reloaded:
+                logging.info(f"service, reloaded {reloaded}")
+
+    def start(self):
+        # start the background refresh
+        if self._thread is None and self.refresh_seconds:
+            self._thread = threading.Thread(target=self._refresh_loop, name="service-refresh", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get_symbols(self):
+        with self._lock:
+            chains = dict(self._chains)
+        result = []
+        for symbol in sorted(chains.keys()):
+            entry = chains[symbol]
+            result.append({"symbol": symbol,
+                           "underlyingPrice": entry["frames"]["PUT"].attrs.get("underlyingPrice"),
+                           "rows": entry["rows"],
+                           "days": {putCall: [int(day) for day in entry["days"][putCall]] for putCall in SIDES},
+                           "loaded": entry["loaded"]})
+        return result
+
+    def get_contracts(self, symbol, putCall, days=None):
+        # (side frame, the closest expiration to days - None for all of them)
+        with self._lock:
+            entry = self._chains.get(symbol)
+        if entry is None:
+            raise QueryError(f"unknown symbol: {symbol}")
+        putCall = putCall.upper()
+        if putCall not in SIDES:
+            raise QueryError(f"putCall should be PUT or CALL, got: {putCall}")
+        df = entry["frames"][putCall]
+        if days is None:
+            return (df, None)
+        unique_days = entry["days"][putCall]
+        if len(unique_days) == 0:
+            raise QueryError(f"no {putCall} expirations for {symbol}")
+        # the first of the closest, as get_working_days picks
+        return (df, unique_days[np.argmin(np.abs(unique_days - days))])
+
+    def candidates(self, symbol, putCall="PUT", days=None, sell_range=None, buy_range=None, top_k=SERVICE_TOP_K,
+                   rank_by="e_w", filters=None):
+        if top_k is not None and top_k < 0:
+            raise QueryError(f"top_k should be 0 (every candidate) or more, got: {top_k}")
+        if rank_by not in RANK_COLUMNS:
+            raise QueryError(f"can't rank candidates by: {rank_by}, expected one of {list(RANK_COLUMNS)}")
+        try:
+            filters = check_filters(filters)
+        except ValueError as e:
+            raise QueryError(str(e))
+        unknown = [f[0] for f in filters if f[0] not in FILTER_COLUMNS]
+        if unknown:
+            raise QueryError(f"can't filter candidates on: {unknown}, expected one of {list(FILTER_COLUMNS)}")
+        for column, op, value in filters:
+            if isinstance(value, str) and not column.endswith("description"):
+                raise QueryError(f"filter on {column} should be a number, got: {value}")
+        df, day = self.get_contracts(symbol, putCall, days=days)
+        if day is None:
+            day = "all"
+        return get_candidates(df, putCall=putCall.upper(), sell_range=sell_range, buy_range=buy_range,
+                              daysToExpiration=day, top_k=top_k or None, rank_by=rank_by, filters=filters)
+
+
+def _get_param(params, name, default=None):
+    values = params.get(name)
+    if not values:
+        return default
+    return values[-1]
+
+
+def _get_number(params, name, default=None, kind=float):
+    value = _get_param(params, name)
+    if value is None:
+        return default
+    try:
+        return kind(value)
+    except ValueError:
+        raise QueryError(f"{name} should be a number, got: {value}")
+
+
+def _get_range(params, name):
+    # "low,high" as a tuple of floats
+    value = _get_param(params, name)
+    if value is None:
+        return None
+    fields = value.split(",")
+    try:
+        if len(fields) == 2:
+            return (float(fields[0]), float(fields[1]))
+    except ValueError:
+        pass
+    raise QueryError(f"{name} should be low,high, got: {value}")
+
+
+def _get_filters(params):
+    # filter=column<op>value parameters as (column, op, value) tuples
+    filters = []
+    for value in params.get("filter", []):
+        m = _filter_re.match(value)
+        if m is None:
+            raise QueryError(f"filter should be like mg>=0.5, got: {value}")
+        column, op, limit = m.groups()
+        try:
+            limit = float(limit)
+        except ValueError:
+            pass
+        filters.append((column, op, limit))
+    try:
+        return check_filters(filters)
+    except ValueError as e:
+        raise QueryError(str(e))
+
+
+def _get_meta(df):
+    meta = {}
+    for k in META_ATTRS:
+        v = df.attrs.get(k)
+        if isinstance(v, np.generic):
+            v = v.item()
+        meta[k] = v
+    meta["rows"] = len(df)
+    return meta
+
+
+def to_json(df, meta):
+    # {"meta", "columns", "data"} with NaN as null - to_json does the rows
+    # without building a python object for each value
+    rows = df.to_json(orient="values")
+    return f'{{"meta": {json.dumps(meta)}, "columns": {json.dumps([str(c) for c in df.columns])}, "data": {rows}}}'
+
+
+def to_arrow(df, meta):
+    # Arrow IPC stream of df, with meta in the schema metadata
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise QueryError("format=arrow needs pyarrow on the server")
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({"opchain": json.dumps(meta)})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    service = None  # set by serve()
+
+    def do_GET(self):
+        started = time.time()
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        try:
+            if url.path == "/symbols":
+                self._send(200, json.dumps(self.service.get_symbols()))
+            elif url.path == "/candidates":
+                self._send_frame(self._get_candidates(params), params)
+            elif url.path == "/contracts":
+                self._send_frame(self._get_contracts(params), params)
+            else:
+                self._send(404, json.dumps({"error": f"unknown path: {url.path}"}))
+        except QueryError as e:
+            self._send(400, json.dumps({"error": str(e)}))
+        except Exception as e:
+            logging.error(f"service, {self.path} failed: {e}")
+            self._send(500, json.dumps({"error": f"{type(e).__name__}: {e}"}))
+        logging.info(f"service, {self.path} took {(time.time() - started)*1000:.1f}ms")
+
+    def _get_symbol(self, params):
+        symbol = _get_param(params, "symbol")
+        if symbol is None:
+            raise QueryError("symbol is required")
+        return symbol
+
+    def _get_candidates(self, params):
+        candidates = self.service.candidates(self._get_symbol(params), putCall=_get_param(params, "putCall", "PUT"),
+                                             days=_get_number(params, "days"),
+                                             sell_range=_get_range(params, "sell"),
+                                             buy_range=_get_range(params, "buy"),
+                                             top_k=_get_number(params, "top_k", SERVICE_TOP_K, kind=int),
+                                             rank_by=_get_param(params, "rank_by", "e_w"),
+                                             filters=_get_filters(params))
+        if candidates is None:
+            raise QueryError("no candidates for that expiration and ranges")
+        return candidates
+
+    def _get_contracts(self, params):
+        df, day = self.service.get_contracts(self._get_symbol(params), _get_param(params, "putCall", "PUT"),
+                                             days=_get_number(params, "days"))
+        if day is not None:
+            df = df[df["daysToExpiration"].to_numpy() == day]
+        return df
+
+    def _send_frame(self, df, params):
+        meta = _get_meta(df)
+        if _get_param(params, "format", "json") == "arrow":
+            self._send(200, to_arrow(df, meta), content_type="application/vnd.apache.arrow.stream")
+        else:
+            self._send(200, to_json(df, meta))
+
+    def _send(self, code, body, content_type="application/json"):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"service, {self.address_string()} {format % args}")
+
+
+def serve(symbols=None, run_date=None, host=SERVICE_HOST, port=SERVICE_PORT, refresh=REFRESH_SECONDS):
+    # load the chains and answer queries until interrupted
+    service = ChainService(symbols=symbols, run_date=run_date, refresh=refresh)
+    started = time.time()
+    service.load_all()
+    loaded = len(service.get_symbols())
+    logging.info(f"service, loaded {loaded} of {len(service.symbols)} symbols in {time.time() - started:.2f}s")
+    handler = type("Handler", (ServiceHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    service.start()
+    logging.info(f"service, listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in ('-h', '--help'):
+        print("usage: python -m opchain.service [--rundate YYYY-MM-DD] [--port N] [--refresh SECONDS] [SYMBOL ...]")
+        sys.exit(0)
+    run_date = None
+    port = SERVICE_PORT
+    refresh = REFRESH_SECONDS
+    symbols = []
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg in ("--rundate", "--port", "--refresh") and not args:
+            print(f"{arg} needs a value")
+            sys.exit(1)
+        if arg == "--rundate":
+            run_date = args.pop(0)
+        elif arg == "--port":
+            port = int(args.pop(0))
+        elif arg == "--refresh":
+            refresh = float(args.pop(0))
+        else:
+            symbols.append(arg)
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    serve(symbols=symbols or None, run_date=run_date, port=port, refresh=refresh)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import logging
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from .chainindex import ChainIndex
+from .opchain import get_today
+from .opchain import clear_chain_cache
+from .opchain import _get_chainframes
+from .snapshot import SIDES
+
+# parsed chains for a universe of symbols in one shared memory block
+#
+# The parent loads each symbol once and packs the columns get_candidates
+# and the scan read into a multiprocessing.shared_memory block - each column
+# one array over every symbol's rows, ordered by symbol, side and
+# expiration - with a small index of row offsets by (symbol, side,
+# expiration) and each chain's attrs.  Pool workers attach by name and
+# build contracts frames on read only numpy views of the block, so the
+# universe is in memory once however many workers there are.  Only the
+# descriptions (stored as fixed width bytes) are decoded in the worker, for
+# the symbol being scanned.
+#
+#   chains = SharedChains.create(symbols, run_date)  # in the parent
+#   ... pass chains.name and chains.index to the workers
+#   chains = SharedChains.attach(name, index)  # in a worker
+#   df = chains.get_dataframe(symbol, putCall="PUT", daysToExpiration=45)
+#   chains.close(); chains.unlink()  # unlink in the parent once done
+
+# shared numeric columns, with putCall as a code into SIDES
+SHARED_COLUMNS = {"strikePrice": np.float64,
+                  "delta": np.float64,
+                  "mark": np.float64,
+                  "last": np.float64,
+                  "totalVolume": np.int64,
+                  "daysToExpiration": np.int64,
+                  "putCallCode": np.int8}
+SHARED_ATTRS = ("underlyingPrice", "volatility", "interestRate", "runDate", "symbol", "mmm")
+ALIGN = 64  # byte alignment of each column in the block
+
+
+def _get_columns(df, putCall):
+    # a side frame's shared columns, in expiration order
+    days = df["daysToExpiration"].to_numpy(dtype=np.int64)
+    # stable, so options keep their frame order within an expiration
+    order = np.argsort(days, kind="stable")
+    cols = {}
+    for name in SHARED_COLUMNS:
+        if name == "putCallCode":
+            cols[name] = np.full(len(df), SIDES.index(putCall), dtype=np.int8)
+        else:
+            values = pd.to_numeric(df[name], errors="coerce") if df[name].dtype == object else df[name]
+            cols[name] = values.to_numpy(dtype=SHARED_COLUMNS[name])[order]
+    cols["description"] = df["description"].astype(str).to_numpy()[order]
+    return cols
+
+
+def _get_expirations(days, offset):
+    # {days: [start, stop]} row ranges of sorted days, offset into the block
+    expirations = {}
+    if len(days) == 0:
+        return expirations
+    unique_days, starts = np.unique(days, return_index=True)
+    stops = list(starts[1:]) + [len(days)]
+    for day, start, stop in zip(unique_days, starts, stops):
+        expirations[int(day)] = [offset + int(start), offset + int(stop)]
+    return expirations
+
+
+class SharedChains:
+    def __init__(self, shm, index, owner=False):
+        self.shm = shm
+        self.index = index
+        self.owner = owner
+        self.name = shm.name
+        self.columns = {}
+        nrows = index["rows"]
+        for name, dtype, offset in index["layout"]:
+            array = np.ndarray((nrows,), dtype=dtype, buffer=shm.buf, offset=offset)
+            array.flags.writeable = owner
+            self.columns[name] = array
+
+    @classmethod
+    def create(cls, symbols, run_date=None):
+        # load each symbol's chain and pack them into a new block.  Symbols
+        # without data are left out (has() is False for them).
+        if run_date is None:
+            run_date = get_today()
+        parts = []
+        entries = {}
+        nrows = 0
+        width = 1
+        for symbol in symbols:
+            frames = _get_chainframes(symbol, run_date=run_date)
+            if not frames:
+                logging.warning(f"SharedChains, no data for {symbol}")
+                continue
+            entry = {"attrs": {}, "sides": {}, "expirations": {}}
+            for k in SHARED_ATTRS:
+                entry["attrs"][k] = frames["PUT"].attrs.get(k)
+            for putCall in SIDES:
+                cols = _get_columns(frames[putCall], putCall)
+                n = len(cols["strikePrice"])
+                entry["sides"][putCall] = [nrows, nrows + n]
+                entry["expirations"][putCall] = _get_expirations(cols["daysToExpiration"], nrows)
+                if n:
+                    width = max(width, max(len(desc.encode("utf-8")) for desc in cols["description"]))
+                parts.append(cols)
+                nrows += n
+            entries[symbol] = entry
+            # the block holds it now - don't keep the frames as well (or
+            # hand them to forked workers)
+            clear_chain_cache(symbol, run_date)
+
+        # one aligned array per column
+        layout = []
+        size = 0
+        dtypes = [(name, np.dtype(SHARED_COLUMNS[name])) for name in SHARED_COLUMNS]
+        dtypes.append(("description", np.dtype(f"S{width}")))
+        for name, dtype in dtypes:
+            size = (size + ALIGN - 1) // ALIGN * ALIGN
+            layout.append((name, dtype.str, size))
+            size += dtype.itemsize * nrows
+        index = {"runDate": run_date, "rows": nrows, "layout": layout, "symbols": entries}
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        chains = cls(shm, index, owner=True)
+        for name in chains.columns:
+            if nrows == 0:
+                continue
+            if name == "description":
+                values = np.concatenate([np.char.encode(part[name].astype(str), "utf-8") for part in parts])
+            else:
+                values = np.concatenate([part[name] for part in parts])
+            chains.columns[name][:] = values
+        logging.info(f"SharedChains, {len(entries)} symbols, {nrows} rows in {size} bytes: {shm.name}")
+        return chains
+
+    @classmethod
+    def attach(cls, name, index):
+        # the block created (by another process) as name, with its index
+        return cls(shared_memory.SharedMemory(name=name), index)
+
+    def has(self, symbol, run_date=None):
+        return symbol in self.index["symbols"] and (run_date is None or run_date == self.index["runDate"])
+
+    def get_dataframe(self, symbol, putCall="PUT", daysToExpiration=None):
+        # contracts frame for one side, like get_dataframe(symbol, putCall,
+        # daysToExpiration=...) but with just the shared columns.  Numeric
+        # columns are read only views of the block.
+        entry = self.index["symbols"][symbol]
+        putCall = putCall.upper()
+        start, stop = entry["sides"][putCall]
+        if daysToExpiration:
+            expirations = entry["expirations"][putCall]
+            if expirations:
+                # the first of the closest, as get_working_days picks
+                days = sorted(expirations.keys())
+                closest = days[int(np.argmin(np.abs(np.array(days) - daysToExpiration)))]
+                start, stop = expirations[closest]
+        data = {}
+        for name in SHARED_COLUMNS:
+            if name != "putCallCode":
+                data[name] = self.columns[name][start:stop]
+        data["description"] = np.char.decode(self.columns["description"][start:stop], "utf-8").astype(object)
+        data["putCall"] = pd.Categorical.from_codes(self.columns["putCallCode"][start:stop], categories=list(SIDES))
+        df = pd.DataFrame(data, copy=False)
+        for k in entry["attrs"]:
+            df.attrs[k] = entry["attrs"][k]
+        df.attrs["chainIndex"] = ChainIndex.from_frame(df)
+        return df
+
+    def close(self):
+        # drop the views before the block they point into
+        self.columns = {}
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
@@ -0,0 +1,83 @@
+import os
+import json
+import logging
+import zipfile
+import numpy as np
+
+# columnar snapshot of a parsed chain, written next to the raw json as
+# data/{symbol}/{symbol}-{run_date}.npz
+#
+# Each side's contract columns are stored as "{putCall}_{column}" arrays
+# (strings as fixed width unicode) and the chain level values (underlyingPrice,
+# volatility, interestRate, mmm map...) as a json string in "meta".  Members
+# are read lazily, so loading a subset of columns only reads those arrays.
+
+SNAPSHOT_VERSION = 1
+SIDES = ("PUT", "CALL")
+
+
+def get_snapshot_path(jsonpath):
+    return os.path.splitext(jsonpath)[0] + ".npz"
+
+
+def _to_array(values):
+    # numpy array for a frame column, or None if it can't be stored
+    # without pickling (e.g. numbers mixed with '' for missing values)
+    if values.dtype.kind == "i":
+        # compact frames use int16/int32 columns, store the usual int64
+        return values.to_numpy(dtype=np.int64)
+    if values.dtype.kind in "buf":
+        return values.to_numpy()
+    if len(values) == 0:
+        return np.zeros(0, dtype="U1")
+    for v in values:
+        if not isinstance(v, str):
+            return None
+    return values.to_numpy(dtype=str)
+
+
+def write_snapshot(filepath, frames, meta):
+    # frames is a dict of putCall -> contracts frame
+    arrays = {}
+    for putCall in frames:
+        df = frames[putCall]
+        for name in meta["columns"]:
+            arr = _to_array(df[name])
+            if arr is None:
+                logging.info(f"write_snapshot, can't store {putCall} column {name}, skipping snapshot")
+                return False
+            arrays[f"{putCall}_{name}"] = arr
+        meta["rows_" + putCall] = len(df)
+    meta["version"] = SNAPSHOT_VERSION
+    arrays["meta"] = np.array(json.dumps(meta))
+
+    # write to a temp file first so a reader never sees a partial snapshot
+    tmppath = f"{filepath}.{os.getpid()}.tmp"
+    with open(tmppath, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmppath, filepath)
+    logging.info(f"write_snapshot, saved {filepath}")
+    return True
+
+
+def read_snapshot(filepath, columns=None, sides=SIDES):
+    # returns (meta, {putCall: {column: array}}) or None if the file
+    # isn't a snapshot this version can read
+    try:
+        with np.load(filepath, allow_pickle=False) as npz:
+            meta = json.loads(str(npz["meta"]))
+            if meta.get("version") != SNAPSHOT_VERSION:
+                logging.info(f"read_snapshot, {filepath} version: {meta.get('version')}, ignoring")
+                return None
+            if columns is None:
+                columns = meta["columns"]
+            sidecols = {}
+            for putCall in sides:
+                cols = {}
+                for name in columns:
+                    cols[name] = npz[f"{putCall}_{name}"]
+                sidecols[putCall] = cols
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        logging.warning(f"read_snapshot, unable to read {filepath}: {e}")
+        return None
+    return (meta, sidecols)
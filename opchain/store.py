@@ -0,0 +1,343 @@
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+from .opchain import OPTION_PROPS
+from .opchain import get_chains_path
+from .opchain import clear_chain_cache
+from .opchain import _get_chainframes
+from .opchain import _save_snapshot
+from .opchain import _set_sideframe
+from .opchain import _get_snapshot_attrs
+from .snapshot import get_snapshot_path, read_snapshot, SIDES
+from . import metrics
+from . import opchain
+
+# historical chain store
+#
+# Each (symbol, run_date) snapshot in data/{symbol}/ is a partition, stored
+# as the columnar .npz get_dataframe writes (or, for a chain a snapshot
+# can't be written for, the json - slower to read, as it's parsed whole).  data/{symbol}/catalog.json
+# indexes them - for each run_date the underlying price and, per side and
+# expiration, the number of contracts and the strike range - so a query
+# over a year of dates only opens the partitions with matching expirations
+# and only reads the columns it asks for.
+#
+#   update_store(["TSLA"])  # add any new daily snapshots to the catalog
+#   df = query_history("TSLA", start="2021-01-01", putCall="PUT", daysToExpiration=45,
+#                      columns=["strikePrice", "delta", "mark"])
+#   for run_date, contracts in iter_history("TSLA", putCall="PUT", daysToExpiration=45):
+#       candidates = get_candidates(contracts)
+
+CATALOG_VERSION = 1
+CATALOG_NAME = "catalog.json"
+HISTORY_COLUMNS = ("runDate", "underlyingPrice")  # added to each query_history row
+
+
+def get_catalog_path(symbol):
+    return os.path.join(os.path.dirname(get_chains_path(symbol, "")), CATALOG_NAME)
+
+
+def _list_run_dates(symbol):
+    # run dates with a json chain or a snapshot in the symbol's directory
+    dirname, basename = os.path.split(get_chains_path(symbol, ""))
+    prefix = basename[:-len(".json")]
+    run_dates = set()
+    if not os.path.isdir(dirname):
+        return []
+    for filename in os.listdir(dirname):
+        if not filename.startswith(prefix):
+            continue
+        name, ext = os.path.splitext(filename)
+        # YYYY-MM-DD, not the scheduler's intraday YYYY-MM-DDTHHMMSS snapshots
+        if ext in (".json", ".npz") and len(name) == len(prefix) + len("YYYY-MM-DD"):
+            run_dates.add(name[len(prefix):])
+    run_dates = list(run_dates)
+    run_dates.sort()
+    return run_dates
+
+
+def read_catalog(symbol):
+    # {run_date: entry}, empty if there's no catalog (or it's an old version)
+    filepath = get_catalog_path(symbol)
+    if not os.path.isfile(filepath):
+        return {}
+    try:
+        with open(filepath, "r") as f:
+            catalog = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"read_catalog, unable to read {filepath}: {e}")
+        return {}
+    if catalog.get("version") != CATALOG_VERSION:
+        logging.info(f"read_catalog, {filepath} version: {catalog.get('version')}, ignoring")
+        return {}
+    return catalog["partitions"]
+
+
+def _write_catalog(symbol, partitions):
+    filepath = get_catalog_path(symbol)
+    catalog = {"version": CATALOG_VERSION, "symbol": symbol, "partitions": partitions}
+    tmppath = f"{filepath}.{os.getpid()}.tmp"
+    with open(tmppath, "w") as f:
+        json.dump(catalog, f, sort_keys=True)
+    os.replace(tmppath, filepath)
+
+
+def _get_partition_path(symbol, run_date):
+    # the file a partition is read from - the snapshot unless the json is newer
+    filepath = get_chains_path(symbol, run_date)
+    snappath = get_snapshot_path(filepath)
+    if os.path.isfile(snappath):
+        if not os.path.isfile(filepath) or os.path.getmtime(filepath) <= os.path.getmtime(snappath):
+            return snappath
+    return filepath
+
+
+def _get_partition(symbol, run_date):
+    # snapshot path for symbol and run_date, writing it from the json first
+    # if it's missing or out of date.  The json path if the snapshot can't
+    # be written, None if there's no data.
+    path = _get_partition_path(symbol, run_date)
+    if path.endswith(".npz"):
+        return path
+    if not os.path.isfile(path):
+        return None
+    frames = _read_json(symbol, run_date)
+    if not frames:
+        return None
+    if not opchain.USE_SNAPSHOTS:
+        _save_snapshot(get_snapshot_path(path), frames)
+    snappath = _get_partition_path(symbol, run_date)
+    if not snappath.endswith(".npz"):
+        logging.warning(f"update_store, unable to write a snapshot of {path}, reading the json instead")
+    return snappath
+
+
+def _read_json(symbol, run_date):
+    # parse the json (reload would fetch it again), without leaving a year
+    # of chains in the chain cache
+    clear_chain_cache(symbol, run_date)
+    frames = _get_chainframes(symbol, run_date=run_date)
+    clear_chain_cache(symbol, run_date)
+    return frames
+
+
+def _read_partition(path, columns=None, sides=SIDES):
+    # (attrs, {putCall: {column: array}}) of a partition's snapshot or json,
+    # None if it can't be read
+    if path.endswith(".npz"):
+        snapshot = read_snapshot(path, columns=columns, sides=sides)
+        if snapshot is None:
+            return None
+        meta, sidecols = snapshot
+        return (_get_snapshot_attrs(meta), sidecols)
+    symbol = os.path.basename(os.path.dirname(path))
+    run_date = os.path.basename(path)[len(symbol) + 1:-len(".json")]
+    frames = _read_json(symbol, run_date)
+    if not frames:
+        return None
+    if columns is None:
+        columns = OPTION_PROPS
+    sidecols = {}
+    for putCall in sides:
+        sidecols[putCall] = {name: frames[putCall][name].to_numpy() for name in columns}
+    attrs = {k: v for k, v in frames["PUT"].attrs.items() if k != "chainIndex"}
+    return (attrs, sidecols)
+
+
+def _get_entry(path):
+    # catalog entry for a partition - reads just the two columns it needs
+    partition = _read_partition(path, columns=["daysToExpiration", "strikePrice"])
+    if partition is None:
+        return None
+    attrs, sidecols = partition
+    entry = {}
+    entry["mtime"] = os.path.getmtime(path)
+    entry["underlyingPrice"] = attrs["underlyingPrice"]
+    for putCall in sidecols:
+        days = sidecols[putCall]["daysToExpiration"]
+        strikes = sidecols[putCall]["strikePrice"].astype(float)
+        expirations = {}
+        for day in np.unique(days):
+            day_strikes = strikes[days == day]
+            # json keys are strings
+            expirations[str(int(day))] = [int(len(day_strikes)), float(np.nanmin(day_strikes)),
+                                          float(np.nanmax(day_strikes))]
+        entry[putCall] = expirations
+    return entry
+
+
+def update_store(symbols, run_dates=None):
+    # add new or changed snapshots for each symbol to its catalog, parsing
+    # any json that doesn't have a snapshot yet.  Returns the number of
+    # partitions added or updated.
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    updated = 0
+    for symbol in symbols:
+        partitions = read_catalog(symbol)
+        changed = False
+        dates = _list_run_dates(symbol) if run_dates is None else run_dates
+        for run_date in dates:
+            with metrics.timer("load"):
+                path = _get_partition(symbol, run_date)
+            if path is None:
+                continue
+            entry = partitions.get(run_date)
+            if entry is not None and entry["mtime"] == os.path.getmtime(path):
+                continue
+            entry = _get_entry(path)
+            if entry is None:
+                logging.warning(f"update_store, unable to read {path}, not in the catalog")
+                continue
+            partitions[run_date] = entry
+            changed = True
+            updated += 1
+        # drop partitions whose files have gone
+        for run_date in list(partitions.keys()):
+            if not os.path.isfile(_get_partition_path(symbol, run_date)):
+                del partitions[run_date]
+                changed = True
+        if changed:
+            _write_catalog(symbol, partitions)
+            logging.info(f"update_store, {symbol} catalog has {len(partitions)} partitions")
+    return updated
+
+
+def get_catalog(symbol):
+    # the catalog as a frame, one row per run date, side and expiration
+    partitions = read_catalog(symbol)
+    rows = []
+    for run_date in sorted(partitions.keys()):
+        entry = partitions[run_date]
+        for putCall in SIDES:
+            expirations = entry.get(putCall, {})
+            for day in sorted(expirations.keys(), key=int):
+                count, min_strike, max_strike = expirations[day]
+                rows.append([run_date, putCall, int(day), count, min_strike, max_strike, entry["underlyingPrice"]])
+    columns = ["runDate", "putCall", "daysToExpiration", "contracts", "minStrike", "maxStrike", "underlyingPrice"]
+    return pd.DataFrame(rows, columns=columns)
+
+
+def _get_days(expirations, daysToExpiration):
+    # the catalog's expirations matching daysToExpiration - None for every
+    # expiration, a number for the closest one (as get_dataframe picks) or
+    # a list of days
+    days = [int(day) for day in expirations]
+    if daysToExpiration is None:
+        return days
+    if np.isscalar(daysToExpiration):
+        closest = None
+        for day in sorted(days):
+            if closest is None or abs(day - daysToExpiration) < abs(closest - daysToExpiration):
+                closest = day
+        return [] if closest is None else [closest]
+    wanted = set(daysToExpiration)
+    return [day for day in days if day in wanted]
+
+
+def _get_plan(symbol, start, end, putCall, daysToExpiration, strikes):
+    # [(run_date, path, {putCall: days})] for the partitions a query reads
+    partitions = read_catalog(symbol)
+    sides = SIDES if putCall is None else (putCall.upper(),)
+    plan = []
+    for run_date in sorted(partitions.keys()):
+        if (start is not None and run_date < start) or (end is not None and run_date > end):
+            continue
+        entry = partitions[run_date]
+        side_days = {}
+        for side in sides:
+            expirations = entry.get(side, {})
+            days = _get_days(expirations, daysToExpiration)
+            if strikes is not None:
+                # skip expirations whose strikes can't overlap the range
+                days = [day for day in days
+                        if expirations[str(day)][2] >= strikes[0] and expirations[str(day)][1] <= strikes[1]]
+            if days:
+                side_days[side] = days
+        if side_days:
+            plan.append((run_date, _get_partition_path(symbol, run_date), side_days))
+    return plan
+
+
+def _read_rows(path, side_days, columns, strikes):
+    # (attrs, {putCall: {column: array}}) of the rows for side_days, None if
+    # the partition can't be read
+    names = list(columns)
+    for name in ("daysToExpiration", "strikePrice"):
+        if name not in names:
+            names.append(name)
+    with metrics.timer("load"):
+        partition = _read_partition(path, columns=names, sides=list(side_days.keys()))
+    if partition is None:
+        return None
+    attrs, sidecols = partition
+    rows = {}
+    for side in sidecols:
+        cols = sidecols[side]
+        mask = np.isin(cols["daysToExpiration"], side_days[side])
+        if strikes is not None:
+            strike = cols["strikePrice"].astype(float)
+            mask &= (strike >= strikes[0]) & (strike <= strikes[1])
+        rows[side] = {name: cols[name][mask] for name in columns}
+    return (attrs, rows)
+
+
+def query_history(symbol, start=None, end=None, putCall=None, daysToExpiration=None, columns=None,
+                  strikes=None):
+    # contracts for symbol over run dates start..end (inclusive, "YYYY-MM-DD")
+    # as one frame, with a runDate and underlyingPrice column.  Only the
+    # partitions with a matching expiration are opened and only columns (a
+    # list of OPTION_PROPS, default all) are read.  daysToExpiration is a
+    # number for the closest expiration on each date, or a list of days.
+    # strikes is an optional (low, high) strike range.
+    if columns is None:
+        columns = list(OPTION_PROPS)
+    if not columns:
+        raise ValueError("query_history needs at least one column")
+    for name in columns:
+        if name not in OPTION_PROPS:
+            raise ValueError(f"unknown column: {name}, expected one of {list(OPTION_PROPS)}")
+    plan = _get_plan(symbol, start, end, putCall, daysToExpiration, strikes)
+    logging.info(f"query_history, {symbol} reading {len(plan)} partitions")
+    parts = {name: [] for name in list(HISTORY_COLUMNS) + list(columns)}
+    for run_date, path, side_days in plan:
+        result = _read_rows(path, side_days, columns, strikes)
+        if result is None:
+            continue
+        attrs, rows = result
+        for side in rows:
+            n = len(rows[side][columns[0]])
+            for name in columns:
+                parts[name].append(rows[side][name])
+            parts["runDate"].append(np.full(n, run_date, dtype=object))
+            parts["underlyingPrice"].append(np.full(n, attrs["underlyingPrice"], dtype=float))
+    started = metrics.start()
+    data = {}
+    for name in parts:
+        if parts[name]:
+            data[name] = np.concatenate(parts[name])
+        else:
+            data[name] = []
+    df = pd.DataFrame(data, columns=list(parts.keys()))
+    metrics.stop("parse", started)
+    return df
+
+
+def iter_history(symbol, start=None, end=None, putCall="PUT", daysToExpiration=None):
+    # (run_date, contracts) for each run date, where contracts has the rows,
+    # columns and attrs get_dataframe(symbol, putCall, run_date,
+    # daysToExpiration) returns, built from just that expiration's rows
+    putCall = putCall.upper()
+    plan = _get_plan(symbol, start, end, putCall, daysToExpiration, None)
+    for run_date, path, side_days in plan:
+        result = _read_rows(path, side_days, OPTION_PROPS, None)
+        if result is None:
+            continue
+        attrs, rows = result
+        started = metrics.start()
+        df = pd.DataFrame(rows[putCall], columns=OPTION_PROPS)
+        _set_sideframe(df, attrs)
+        metrics.stop("parse", started)
+        yield (run_date, df)
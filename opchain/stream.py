@@ -0,0 +1,202 @@
+import re
+import json
+import codecs
+from json.decoder import scanstring
+
+# incremental reader for td ameritrade chain json
+#
+# json.load builds the whole nested payload - every quote field of every
+# option - before any of it is used.  iter_chain() walks the payload from a
+# file (or an http response) a buffer at a time and hands back each
+# expiration's strike map as soon as it's decoded, so only one expiration's
+# options are held as python objects at once.  Sides and expirations that
+# aren't wanted are skipped over without being decoded.
+#
+#   for event in iter_chain(f, sides=("PUT",), days={45}):
+#       ("value", key, value) for each top level value (underlyingPrice...)
+#       ("expiration", putCall, expDate, bundle) for each expiration, bundle
+#       being its {strike: [options]} map
+
+READ_SIZE = 1 << 20  # characters per read, a few expirations
+MAP_KEYS = {"putExpDateMap": "PUT", "callExpDateMap": "CALL"}
+
+_ws = re.compile(r"[ \t\n\r]*")
+_plain = re.compile(r'[^"{}\[\]]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"{}\[\]]*)*')  # up to the next bracket outside a string
+_delim = re.compile(r'[,}\]\s]')  # ends a number or literal
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    # a text buffer over fp that only keeps what hasn't been consumed yet
+    def __init__(self, fp, read_size=READ_SIZE):
+        self.fp = fp
+        self.read_size = read_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self._decode = codecs.getincrementaldecoder("utf-8")().decode
+
+    def _fill(self):
+        # append the next read to buf, False at the end of the file
+        if self.eof:
+            return False
+        data = self.fp.read(self.read_size)
+        if isinstance(data, bytes):
+            data = self._decode(data, final=not data)
+        if not data:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _error(self, msg):
+        return ValueError(f"chain json, {msg} at: {self.buf[self.pos:self.pos + 40]!r}")
+
+    def peek(self):
+        # next non whitespace character, "" at the end of the file
+        while True:
+            self.pos = _ws.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, ch):
+        if self.peek() != ch:
+            raise self._error(f"expected {ch!r}")
+        self.pos += 1
+
+    def string(self):
+        if self.peek() != '"':
+            raise self._error("expected a string")
+        while True:
+            try:
+                value, end = scanstring(self.buf, self.pos + 1)
+            except ValueError:
+                # unterminated - read more unless there isn't any
+                if not self._fill():
+                    raise self._error("unterminated string")
+                continue
+            self.pos = end
+            return value
+
+    def value(self):
+        # decode the next value, reading more until it's complete
+        if self.peek() not in '{["':
+            # a number (or literal) may carry on in the next read
+            while _delim.search(self.buf, self.pos) is None and self._fill():
+                pass
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise self._error("bad value")
+                continue
+            self.pos = end
+            return value
+
+    def skip(self):
+        # step over the next value without decoding it
+        ch = self.peek()
+        if ch not in "{[":
+            if ch == '"':
+                self.string()
+            else:
+                self.value()
+            return
+        depth = 0
+        while True:
+            self.pos = _plain.match(self.buf, self.pos).end()
+            if self.pos >= len(self.buf):
+                if not self._fill():
+                    raise self._error("unexpected end")
+                continue
+            ch = self.buf[self.pos]
+            if ch == '"':
+                # a string that carries on in the next read
+                if not self._fill():
+                    raise self._error("unterminated string")
+                continue
+            self.pos += 1
+            if ch in "{[":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def keys(self):
+        # each key of an object - the caller reads (or skips) its value
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.string()
+            self.expect(":")
+            yield key
+            ch = self.peek()
+            self.pos += 1
+            if ch == "}":
+                return
+            if ch != ",":
+                self.pos -= 1
+                raise self._error("expected ',' or '}'")
+
+
+class TeeReader:
+    # file-like wrapper that copies everything read to another file, so a
+    # response can be decoded and saved in the same pass
+    def __init__(self, fp, copy):
+        self.fp = fp
+        self.copy = copy
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        if self.copy is not None and data:
+            self.copy.write(data)
+        return data
+
+
+def get_expdate_days(expDate):
+    # "2021-04-01:45" -> 45, or None if the key isn't in that form
+    fields = expDate.split(":")
+    if len(fields) != 2:
+        return None
+    try:
+        return int(fields[1])
+    except ValueError:
+        return None
+
+
+def get_chain_values(fp, read_size=READ_SIZE):
+    # the top level values ahead of the first expiration map (the symbol,
+    # status, underlyingPrice... for td ameritrade) without reading the rest
+    reader = _Reader(fp, read_size=read_size)
+    values = {}
+    for key in reader.keys():
+        if key in MAP_KEYS:
+            break
+        values[key] = reader.value()
+    return values
+
+
+def iter_chain(fp, sides=None, days=None, read_size=READ_SIZE):
+    # events for a chain payload read from fp (text or binary) - see above.
+    # sides is a list of "PUT"/"CALL" and days a set of daysToExpiration to
+    # decode, None for all of them.
+    reader = _Reader(fp, read_size=read_size)
+    for key in reader.keys():
+        putCall = MAP_KEYS.get(key)
+        if putCall is None:
+            yield ("value", key, reader.value())
+            continue
+        if sides is not None and putCall not in sides:
+            reader.skip()
+            continue
+        for expDate in reader.keys():
+            if days is not None and get_expdate_days(expDate) not in days:
+                reader.skip()
+                continue
+            yield ("expiration", putCall, expDate, reader.value())
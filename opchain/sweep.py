@@ -0,0 +1,266 @@
+import logging
+import itertools
+import traceback
+import numpy as np
+import pandas as pd
+from .filters import check_filters, split_filters, passes, DAY_COLUMNS
+from .opchain import get_dataframe
+from .opchain import _get_legs
+from .opchain import _get_pairs
+from .opchain import _get_top_k
+from .opchain import _check_index
+from .opchain import LEG_COLUMNS
+from .opchain import SPREAD_COLUMNS
+from .opchain import DERIVED_COLUMNS
+from .opchain import USE_PRICE
+from .scan import get_pool
+from . import metrics
+from . import opchain
+
+# get_candidates parameter sweep
+#
+# Tries every combination of sell delta range, buy delta range and minimum
+# width on the same chain.  The pairs and their metrics (e, e_w, pop...)
+# don't depend on those settings - only which pairs are kept does - so the
+# pairs are built once for the union of the ranges and the smallest width,
+# and each configuration is a mask over them.  Each configuration's pairs
+# and top spreads are the same get_candidates would give with those
+# settings (sell_range, buy_range and MIN_WIDTH).  Settings left out of the
+# grid default to the current get_candidates ones.
+#
+#   summary, top = sweep_candidates(df, sell_ranges=[(0.05, 0.12), (0.05, 0.15)],
+#                                   buy_ranges=[(0.009, 0.12)], min_widths=[10.0, 25.0])
+#   summary, top = sweep_symbols(symbols, putCall="CALL", min_widths=[10.0, 25.0], workers=4)
+#
+# summary has a row per symbol, expiration and configuration with its
+# number of pairs and stats of rank_by, pop, mg and width; top has the
+# top_k spreads of each, tagged with the configuration.
+
+SWEEP_TOP_K = 10
+CONFIG_COLUMNS = ["config", "sell_low", "sell_high", "buy_low", "buy_high", "min_width"]
+
+
+def _get_ranges(ranges, default):
+    # a list of (low, high) ranges - a single range can be given as is
+    if ranges is None:
+        return [tuple(default)]
+    ranges = list(ranges)
+    if len(ranges) == 2 and np.isscalar(ranges[0]) and np.isscalar(ranges[1]):
+        ranges = [ranges]
+    for r in ranges:
+        if len(r) != 2 or r[0] > r[1]:
+            raise ValueError(f"expected (low, high) delta range, got: {r}")
+    return [tuple(r) for r in ranges]
+
+
+def get_grid(putCall, sell_ranges=None, buy_ranges=None, min_widths=None):
+    # every (sell_range, buy_range, min_width) combination, defaulting each
+    # to the current get_candidates setting for putCall (read now, so a
+    # changed opchain.opchain.MIN_WIDTH is the default)
+    if putCall == "PUT":
+        sell_ranges = _get_ranges(sell_ranges, opchain.PSR_PS_DELTA_RANGE)
+        buy_ranges = _get_ranges(buy_ranges, opchain.PSR_PB_DELTA_RANGE)
+    else:
+        sell_ranges = _get_ranges(sell_ranges, opchain.CSR_CS_DELTA_RANGE)
+        buy_ranges = _get_ranges(buy_ranges, opchain.CSR_CB_DELTA_RANGE)
+    if min_widths is None:
+        min_widths = [opchain.MIN_WIDTH]
+    elif np.isscalar(min_widths):
+        min_widths = [min_widths]
+    return list(itertools.product(sell_ranges, buy_ranges, [float(w) for w in min_widths]))
+
+
+def _in_range(values, low, high, inclusive):
+    # the ChainIndex.delta_range test
+    if inclusive:
+        return (values >= low) & (values <= high)
+    return (values > low) & (values < high)
+
+
+def _get_masks(pairs, grid):
+    # a mask over pairs for each configuration in grid.  Each distinct range
+    # or width is only compared once.
+    s_delta = np.abs(pairs["s_delta"].astype(float))
+    b_delta = np.abs(pairs["b_delta"].astype(float))
+    width = pairs["width"]
+    sell_masks = {}
+    buy_masks = {}
+    width_masks = {}
+    masks = []
+    for sell_range, buy_range, min_width in grid:
+        if sell_range not in sell_masks:
+            # sell legs are picked with inclusive=False, buy legs inclusive
+            sell_masks[sell_range] = _in_range(s_delta, sell_range[0], sell_range[1], False)
+        if buy_range not in buy_masks:
+            buy_masks[buy_range] = _in_range(b_delta, buy_range[0], buy_range[1], True)
+        if min_width not in width_masks:
+            width_masks[min_width] = ~(width < min_width)
+        masks.append(sell_masks[sell_range] & buy_masks[buy_range] & width_masks[min_width])
+    return masks
+
+
+def _get_summary(values, top, rank_by):
+    # stats of one configuration's pairs (values) and top pairs
+    n = len(values["e"])
+    summary = {"pairs": n}
+    if n == 0:
+        for name in (f"{rank_by}_max", f"{rank_by}_top_mean", f"{rank_by}_median", "pop_mean", "mg_mean",
+                     "width_mean"):
+            summary[name] = np.nan
+        return summary
+    ranked = values[rank_by].astype(float)
+    summary[f"{rank_by}_max"] = np.nanmax(ranked) if not np.isnan(ranked).all() else np.nan
+    summary[f"{rank_by}_top_mean"] = np.nanmean(ranked[top]) if not np.isnan(ranked[top]).all() else np.nan
+    summary[f"{rank_by}_median"] = np.nanmedian(ranked) if not np.isnan(ranked).all() else np.nan
+    summary["pop_mean"] = np.mean(values["pop"])
+    summary["mg_mean"] = np.mean(values["mg"])
+    summary["width_mean"] = np.mean(values["width"])
+    return summary
+
+
+def sweep_candidates(contracts, sell_ranges=None, buy_ranges=None, min_widths=None, putCall=None,
+                     daysToExpiration=None, top_k=SWEEP_TOP_K, rank_by="e_w", filters=None):
+    # (summary, top) frames for every configuration of the grid (see above)
+    # on one side of a chain.  daysToExpiration is a day, a list of days or
+    # "all" (the default), filters as for get_candidates (other than the
+    # delta ranges and width they're the same for every configuration).
+    if len(contracts) == 0:
+        logging.warning("no contracts")
+        return (None, None)
+    if putCall is None:
+        unique_putCalls = list(set(list(contracts['putCall'].values)))
+        if len(unique_putCalls) != 1:
+            raise ValueError("putCall should be either PUT or CALL")
+        putCall = unique_putCalls[0]
+    putCall = putCall.upper()
+    if putCall not in ("PUT", "CALL"):
+        raise ValueError("putCall should be either PUT or CALL")
+    grid = get_grid(putCall, sell_ranges=sell_ranges, buy_ranges=buy_ranges, min_widths=min_widths)
+
+    side = (contracts['putCall'] == putCall).to_numpy()
+    all_days = contracts['daysToExpiration'].to_numpy()
+    if daysToExpiration is None or isinstance(daysToExpiration, str):
+        if daysToExpiration not in (None, "all"):
+            raise ValueError(f"unexpected daysToExpiration: {daysToExpiration}")
+        day_list = sorted(set(list(all_days[side])))
+    elif np.isscalar(daysToExpiration):
+        day_list = [daysToExpiration]
+    else:
+        day_list = sorted(set(daysToExpiration))
+
+    filters = check_filters(filters)
+    day_filters, filters = split_filters(filters, DAY_COLUMNS)
+    leg_columns = ["s_" + name for name in LEG_COLUMNS] + ["b_" + name for name in LEG_COLUMNS]
+    leg_filters, filters = split_filters(filters, leg_columns)
+    pair_filters, filters = split_filters(filters, SPREAD_COLUMNS + DERIVED_COLUMNS)
+    if filters:
+        raise ValueError(f"can't filter candidates on: {[f[0] for f in filters]}")
+    day_list = [day for day in day_list if passes(day, day_filters)]
+
+    # the union of the grid's ranges, and its smallest width
+    sell_range = (min(g[0][0] for g in grid), max(g[0][1] for g in grid))
+    buy_range = (min(g[1][0] for g in grid), max(g[1][1] for g in grid))
+    min_width = min(g[2] for g in grid)
+
+    cols = {}
+    for name in set(LEG_COLUMNS) | {USE_PRICE}:
+        cols[name] = contracts[name].to_numpy()
+    index = contracts.attrs.get("chainIndex")
+    summary_rows = []
+    top_parts = []
+    for day in day_list:
+        pos = np.flatnonzero(side & (all_days == day))
+        index = _check_index(index, contracts, cols, putCall, day, pos)
+        pairs = None
+        legs = _get_legs(contracts, cols, pos, index, putCall, day, buy_range, sell_range, leg_filters=leg_filters)
+        if legs is not None:
+            buy_pos, sell_pos = legs
+            pairs = _get_pairs(cols, buy_pos, sell_pos, putCall=putCall, index=index, daysToExpiration=day,
+                               filters=pair_filters, min_width=min_width)
+            del pairs["s_pos"], pairs["b_pos"]
+        if pairs is None or len(pairs["e"]) == 0:
+            masks = [None] * len(grid)
+        else:
+            masks = _get_masks(pairs, grid)
+        metrics.count("sweep_configs", len(grid))
+
+        with metrics.timer("sweep"):
+            for i in range(len(grid)):
+                (sell_low, sell_high), (buy_low, buy_high), width = grid[i]
+                config = {"config": i, "sell_low": sell_low, "sell_high": sell_high, "buy_low": buy_low,
+                          "buy_high": buy_high, "min_width": width}
+                if masks[i] is None:
+                    values = {"e": np.zeros(0)}
+                    top = np.zeros(0, dtype=np.intp)
+                else:
+                    values = {}
+                    for name in pairs:
+                        values[name] = pairs[name][masks[i]]
+                    top = _get_top_k(values[rank_by], top_k)
+                row = {"putCall": putCall, "daysToExpiration": day}
+                row.update(config)
+                row.update(_get_summary(values, top, rank_by))
+                summary_rows.append(row)
+                if len(top):
+                    part = {}
+                    for name in CONFIG_COLUMNS:
+                        part[name] = np.full(len(top), config[name])
+                    part["daysToExpiration"] = np.full(len(top), day)
+                    part["rank"] = np.arange(1, len(top) + 1)
+                    for name in values:
+                        part[name] = values[name][top]
+                    top_parts.append(pd.DataFrame(part))
+
+    summary = pd.DataFrame(summary_rows)
+    if top_parts:
+        top = pd.concat(top_parts, ignore_index=True)
+    else:
+        top = pd.DataFrame([], columns=CONFIG_COLUMNS + ["daysToExpiration", "rank"])
+    for df in (summary, top):
+        for k in ("symbol", "underlyingPrice", "runDate"):
+            if k in contracts.attrs:
+                df.attrs[k] = contracts.attrs[k]
+        df.attrs["putCall"] = putCall
+    return (summary, top)
+
+
+def sweep_symbol(symbol, putCall="PUT", sell_ranges=None, buy_ranges=None, min_widths=None, run_date=None,
+                 exp_days=None, top_k=SWEEP_TOP_K, rank_by="e_w", filters=None):
+    # sweep_candidates for one symbol's chain, with a symbol column.
+    # Returns (None, None) if there's no data or the sweep fails.
+    try:
+        df = get_dataframe(symbol, putCall=putCall, run_date=run_date, daysToExpiration=exp_days)
+        if df is None or len(df) == 0:
+            logging.warning(f"sweep_symbol, no data for {symbol}")
+            return (None, None)
+        summary, top = sweep_candidates(df, sell_ranges=sell_ranges, buy_ranges=buy_ranges, min_widths=min_widths,
+                                        putCall=putCall, top_k=top_k, rank_by=rank_by, filters=filters)
+    except Exception:
+        logging.error(f"sweep_symbol {symbol} failed: {traceback.format_exc()}")
+        return (None, None)
+    if summary is None:
+        return (None, None)
+    summary.insert(0, "symbol", symbol)
+    top.insert(0, "symbol", symbol)
+    return (summary, top)
+
+
+def sweep_symbols(symbols, putCall="PUT", sell_ranges=None, buy_ranges=None, min_widths=None, run_date=None,
+                  exp_days=None, top_k=SWEEP_TOP_K, rank_by="e_w", filters=None, workers=1):
+    # sweep_symbol() over a universe, as one (summary, top) in symbol order.
+    # With workers > 1 the symbols are spread over a scan process pool.
+    n = len(symbols)
+    args = (symbols, [putCall]*n, [sell_ranges]*n, [buy_ranges]*n, [min_widths]*n, [run_date]*n, [exp_days]*n,
+            [top_k]*n, [rank_by]*n, [filters]*n)
+    if workers is None or workers <= 1 or n <= 1:
+        results = list(map(sweep_symbol, *args))
+    else:
+        with get_pool(workers) as executor:
+            results = list(executor.map(sweep_symbol, *args, chunksize=1))
+    summaries = [summary for summary, top in results if summary is not None]
+    tops = [top for summary, top in results if top is not None and len(top)]
+    if not summaries:
+        return (None, None)
+    summary = pd.concat(summaries, ignore_index=True)
+    top = pd.concat(tops, ignore_index=True) if tops else pd.DataFrame([], columns=["symbol"] + CONFIG_COLUMNS)
+    return (summary, top)
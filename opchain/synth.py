@@ -0,0 +1,133 @@
+import math
+import random
+from datetime import datetime, timedelta
+
+# synthetic TD Ameritrade style option chains for benchmarks - same layout
+# as the json get_chains saves, with black-scholes marks and deltas
+
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def _ncdf(x):
+    return 0.5 * (1.0 + math.erf(x / math.sqrt(2.0)))
+
+
+def _bs(putCall, s, k, t, vol, r):
+    if t <= 0:
+        t = 1.0 / 365
+    d1 = (math.log(s / k) + (r + 0.5 * vol * vol) * t) / (vol * math.sqrt(t))
+    d2 = d1 - vol * math.sqrt(t)
+    if putCall == "CALL":
+        price = s * _ncdf(d1) - k * math.exp(-r * t) * _ncdf(d2)
+        delta = _ncdf(d1)
+    else:
+        price = k * math.exp(-r * t) * _ncdf(-d2) - s * _ncdf(-d1)
+        delta = _ncdf(d1) - 1.0
+    return max(price, 0.0), delta
+
+
+def make_chains(symbol="SYN", underlying=1000.0, expirations=8, strikes=100, step=None,
+                missing=0.02, pm=0.0, seed=0, run_date="2021-04-01", first_days=3, day_step=7):
+    rnd = random.Random(seed)
+    if step is None:
+        step = max(1.0, round(underlying * 0.005))
+    vol = 0.3
+    r = 0.01
+    dt0 = datetime.strptime(run_date, "%Y-%m-%d")
+    root = symbol.strip("$").split(".")[0]
+    chains = {"symbol": symbol, "status": "SUCCESS", "underlying": None, "strategy": "ANALYTICAL",
+              "interval": 0.0, "isDelayed": True, "isIndex": False, "interestRate": r,
+              "underlyingPrice": underlying, "volatility": vol * 100, "daysToExpiration": 0.0,
+              "numberOfContracts": 0, "putExpDateMap": {}, "callExpDateMap": {}}
+    lo = underlying - step * (strikes // 2)
+    count = 0
+    for e in range(expirations):
+        days = first_days + e * day_step
+        exp = dt0 + timedelta(days=days)
+        exp_key = f"{exp.year}-{exp.month:02d}-{exp.day:02d}:{days}"
+        t = days / 365.0
+        for putCall, map_name in (("PUT", "putExpDateMap"), ("CALL", "callExpDateMap")):
+            bundle = {}
+            for i in range(strikes):
+                strike = lo + i * step
+                if strike <= 0:
+                    continue
+                price, delta = _bs(putCall, underlying, strike, t, vol * (1 + rnd.uniform(-0.05, 0.05)), r)
+                mark = round(price, 2)
+                spread = max(0.05, round(mark * 0.04, 2))
+                delta = round(delta, 3)
+                if rnd.random() < missing:
+                    delta = -999.0
+                kind = "Put" if putCall == "PUT" else "Call"
+                strike_str = f"{strike:g}"
+                desc = f"{root} {MONTHS[exp.month - 1]} {exp.day} {exp.year} {strike_str} {kind}"
+                option = _make_option(putCall, root, exp, days, strike, desc, mark, spread, delta, rnd)
+                options = [option]
+                if pm and rnd.random() < pm:
+                    pm_option = dict(option)
+                    pm_option["description"] = desc + " (PM)"
+                    pm_option["symbol"] = option["symbol"].replace(root, root + "W", 1)
+                    pm_option["settlementType"] = "P"
+                    pm_option["mark"] = round(mark * 1.01, 2)
+                    options.append(pm_option)
+                bundle[f"{strike:.1f}"] = options
+                count += len(options)
+            chains[map_name][exp_key] = bundle
+    chains["numberOfContracts"] = count
+    return chains
+
+
+def _make_option(putCall, root, exp, days, strike, desc, mark, spread, delta, rnd):
+    bid = max(0.0, round(mark - spread / 2, 2))
+    ask = round(mark + spread / 2, 2)
+    flag = "P" if putCall == "PUT" else "C"
+    option = {
+        "putCall": putCall,
+        "symbol": f"{root}_{exp.month:02d}{exp.day:02d}{exp.year % 100:02d}{flag}{strike:g}",
+        "description": desc,
+        "exchangeName": "OPR",
+        "bid": bid,
+        "ask": ask,
+        "last": round(mark * rnd.uniform(0.9, 1.1), 2),
+        "mark": mark,
+        "bidSize": rnd.randint(1, 50),
+        "askSize": rnd.randint(1, 50),
+        "bidAskSize": f"{rnd.randint(1, 50)}X{rnd.randint(1, 50)}",
+        "lastSize": 0,
+        "highPrice": 0.0,
+        "lowPrice": 0.0,
+        "openPrice": 0.0,
+        "closePrice": mark,
+        "totalVolume": rnd.randint(0, 5000),
+        "tradeDate": None,
+        "tradeTimeInLong": 1617307200000,
+        "quoteTimeInLong": 1617307200000,
+        "netChange": 0.0,
+        "volatility": 30.0,
+        "delta": delta,
+        "gamma": 0.001,
+        "theta": -0.1,
+        "vega": 0.2,
+        "rho": 0.01,
+        "openInterest": rnd.randint(0, 20000),
+        "timeValue": mark,
+        "theoreticalOptionValue": mark,
+        "theoreticalVolatility": 29.0,
+        "optionDeliverablesList": None,
+        "strikePrice": strike,
+        "expirationDate": int(exp.timestamp() * 1000),
+        "daysToExpiration": days,
+        "expirationType": "R",
+        "lastTradingDay": int(exp.timestamp() * 1000),
+        "multiplier": 100.0,
+        "settlementType": " ",
+        "deliverableNote": "",
+        "isIndexOption": None,
+        "percentChange": 0.0,
+        "markChange": 0.0,
+        "markPercentChange": 0.0,
+        "nonStandard": False,
+        "inTheMoney": False,
+        "mini": False,
+    }
+    return option
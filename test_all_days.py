@@ -0,0 +1,32 @@
+import pandas as pd
+import pytest
+import opchain.opchain as oc
+from opchain.opchain import get_candidates, get_dataframe
+
+# get_candidates over many expirations in one call against one call per day
+
+
+@pytest.mark.parametrize("putCall", ["PUT", "CALL"])
+@pytest.mark.parametrize("top_k", [None, 7])
+def test_all_days_match_single_days(write_chains, monkeypatch, putCall, top_k):
+    write_chains("SYN", expirations=4, strikes=80, seed=5)
+    monkeypatch.setattr(oc, "MIN_WIDTH", 5.0)
+    contracts = get_dataframe("SYN", putCall=putCall, run_date="2021-04-01")
+    days = sorted(contracts.daysToExpiration.unique())
+    both = get_candidates(contracts, daysToExpiration="all", top_k=top_k)
+    assert list(both.daysToExpiration) == sorted(both.daysToExpiration)
+    assert both.attrs["daysToExpiration"] == days
+    parts = []
+    for day in days:
+        # single days ranked the way the multi day frame is (by _get_top_k)
+        single = get_candidates(contracts, daysToExpiration=day, top_k=10**9 if top_k is None else top_k)
+        if single is not None:
+            single["daysToExpiration"] = day
+            parts.append(single)
+    want = pd.concat(parts, ignore_index=True)
+    got = both.reset_index(drop=True)
+    pd.testing.assert_frame_equal(got, want[got.columns], check_dtype=False)
+    # and a list of days is the same as "all" of them
+    some = get_candidates(contracts, daysToExpiration=days[1:], top_k=top_k)
+    rest = got[got.daysToExpiration != days[0]]
+    pd.testing.assert_frame_equal(some.reset_index(drop=True), rest.reset_index(drop=True))
@@ -0,0 +1,32 @@
+import os
+import opchain.opchain as oc
+from opchain.opchain import get_dataframe
+
+# the parsed chain cache against chains saved again by another process
+
+
+def test_cache_reloads_newer_json(write_chains):
+    write_chains("SYN", expirations=2, strikes=40, seed=18)
+    first = get_dataframe("SYN", putCall="PUT", run_date="2021-04-01")
+    assert get_dataframe("SYN", putCall="PUT", run_date="2021-04-01")["mark"].tolist() == first["mark"].tolist()
+    # as another process would save it, without clear_chain_cache
+    chains = write_chains("SYN", expirations=2, strikes=40, seed=19)
+    filepath = oc.get_chains_path("SYN", "2021-04-01")
+    mtime = os.path.getmtime(filepath) + 10
+    os.utime(filepath, (mtime, mtime))
+    got = get_dataframe("SYN", putCall="PUT", run_date="2021-04-01")
+    assert got["mark"].tolist() == oc._get_sideframe(chains, "PUT")["mark"].tolist()
+    assert got["mark"].tolist() != first["mark"].tolist()
+    assert len(oc._chain_cache) == 1
+
+
+def test_cache_counts_attrs(write_chains):
+    write_chains("SYN", expirations=3, strikes=60, seed=20)
+    get_dataframe("SYN", putCall="PUT", run_date="2021-04-01")
+    frames = oc._chain_cache.get(("SYN", "2021-04-01"))
+    nbytes = 0
+    for putCall in frames:
+        nbytes += int(frames[putCall].memory_usage(deep=True).sum())
+        assert frames[putCall].attrs["chainIndex"].nbytes > 0
+        nbytes += frames[putCall].attrs["chainIndex"].nbytes
+    assert oc._chain_cache.nbytes > nbytes
@@ -0,0 +1,24 @@
+import pandas as pd
+import pytest
+from opchain.opchain import get_candidates, get_dataframe
+
+# a chainIndex carried over to an edited copy of the contracts isn't used
+
+
+@pytest.mark.parametrize("name", ["strikePrice", "delta", "mark"])
+def test_edited_copy_rebuilds_index(write_chains, name):
+    write_chains("SYN", expirations=2, strikes=80, seed=15)
+    contracts = get_dataframe("SYN", putCall="PUT", run_date="2021-04-01", daysToExpiration=10)
+    copy = contracts.copy()
+    assert copy.attrs["chainIndex"] is contracts.attrs["chainIndex"]
+    col = copy.columns.get_loc(name)
+    for i in range(0, len(copy), 3):
+        copy.iloc[i, col] = copy.iloc[i, col] * 1.05
+    fresh = copy.copy()
+    fresh.attrs.pop("chainIndex")
+    want = get_candidates(fresh)
+    pd.testing.assert_frame_equal(get_candidates(copy), want)
+    # the index matches the rows it was built from, not the edited ones
+    assert not contracts.attrs["chainIndex"].matches("PUT", 10, copy.index, copy.strikePrice, copy.delta, copy.mark)
+    assert contracts.attrs["chainIndex"].matches("PUT", 10, contracts.index, contracts.strikePrice, contracts.delta,
+                                                 contracts.mark)
@@ -0,0 +1,96 @@
+import logging
+import numpy as np
+import pytest
+import opchain.opchain as oc
+from opchain.opchain import get_candidates, get_dataframe
+from opchain.condor import get_condors
+
+# get_condors' pruned heap against pairing every put spread with every call spread
+
+BOUNDS = [{}, {"min_credit": 1.0}, {"max_loss": 15.0, "min_pop": 70.0}, {"min_e_w": -5.0}]
+
+
+def brute_force(puts, calls, day, top_k, min_credit=None, max_loss=None, min_e_w=None, min_pop=None):
+    # (put rows, call rows, e_w, pop) of the best top_k condors, ties in put
+    # then call order
+    p, c = np.meshgrid(np.arange(len(puts)), np.arange(len(calls)), indexing="ij")
+    p = p.ravel()
+    c = c.ravel()
+    mg = puts.mg.to_numpy(dtype=float)[p] + calls.mg.to_numpy(dtype=float)[c]
+    width = np.maximum(puts.width.to_numpy(dtype=float)[p], calls.width.to_numpy(dtype=float)[c])
+    e_w = 100 * (puts.e.to_numpy(dtype=float)[p] + calls.e.to_numpy(dtype=float)[c]) / width
+    p_strike = puts.s_strikePrice.to_numpy(dtype=float)[p]
+    c_strike = calls.s_strikePrice.to_numpy(dtype=float)[c]
+    mask = (p_strike < c_strike) & ~np.isnan(e_w)
+    if min_credit is not None:
+        mask &= mg >= min_credit
+    if max_loss is not None:
+        mask &= width - mg <= max_loss
+    if min_e_w is not None:
+        mask &= e_w >= min_e_w
+    p_delta, p_valid = puts.attrs["chainIndex"].interp_delta("PUT", day, p_strike - mg)
+    c_delta, c_valid = calls.attrs["chainIndex"].interp_delta("CALL", day, c_strike + mg)
+    pop = 100 * (1 - p_delta - c_delta)
+    mask &= p_valid & c_valid
+    if min_pop is not None:
+        mask &= ~(pop < min_pop)
+    keep = np.flatnonzero(mask)
+    order = keep[np.lexsort((c[keep], p[keep], -e_w[keep]))][:top_k]
+    return (puts.index.to_numpy()[p[order]], calls.index.to_numpy()[c[order]], e_w[order], pop[order])
+
+
+@pytest.fixture
+def sides(write_chains, monkeypatch):
+    write_chains("SYN", expirations=4, strikes=100, seed=13)
+    monkeypatch.setattr(oc, "MIN_WIDTH", 5.0)
+    return {putCall: get_dataframe("SYN", putCall=putCall, run_date="2021-04-01") for putCall in ("PUT", "CALL")}
+
+
+@pytest.mark.parametrize("bounds", BOUNDS)
+def test_condors_match_brute_force(sides, bounds):
+    checked = 0
+    for day in sorted(sides["PUT"].daysToExpiration.unique()):
+        puts = get_candidates(sides["PUT"], daysToExpiration=day)
+        calls = get_candidates(sides["CALL"], daysToExpiration=day)
+        if puts is None or calls is None or len(puts) == 0 or len(calls) == 0:
+            continue
+        condors = get_condors(puts, calls, top_k=20, **bounds)
+        p_row, c_row, e_w, pop = brute_force(puts, calls, day, 20, **bounds)
+        assert list(condors.p_row) == list(p_row)
+        assert list(condors.c_row) == list(c_row)
+        assert np.allclose(condors.e_w.to_numpy(dtype=float), e_w)
+        assert np.allclose(condors["pop"].to_numpy(dtype=float), pop)
+        checked += len(condors)
+    assert checked > 0
+
+
+def test_condors_all_days(sides):
+    # the daysToExpiration="all" frames give each day's condors
+    puts = get_candidates(sides["PUT"], daysToExpiration="all")
+    calls = get_candidates(sides["CALL"], daysToExpiration="all")
+    condors = get_condors(puts, calls, top_k=10)
+    assert len(condors) > 0
+    for day in sorted(set(condors.daysToExpiration)):
+        single = get_condors(get_candidates(sides["PUT"], daysToExpiration=day),
+                             get_candidates(sides["CALL"], daysToExpiration=day), top_k=10)
+        part = condors[condors.daysToExpiration == day]
+        assert np.allclose(part.e_w.to_numpy(dtype=float), single.e_w.to_numpy(dtype=float))
+        assert np.allclose(part["pop"].to_numpy(dtype=float), single["pop"].to_numpy(dtype=float))
+
+
+def test_condors_rebuild_missing_or_stale_index(sides, caplog):
+    puts = get_candidates(sides["PUT"], daysToExpiration="all")
+    calls = get_candidates(sides["CALL"], daysToExpiration="all")
+    want = get_condors(puts, calls, top_k=10)
+    missing = puts.copy()
+    missing.attrs = {}
+    stale = calls.copy()
+    stale.attrs["chainIndex"] = puts.attrs["chainIndex"]
+    with caplog.at_level(logging.WARNING):
+        got = get_condors(missing, stale, top_k=10)
+    assert "no PUT chainIndex" in caplog.text
+    assert "CALL chainIndex doesn't match" in caplog.text
+    # the same condors, with pop from the legs' strikes only
+    assert len(got) == len(want)
+    assert np.allclose(got.e_w.to_numpy(dtype=float), want.e_w.to_numpy(dtype=float))
+    assert np.allclose(got["pop"].to_numpy(dtype=float), want["pop"].to_numpy(dtype=float), atol=2.0)
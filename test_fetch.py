@@ -0,0 +1,136 @@
+import os
+import json
+import pytest
+import opchain.opchain as oc
+from opchain import fetch
+from opchain.fetch import TokenBucket, fetch_chains, fetch_many
+
+# fetch_chains and fetch_many against the stub chains api in conftest.py
+
+
+def fake_clock():
+    # (clock, sleep) where sleep moves clock on
+    now = [0.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+    return (lambda: now[0], sleep)
+
+
+def test_fetch_retries_with_backoff(chain_server):
+    chain_server.script["SYN"] = [503, 500, 200]
+    sleeps = []
+    data, status = fetch_chains("SYN", token="tok", url=chain_server.url, sleep=sleeps.append)
+    assert status["status"] == "ok" and status["attempts"] == 3 and status["status_code"] == 200
+    assert data == chain_server.get_chains("SYN")
+    assert chain_server.requests == [("SYN", "Bearer tok")] * 3
+    # doubled each retry, with jitter of up to half
+    assert len(sleeps) == 2
+    for attempt, seconds in enumerate(sleeps):
+        delay = fetch.BACKOFF_BASE * 2**attempt
+        assert delay * 0.5 <= seconds <= delay
+
+
+@pytest.mark.parametrize("retry_after, seconds", [("7", 7.0), ("120", fetch.BACKOFF_MAX)])
+def test_fetch_honours_retry_after(chain_server, retry_after, seconds):
+    chain_server.script["SYN"] = [(429, {"Retry-After": retry_after}), 200]
+    sleeps = []
+    data, status = fetch_chains("SYN", token="tok", url=chain_server.url, sleep=sleeps.append)
+    assert status["status"] == "ok" and status["attempts"] == 2
+    assert sleeps == [seconds]
+
+
+def test_fetch_gives_up_after_retries(chain_server):
+    chain_server.script["SYN"] = [503] * 5
+    sleeps = []
+    data, status = fetch_chains("SYN", token="tok", url=chain_server.url, retries=2, sleep=sleeps.append)
+    assert data is None
+    assert status["status"] == "failed" and status["attempts"] == 3 and status["status_code"] == 503
+    assert len(sleeps) == 2
+
+
+def test_fetch_doesnt_retry_404(chain_server):
+    chain_server.script["SYN"] = [404]
+    sleeps = []
+    data, status = fetch_chains("SYN", token="tok", url=chain_server.url, sleep=sleeps.append)
+    assert data is None
+    assert status["attempts"] == 1 and status["status_code"] == 404 and "404" in status["error"]
+    assert sleeps == []
+
+
+def test_fetch_failed_status_isnt_saved(chain_server, chains_dir):
+    chain_server.script["SYN"] = ["FAILED"]
+    filepath = oc.get_chains_path("SYN", "2021-04-01")
+    os.makedirs(os.path.dirname(filepath))
+    sleeps = []
+    data, status = fetch_chains("SYN", token="tok", url=chain_server.url, sleep=sleeps.append, filepath=filepath)
+    assert data is None
+    assert status["attempts"] == 1 and status["error"] == "got FAILED status"
+    assert sleeps == []
+    assert os.listdir(os.path.dirname(filepath)) == []
+
+
+@pytest.mark.parametrize("script", [[503, 429, 200], [500, 404], ["FAILED"]])
+def test_fetch_closes_streamed_responses(chain_server, chains_dir, script):
+    # every response is closed, whether its body was read or not
+    chain_server.script["SYN"] = list(script)
+    filepath = oc.get_chains_path("SYN", "2021-04-01")
+    os.makedirs(os.path.dirname(filepath))
+    session = fetch.get_session(pool_size=1)
+    responses = []
+    get = session.get
+
+    def recorded_get(*args, **kwargs):
+        responses.append(get(*args, **kwargs))
+        return responses[-1]
+    session.get = recorded_get
+    fetch_chains("SYN", session=session, token="tok", url=chain_server.url, sleep=lambda seconds: None,
+                 filepath=filepath)
+    assert len(responses) == len(script)
+    assert all(rsp.raw.closed for rsp in responses)
+
+
+def test_token_bucket_budget():
+    clock, sleep = fake_clock()
+    bucket = TokenBucket(2.0, clock=clock, sleep=sleep)
+    # a full bucket (capacity 2), then one every half second
+    for i in range(10):
+        bucket.acquire()
+    assert clock() == pytest.approx(4.0)
+    assert bucket.try_acquire() == pytest.approx(0.5)
+
+
+def test_fetch_spends_a_token_per_attempt(chain_server):
+    chain_server.script["SYN"] = [503, 503, 200]
+    clock, sleep = fake_clock()
+    limiter = TokenBucket(1.0, clock=clock, sleep=sleep)
+    data, status = fetch_chains("SYN", token="tok", url=chain_server.url, limiter=limiter, sleep=lambda s: None)
+    assert status["attempts"] == 3
+    # the first attempt had the bucket's one token, the retries waited a second each
+    assert clock() == pytest.approx(2.0)
+
+
+def test_fetch_many_saves_chains(chain_server, chains_dir):
+    chain_server.script["BBB"] = [503]
+    chain_server.script["NOPE"] = [404]
+    chain_server.chain_args["BBB"] = {"underlying": 250.0, "expirations": 3}
+    symbols = ["AAA", "BBB", "NOPE"]
+    statuses = fetch_many(symbols, run_date="2021-04-01", workers=2, requests_per_minute=6000, token="tok",
+                          url=chain_server.url)
+    assert [s["symbol"] for s in statuses] == symbols
+    assert [s["status"] for s in statuses] == ["ok", "ok", "failed"]
+    assert statuses[1]["attempts"] == 2
+    assert statuses[2]["status_code"] == 404
+    for symbol in ("AAA", "BBB"):
+        with open(oc.get_chains_path(symbol, "2021-04-01")) as f:
+            assert json.load(f) == chain_server.get_chains(symbol)
+        df = oc.get_dataframe(symbol, putCall="PUT", run_date="2021-04-01")
+        assert len(df) > 0 and df.attrs["underlyingPrice"] == chain_server.get_chains(symbol)["underlyingPrice"]
+    assert not os.path.exists(oc.get_chains_path("NOPE", "2021-04-01"))
+
+    # saved chains aren't fetched again
+    count = len(chain_server.requests)
+    statuses = fetch_many(symbols[:2], run_date="2021-04-01", requests_per_minute=6000, token="tok",
+                          url=chain_server.url)
+    assert [s["status"] for s in statuses] == ["cached", "cached"]
+    assert len(chain_server.requests) == count
@@ -0,0 +1,64 @@
+import random
+import pandas as pd
+import pytest
+from opchain.opchain import get_candidates, get_dataframe
+from opchain.incremental import update_candidates
+
+# update_candidates against a full get_candidates rescan of the new contracts
+
+FILTERS = [None, [("mg", ">=", 0.5)], [("s_totalVolume", ">", 10)]]
+
+
+def perturb(df, rnd, drop):
+    # a copy of an expiration's contracts with a few quotes moved (and an
+    # option dropped), as the next snapshot of the chain
+    df = df.copy()
+    for _ in range(rnd.randint(1, 8)):
+        i = rnd.randrange(len(df))
+        name = rnd.choice(["mark", "delta", "totalVolume", "last"])
+        col = df.columns.get_loc(name)
+        if name == "totalVolume":
+            df.iloc[i, col] = rnd.randint(0, 100)
+        elif name == "delta":
+            df.iloc[i, col] = df.iloc[i, col] * rnd.uniform(0.9, 1.1)
+        else:
+            df.iloc[i, col] = df.iloc[i, col] * rnd.uniform(0.8, 1.2)
+    if drop:
+        df = df.drop(df.index[rnd.randrange(1, len(df) - 1)])
+    return df
+
+
+@pytest.mark.parametrize("putCall", ["PUT", "CALL"])
+def test_update_matches_full_rescan(write_chains, putCall):
+    write_chains("SYN", expirations=3, strikes=200, seed=1)
+    contracts = get_dataframe("SYN", putCall=putCall, run_date="2021-04-01")
+    days = sorted(contracts.daysToExpiration.unique())
+    incremental = 0
+    for trial in range(24):
+        rnd = random.Random(trial)
+        prev_contracts = get_dataframe("SYN", putCall=putCall, run_date="2021-04-01",
+                                       daysToExpiration=days[trial % len(days)])
+        filters = FILTERS[trial % len(FILTERS)]
+        prev = get_candidates(prev_contracts, filters=filters)
+        new_contracts = perturb(prev_contracts, rnd, drop=trial % 5 == 0)
+
+        got, changes = update_candidates(prev_contracts, prev, new_contracts, filters=filters)
+        want = get_candidates(new_contracts, filters=filters)
+        pd.testing.assert_frame_equal(got, want, check_dtype=False)
+        assert got.attrs["daysToExpiration"] == want.attrs["daysToExpiration"]
+        if not changes["full"]:
+            incremental += 1
+            assert changes["recomputed"] <= len(want)
+    # most snapshots shouldn't need everything recomputed
+    assert incremental > 12
+
+
+def test_update_without_changes(write_chains):
+    write_chains("SYN", expirations=2, strikes=120, seed=2)
+    contracts = get_dataframe("SYN", putCall="PUT", run_date="2021-04-01", daysToExpiration=10)
+    prev = get_candidates(contracts)
+    assert len(prev) > 0
+    got, changes = update_candidates(contracts, prev, contracts.copy())
+    pd.testing.assert_frame_equal(got, prev)
+    assert changes["recomputed"] == 0 and not changes["full"]
+    assert changes["options"] == {"added": [], "changed": [], "removed": []}
@@ -0,0 +1,43 @@
+import time
+import pytest
+import opchain.opchain as oc
+from opchain import metrics
+from opchain.opchain import get_dataframe
+
+# stage times don't overlap
+
+
+@pytest.fixture
+def enabled():
+    metrics.reset()
+    metrics.enable()
+    yield
+    metrics.disable()
+    metrics.reset()
+
+
+def test_inner_stage_not_counted_twice(enabled):
+    with metrics.timer("load"):
+        time.sleep(0.02)
+        with metrics.timer("mmm"):
+            time.sleep(0.05)
+        started = metrics.start()
+        time.sleep(0.05)
+        metrics.stop("parse", started)
+    stages = metrics.snapshot()["stages"]
+    assert stages["mmm"]["seconds"] >= 0.05 and stages["parse"]["seconds"] >= 0.05
+    assert 0.02 <= stages["load"]["seconds"] < 0.05
+    assert stages["load"]["calls"] == 1
+
+
+def test_streamed_chain_stages_add_up(write_chains, monkeypatch, enabled):
+    write_chains("SYN", expirations=6, strikes=200, seed=16)
+    monkeypatch.setattr(oc, "USE_SNAPSHOTS", False)
+    monkeypatch.setattr(oc, "STREAM_CHAINS", True)
+    monkeypatch.setattr(oc, "STREAM_MIN_BYTES", 0)
+    started = time.perf_counter()
+    get_dataframe("SYN", run_date="2021-04-01")
+    wall = time.perf_counter() - started
+    stages = metrics.snapshot()["stages"]
+    assert stages["mmm"]["calls"] == 1 and stages["load"]["calls"] == 1
+    assert sum(stages[stage]["seconds"] for stage in stages) <= wall
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import opchain.opchain as oc
+from opchain.opchain import get_candidates, get_dataframe, get_derived
+
+# get_candidates' vectorized pairs against the per row get_derived loop
+# they replaced (sell legs strictly inside sell_range, buy legs inclusive,
+# get_prb over the expiration's options for the break even)
+
+VALUE_COLUMNS = ["e", "e_w", "mg", "ml", "width", "eml", "dme", "dme_w", "mg_w", "pop"]
+KEEP_LIST = ["description", "last", "mark", "delta", "strikePrice", "totalVolume"]
+
+
+def loop_candidates(df, putCall, sell_range, buy_range):
+    # {(s_description, b_description): row} the old nested loop gives for
+    # one expiration
+    buy_df = df[(abs(df.delta) >= buy_range[0]) & (abs(df.delta) <= buy_range[1])]
+    sell_df = df[(abs(df.delta) > sell_range[0]) & (abs(df.delta) < sell_range[1])]
+    rows = {}
+    for i, b in buy_df.iterrows():
+        for j, s in sell_df.iterrows():
+            if putCall == "PUT" and b.strikePrice >= s.strikePrice:
+                continue
+            if putCall == "CALL" and b.strikePrice <= s.strikePrice:
+                continue
+            if abs(b.delta) > abs(s.delta):
+                continue
+            row = {}
+            for k in KEEP_LIST:
+                row["b_" + k] = b[k]
+                row["s_" + k] = s[k]
+            if get_derived(row, putCall=putCall, underlying=df.attrs["underlyingPrice"], options=df):
+                rows[(row["s_description"], row["b_description"])] = row
+    return rows
+
+
+@pytest.mark.parametrize("putCall", ["PUT", "CALL"])
+@pytest.mark.parametrize("min_width", [5.0, 25.0])
+def test_pairs_match_loop(write_chains, monkeypatch, putCall, min_width):
+    write_chains("SYN", expirations=3, strikes=80, seed=3)
+    monkeypatch.setattr(oc, "MIN_WIDTH", min_width)
+    contracts = get_dataframe("SYN", putCall=putCall, run_date="2021-04-01")
+    if putCall == "PUT":
+        sell_range, buy_range = oc.PSR_PS_DELTA_RANGE, oc.PSR_PB_DELTA_RANGE
+    else:
+        sell_range, buy_range = oc.CSR_CS_DELTA_RANGE, oc.CSR_CB_DELTA_RANGE
+    checked = 0
+    for day in sorted(contracts.daysToExpiration.unique()):
+        df = contracts[contracts.daysToExpiration == day]
+        expected = loop_candidates(df, putCall, sell_range, buy_range)
+        candidates = get_candidates(df, putCall=putCall, daysToExpiration=day)
+        if candidates is None:
+            assert not expected
+            continue
+        keys = list(zip(candidates.s_description, candidates.b_description))
+        assert sorted(keys) == sorted(expected)
+        for name in VALUE_COLUMNS:
+            values = [expected[key][name] for key in keys]
+            assert np.allclose(candidates[name].to_numpy(dtype=float), values), name
+        assert (candidates.e_w.diff().dropna() <= 0).all()
+        checked += len(keys)
+    assert checked > 0
+
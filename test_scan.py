@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+import opchain.opchain as oc
+from opchain.opchain import get_dataframe, count_candidates, get_candidates
+from opchain.scan import _get_best_rows
+from opchain.filters import OPS
+
+# _get_best_rows with filters against filtering all of its unfiltered rows
+
+FILTERS = [[("days_exp", ">=", 10), ("days_exp", "<=", 24)],
+           [("days_exp", ">", 30), ("e_w", ">", -5.0), ("mg", ">=", 0.5)],
+           [("daysToExpiration", "<", 0)]]
+
+
+@pytest.fixture
+def sides(write_chains, monkeypatch):
+    write_chains("SYN", expirations=5, strikes=80, seed=14)
+    monkeypatch.setattr(oc, "MIN_WIDTH", 5.0)
+    return {putCall: get_dataframe("SYN", putCall=putCall, run_date="2021-04-01") for putCall in ("PUT", "CALL")}
+
+
+def passing(rows, filters):
+    # positions of the rows passing every filter
+    return [i for i, row in enumerate(rows) if all(OPS[op](row[column], value) for column, op, value in filters)]
+
+
+@pytest.mark.parametrize("putCall", ["PUT", "CALL"])
+@pytest.mark.parametrize("filters", FILTERS)
+def test_filtered_rows_keep_positions(sides, putCall, filters):
+    df = sides[putCall]
+    days = sorted(df.daysToExpiration.unique())
+    all_rows, all_ids, all_total = _get_best_rows(df, daysToExpiration=days, count=7)
+    assert all_ids == list(range(all_total))
+    rows, row_ids, total = _get_best_rows(df, daysToExpiration=days, count=7, filters=filters)
+    keep = passing(all_rows, filters)
+    assert total == all_total
+    assert list(row_ids) == keep
+    assert [row["s_description"] for row in rows] == [all_rows[i]["s_description"] for i in keep]
+    assert np.allclose([row["e_w"] for row in rows], [all_rows[i]["e_w"] for i in keep])
+
+
+def test_count_candidates(sides):
+    df = sides["PUT"]
+    counts = count_candidates(df)
+    assert sum(counts.values()) > 0
+    for day in counts:
+        want = get_candidates(df, daysToExpiration=day)
+        assert counts[day] == (0 if want is None else len(want))
+    single = get_dataframe("SYN", putCall="PUT", run_date="2021-04-01", daysToExpiration=day)
+    rows, row_ids, total = _get_best_rows(single, daysToExpiration=day, count=1, filters=[("days_exp", "<", 0)])
+    assert (rows, row_ids, total) == ([], [], min(1, counts[day]))
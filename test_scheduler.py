@@ -0,0 +1,94 @@
+import os
+import json
+from datetime import datetime
+import pytest
+import opchain.opchain as oc
+from opchain.scheduler import RefreshScheduler, get_priority, get_intraday_path, _read_stats
+
+# RefreshScheduler on a fake clock against the stub chains api in conftest.py
+
+START = datetime(2021, 4, 1, 10, 0, 0).timestamp()
+
+
+class FakeClock:
+    def __init__(self, now=START):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def write_daily(write_chains, symbol, age, **kwargs):
+    # a daily chain last fetched age seconds before START
+    write_chains(symbol, **kwargs)
+    filepath = oc.get_chains_path(symbol, "2021-04-01")
+    os.utime(filepath, (START - age, START - age))
+    return filepath
+
+
+def test_refresh_in_priority_order(write_chains, chain_server):
+    # more strikes, more open interest - and NEW has never been fetched
+    sizes = {"LOW": 20, "HIGH": 120, "MID": 60}
+    for symbol in sizes:
+        write_daily(write_chains, symbol, 2 * 60 * 60, strikes=sizes[symbol], seed=1)
+        chain_server.chain_args[symbol] = {"strikes": sizes[symbol], "seed": 1}
+    stats = {symbol: _read_stats(oc.get_chains_path(symbol, "2021-04-01")) for symbol in sizes}
+    ranked = sorted(sizes, key=lambda symbol: -get_priority(stats[symbol]))
+    assert ranked == ["HIGH", "MID", "LOW"]
+
+    clock = FakeClock()
+    # two a minute - one token at a time, refilled every 30 seconds
+    scheduler = RefreshScheduler(["LOW", "NEW", "MID", "HIGH"], requests_per_minute=2, clock=clock,
+                                 sleep=clock.sleep, url=chain_server.url, token="tok")
+    schedule = scheduler.get_schedule().set_index("symbol")
+    assert schedule.loc["HIGH", "interval"] < schedule.loc["MID", "interval"] < schedule.loc["LOW", "interval"]
+
+    assert scheduler.run_once() == ["NEW"]
+    assert scheduler.run_once() == []
+    scheduler.run(until=START + 100)
+    assert [symbol for symbol, auth in chain_server.requests] == ["NEW"] + ranked
+    assert {symbol: scheduler.states[symbol]["last"] for symbol in ranked} == {
+        "HIGH": START + 30, "MID": START + 60, "LOW": START + 90}
+    # nothing is due again until its interval is up
+    assert scheduler.get_wait() >= scheduler.min_interval - 100
+
+
+def test_intraday_snapshots_copied_over_daily(chains_dir, chain_server):
+    clock = FakeClock()
+    scheduler = RefreshScheduler(["SYN"], requests_per_minute=60, intervals={"SYN": 120}, clock=clock,
+                                 sleep=clock.sleep, url=chain_server.url, token="tok")
+    daily = oc.get_chains_path("SYN", "2021-04-01")
+    for i, hhmmss in enumerate(["100000", "100200", "100400"]):
+        chain_server.chain_args["SYN"] = {"seed": i, "strikes": 30}
+        scheduler.run(until=START + 120 * i + 1)
+        intraday = get_intraday_path("SYN", "2021-04-01", hhmmss)
+        assert intraday == f"data/SYN/SYN-2021-04-01T{hhmmss}.json"
+        with open(intraday) as f:
+            assert json.load(f) == chain_server.get_chains("SYN")
+        # the daily file is the latest snapshot, and get_dataframe sees it
+        with open(intraday, "rb") as f, open(daily, "rb") as g:
+            assert f.read() == g.read()
+        df = oc.get_dataframe("SYN", putCall="PUT", run_date="2021-04-01")
+        want = oc._get_sideframe(chain_server.get_chains("SYN"), "PUT")
+        assert df["mark"].tolist() == want["mark"].tolist()
+    names = sorted(name for name in os.listdir("data/SYN") if name.endswith(".json"))
+    assert names == ["SYN-2021-04-01.json", "SYN-2021-04-01T100000.json", "SYN-2021-04-01T100200.json",
+                     "SYN-2021-04-01T100400.json"]
+    assert scheduler.states["SYN"]["fetches"] == 3
+
+
+def test_failed_fetch_is_retried(chains_dir, chain_server):
+    chain_server.script["SYN"] = [503]
+    clock = FakeClock()
+    scheduler = RefreshScheduler(["SYN"], requests_per_minute=60, clock=clock, sleep=clock.sleep,
+                                 url=chain_server.url, token="tok")
+    assert scheduler.run_once() == ["SYN"]
+    assert scheduler.states["SYN"]["failures"] == 1
+    assert not os.path.exists(oc.get_chains_path("SYN", "2021-04-01"))
+    assert scheduler.get_wait() == pytest.approx(60.0)
+    scheduler.run(until=START + 61)
+    assert scheduler.states["SYN"]["failures"] == 0 and scheduler.states["SYN"]["fetches"] == 1
+    assert os.path.isfile(get_intraday_path("SYN", "2021-04-01", "100100"))
@@ -0,0 +1,121 @@
+import io
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import opchain.opchain as oc
+from opchain.opchain import read_chain, get_mmm, get_dataframe
+from opchain.stream import iter_chain, get_chain_values
+from opchain.synth import make_chains
+
+# the streaming chain decoder against json.load and _get_mapdata
+
+
+def get_bytes(chains):
+    return json.dumps(chains).encode("utf-8")
+
+
+def assert_same_frames(chains, meta, sides):
+    # the side frames read_chain's output makes against the json.load ones
+    mmm = get_mmm(chains, underlying=chains["underlyingPrice"])
+    assert meta["mmm"] == mmm
+    for putCall in ("PUT", "CALL"):
+        want = oc._get_sideframe(chains, putCall, symbol="SYN", run_date="2021-04-01", mmm_map=mmm)
+        got = oc._new_sideframe(sides[putCall], meta, symbol="SYN", run_date="2021-04-01", mmm_map=meta["mmm"])
+        pd.testing.assert_frame_equal(got, want)
+        assert got.attrs.keys() == want.attrs.keys()
+
+
+@pytest.mark.parametrize("chunk_rows", [7, oc.STREAM_CHUNK_ROWS])
+@pytest.mark.parametrize("pm", [0.0, 0.3])
+def test_read_chain_matches_json_load(chunk_rows, pm):
+    chains = make_chains(expirations=5, strikes=60, missing=0.05, pm=pm, seed=4)
+    meta, sides = read_chain(io.BytesIO(get_bytes(chains)), chunk_rows=chunk_rows)
+    assert meta["underlyingPrice"] == chains["underlyingPrice"]
+    assert_same_frames(chains, meta, sides)
+
+
+def test_read_chain_unexpected_values():
+    # a "NaN" string and a float in an int column come out the same either way
+    chains = make_chains(expirations=3, strikes=40, seed=6)
+    exp = list(chains["putExpDateMap"])[1]
+    strike = list(chains["putExpDateMap"][exp])[0]
+    option = chains["putExpDateMap"][exp][strike][0]
+    option["mark"] = "NaN"
+    option["openInterest"] = 12.5
+    del option["totalVolume"]
+    meta, sides = read_chain(io.BytesIO(get_bytes(chains)), chunk_rows=16)
+    assert_same_frames(chains, meta, sides)
+    puts = oc._get_mapdata(chains["putExpDateMap"], "PUT", underlying=chains["underlyingPrice"])
+    assert "NaN" in list(puts["mark"])
+    assert 12.5 in list(puts["openInterest"])
+
+
+def test_read_chain_underlying_after_maps():
+    chains = make_chains(expirations=3, strikes=40, seed=7)
+    moved = dict(chains)
+    underlying = moved.pop("underlyingPrice")
+    moved["underlyingPrice"] = underlying
+    meta, sides = read_chain(io.BytesIO(get_bytes(moved)), chunk_rows=5)
+    assert_same_frames(chains, meta, sides)
+
+
+def test_read_chain_filtered():
+    chains = make_chains(expirations=4, strikes=40, seed=8)
+    meta, sides = read_chain(io.BytesIO(get_bytes(chains)))
+    part_meta, part = read_chain(io.BytesIO(get_bytes(chains)), putCalls=("PUT",), days={10})
+    assert part_meta["mmm"] is None
+    assert len(part["CALL"]["symbol"]) == 0
+    keep = sides["PUT"]["daysToExpiration"] == 10
+    assert keep.any()
+    for name in oc.OPTION_PROPS:
+        assert np.array_equal(part["PUT"][name], sides["PUT"][name][keep])
+
+
+def test_iter_chain_small_reads():
+    # values and numbers split across reads decode the same
+    chains = make_chains(expirations=2, strikes=20, seed=9)
+    data = get_bytes(chains)
+    values = {}
+    maps = {"PUT": {}, "CALL": {}}
+    for event in iter_chain(io.BytesIO(data), read_size=64):
+        if event[0] == "value":
+            values[event[1]] = event[2]
+        else:
+            maps[event[1]][event[2]] = event[3]
+    assert maps["PUT"] == chains["putExpDateMap"]
+    assert maps["CALL"] == chains["callExpDateMap"]
+    for k in values:
+        assert values[k] == chains[k]
+    head = get_chain_values(io.BytesIO(data), read_size=64)
+    assert head["underlyingPrice"] == chains["underlyingPrice"] and "putExpDateMap" not in head
+
+
+@pytest.mark.parametrize("stream_min_bytes", [0, 1 << 40])
+def test_get_dataframe_stream_or_json_load(write_chains, monkeypatch, stream_min_bytes):
+    # streamed (0) and json.load'ed (everything under the threshold) chains
+    # give the same frames as the json.load path with streaming off
+    write_chains("SYN", expirations=4, strikes=60, pm=0.2, seed=10)
+    monkeypatch.setattr(oc, "USE_SNAPSHOTS", False)
+    monkeypatch.setattr(oc, "STREAM_CHAINS", False)
+    want = get_dataframe("SYN", run_date="2021-04-01")
+    oc.clear_chain_cache()
+    monkeypatch.setattr(oc, "STREAM_CHAINS", True)
+    monkeypatch.setattr(oc, "STREAM_MIN_BYTES", stream_min_bytes)
+    got = get_dataframe("SYN", run_date="2021-04-01")
+    pd.testing.assert_frame_equal(got, want)
+    assert got.attrs["mmm"] == want.attrs["mmm"]
+
+
+def test_pm_checked_per_option():
+    # the same root with PM and AM descriptions - each option is checked
+    chains = make_chains(expirations=2, strikes=40, seed=17)
+    options = [option for exp in chains["putExpDateMap"].values() for strike in exp.values() for option in strike]
+    options[0]["description"] += " (PM)"
+    options[-1]["description"] += " (PM)"
+    puts = oc._get_mapdata(chains["putExpDateMap"], "PUT", underlying=chains["underlyingPrice"])
+    descs = list(puts["description"])
+    assert options[0]["description"] not in descs and options[-1]["description"] not in descs
+    assert options[1]["description"] in descs or options[1]["strikePrice"] >= chains["underlyingPrice"]
+    meta, sides = read_chain(io.BytesIO(get_bytes(chains)), chunk_rows=16)
+    assert list(sides["PUT"]["description"]) == descs
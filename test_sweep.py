@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import opchain.opchain as oc
+from opchain.opchain import get_candidates, get_dataframe
+from opchain.sweep import sweep_candidates, get_grid
+
+# sweep_candidates against get_candidates run once per setting
+
+SELL_RANGES = [(0.05, 0.12), (0.05, 0.2), (0.1, 0.3)]
+BUY_RANGES = [(0.009, 0.12), (0.02, 0.2)]
+MIN_WIDTHS = [5.0, 10.0, 25.0]
+TOP_K = 5
+
+
+@pytest.mark.parametrize("putCall", ["PUT", "CALL"])
+def test_sweep_matches_get_candidates(write_chains, monkeypatch, putCall):
+    write_chains("SYN", expirations=3, strikes=100, seed=11)
+    contracts = get_dataframe("SYN", putCall=putCall, run_date="2021-04-01")
+    filters = [("mg", ">=", 0.2)]
+    summary, top = sweep_candidates(contracts, sell_ranges=SELL_RANGES, buy_ranges=BUY_RANGES, min_widths=MIN_WIDTHS,
+                                    daysToExpiration="all", top_k=TOP_K, filters=filters)
+    grid = get_grid(putCall, SELL_RANGES, BUY_RANGES, MIN_WIDTHS)
+    days = sorted(contracts.daysToExpiration.unique())
+    assert len(summary) == len(grid) * len(days)
+    checked = 0
+    for config, (sell_range, buy_range, min_width) in enumerate(grid):
+        monkeypatch.setattr(oc, "MIN_WIDTH", min_width)
+        for day in days:
+            row = summary[(summary.config == config) & (summary.daysToExpiration == day)].iloc[0]
+            assert (row.sell_low, row.sell_high, row.buy_low, row.buy_high, row.min_width) == (
+                sell_range + buy_range + (min_width,))
+            want = get_candidates(contracts, sell_range=sell_range, buy_range=buy_range, daysToExpiration=day,
+                                  filters=filters)
+            assert row.pairs == (0 if want is None else len(want))
+            got = top[(top.config == config) & (top.daysToExpiration == day)]
+            if want is None or len(want) == 0:
+                assert len(got) == 0
+                continue
+            want = get_candidates(contracts, sell_range=sell_range, buy_range=buy_range, daysToExpiration=day,
+                                  top_k=TOP_K, filters=filters)
+            assert list(got["rank"]) == list(range(1, len(want) + 1))
+            assert list(got.s_description) == list(want.s_description)
+            assert list(got.b_description) == list(want.b_description)
+            for name in ("e", "e_w", "mg", "width", "pop"):
+                assert np.allclose(got[name].to_numpy(dtype=float), want[name].to_numpy(dtype=float)), name
+            assert row.e_w_max == pytest.approx(want.e_w.max())
+            checked += 1
+    assert checked > len(grid)
+
+
+def test_sweep_defaults_to_current_settings(write_chains, monkeypatch):
+    # settings left out of the grid are get_candidates' at the time of the call
+    write_chains("SYN", expirations=2, strikes=100, seed=12)
+    contracts = get_dataframe("SYN", putCall="PUT", run_date="2021-04-01")
+    monkeypatch.setattr(oc, "MIN_WIDTH", 10.0)
+    monkeypatch.setattr(oc, "PSR_PS_DELTA_RANGE", (0.05, 0.25))
+    assert get_grid("PUT") == [((0.05, 0.25), oc.PSR_PB_DELTA_RANGE, 10.0)]
+    summary, top = sweep_candidates(contracts, daysToExpiration="all", top_k=3)
+    assert summary.pairs.sum() > 0
+    for day in sorted(contracts.daysToExpiration.unique()):
+        want = get_candidates(contracts, daysToExpiration=day)
+        row = summary[summary.daysToExpiration == day].iloc[0]
+        assert row.pairs == (0 if want is None else len(want))
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import opchain.opchain as oc
+from opchain.opchain import get_candidates, get_dataframe, _get_top_k
+
+# get_candidates' top_k against sorting every spread
+
+
+def test_get_top_k_ties_and_nan():
+    values = np.array([1.0, np.nan, 3.0, 2.0, 3.0, 2.0, np.nan])
+    assert list(_get_top_k(values, 3)) == [2, 4, 3]
+    assert list(_get_top_k(values, 4)) == [2, 4, 3, 5]
+    assert list(_get_top_k(values, 7)) == [2, 4, 3, 5, 0, 1, 6]
+    assert list(_get_top_k(values, 10)) == [2, 4, 3, 5, 0, 1, 6]
+
+
+@pytest.mark.parametrize("putCall", ["PUT", "CALL"])
+@pytest.mark.parametrize("top_k", [1, 7, 10000])
+def test_top_k_matches_full_sort(write_chains, monkeypatch, putCall, top_k):
+    write_chains("SYN", expirations=4, strikes=80, seed=5)
+    monkeypatch.setattr(oc, "MIN_WIDTH", 5.0)
+    contracts = get_dataframe("SYN", putCall=putCall, run_date="2021-04-01")
+    checked = 0
+    for day in sorted(contracts.daysToExpiration.unique()):
+        full = get_candidates(contracts, daysToExpiration=day)
+        top = get_candidates(contracts, daysToExpiration=day, top_k=top_k)
+        if full is None:
+            assert top is None
+            continue
+        # the top_k best e_w (ties may pick different pairs), each a pair of the day
+        best = np.sort(full.e_w.to_numpy(dtype=float))[::-1][:top_k]
+        assert len(top) == min(top_k, len(full))
+        assert np.allclose(top.e_w.to_numpy(dtype=float), best)
+        full = full.set_index(["s_description", "b_description"])
+        for row in top.itertuples():
+            assert np.isclose(full.loc[(row.s_description, row.b_description), "e_w"], row.e_w)
+        checked += len(top)
+    assert checked > 0